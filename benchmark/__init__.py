@@ -0,0 +1 @@
+"""benchmarks of urls2dataset, run from the repository root with python -m benchmark.<module>"""
@@ -0,0 +1,139 @@
+"""cc_benchmark measures the common crawl path on generated WARC files: sharding, extraction and end to end
+
+python -m benchmark.cc_benchmark --records 5000 --processes "[1,4]" --config '{"media_elems": true}'
+"""
+
+import itertools
+import os
+import tempfile
+import time
+
+import pyarrow as pa
+
+from .crawl_benchmark import environment, record_result, run_config, run_measured
+from .warc_generator import generate_warc
+
+
+def shard_warc(warc_file, tmp_folder, number_sample_per_shard):
+    """Shard a WARC like urls2dataset does, return the shard files and the number of documents"""
+    from urls2dataset.input_sharder import InputSharder  # pylint: disable=import-outside-toplevel
+
+    os.makedirs(tmp_folder, exist_ok=True)
+    sharder = InputSharder(warc_file, "cc", "url", None, None, number_sample_per_shard, set(), tmp_folder)
+    shard_files = [shard_file for _, shard_file in sharder]
+    docs = 0
+    for shard_file in shard_files:
+        with pa.memory_map(shard_file) as source:
+            docs += pa.ipc.open_file(source).read_all().num_rows
+    return {"shard_files": shard_files, "docs": docs}
+
+
+def extract_shards(shard_files, config):
+    """Run the extraction of the cc path on every document of the shards in one thread"""
+    from urls2dataset.data_reader import CCDownloader  # pylint: disable=import-outside-toplevel
+
+    downloader = CCDownloader(config)
+    docs, errors, text_bytes = 0, 0, 0
+    start = time.perf_counter()
+    for shard_file in shard_files:
+        with pa.memory_map(shard_file) as source:
+            column = pa.ipc.open_file(source).read_all()["url"]
+        for data in column.to_pylist():
+            text, _, error, _ = downloader(data)
+            docs += 1
+            if error is not None:
+                errors += 1
+            else:
+                text_bytes += len(text.encode("utf-8"))
+    return {"docs": docs, "errors": errors, "text_bytes": text_bytes, "extraction_time": time.perf_counter() - start}
+
+
+def benchmark(
+    records=2000,
+    median_page_size=20000,
+    media_density=1.0,
+    processes=(1, 2),
+    threads=(4,),
+    number_sample_per_shard=1000,
+    output_format="parquet",
+    config=None,
+    results_file="benchmark_results.jsonl",
+):
+    """Generate a WARC then measure sharding, single thread extraction and end to end runs of urls2dataset
+
+    One json line per measure is appended to results_file, with a "benchmark" field telling which one it is
+    """
+    config = config or {}
+    settings = {"records": records, "median_page_size": median_page_size, "media_density": media_density}
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        warc_file = os.path.join(tmp_dir, "benchmark.warc.gz")
+        generate_warc(warc_file, records, median_page_size, media_density)
+        warc_mb = os.path.getsize(warc_file) / 1024**2
+
+        sharding, measures = run_measured(
+            shard_warc,
+            warc_file=warc_file,
+            tmp_folder=os.path.join(tmp_dir, "shards"),
+            number_sample_per_shard=number_sample_per_shard,
+        )
+        result = {
+            **environment(),
+            **settings,
+            "benchmark": "cc_sharding",
+            "docs": sharding["docs"],
+            **measures,
+            "docs_per_sec": sharding["docs"] / measures["duration"],
+            "warc_mb_per_sec": warc_mb / measures["duration"],
+        }
+        print(f"sharding: {result['docs_per_sec']:.1f} docs/s, {result['warc_mb_per_sec']:.2f} compressed MB/s")
+        results.append(result)
+
+        extraction, measures = run_measured(extract_shards, shard_files=sharding["shard_files"], config=config)
+        result = {
+            **environment(),
+            **settings,
+            "benchmark": "cc_extraction",
+            "config": config,
+            **extraction,
+            **measures,
+            "docs_per_sec": extraction["docs"] / extraction["extraction_time"],
+        }
+        print(f"extraction: {result['docs_per_sec']:.1f} docs/s in one thread, {extraction['errors']} errors")
+        results.append(result)
+
+        for processes_count, thread_count in itertools.product(processes, threads):
+            run_settings = {
+                "processes_count": processes_count,
+                "thread_count": thread_count,
+                "number_sample_per_shard": number_sample_per_shard,
+                "output_format": output_format,
+                "config": config,
+            }
+            measures = run_config(warc_file, os.path.join(tmp_dir, "output"), input_format="cc", **run_settings)
+            result = {
+                **environment(),
+                **settings,
+                "benchmark": "cc_end_to_end",
+                **run_settings,
+                **measures,
+                "docs_per_sec": measures["count"] / measures["duration"],
+            }
+            print(
+                f"end to end, processes {processes_count} threads {thread_count}: "
+                f"{result['docs_per_sec']:.1f} docs/s, peak rss {result['peak_rss_mb']:.0f} MB"
+            )
+            results.append(result)
+        for result in results:
+            record_result(results_file, result)
+    return results
+
+
+def main():
+    import fire  # pylint: disable=import-outside-toplevel
+
+    fire.Fire(benchmark)
+
+
+if __name__ == "__main__":
+    main()
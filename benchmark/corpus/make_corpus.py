@@ -0,0 +1,73 @@
+"""make_corpus writes the html pages of the extraction benchmark corpus, the pages are checked in
+
+python -m benchmark.corpus.make_corpus
+"""
+
+import os
+import random
+
+from ..synthetic_site import generate_page
+
+CORPUS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def paragraphs(rng, words, count):
+    return "".join(
+        "<p>" + " ".join(rng.choice(words) for _ in range(rng.randint(20, 80))) + "</p>" for _ in range(count)
+    )
+
+
+def make_pages():
+    """Dict of file name to page bytes"""
+    rng = random.Random(0)
+    words = "the of and to in is was for on that with as by at from data page text".split()
+    pages = {
+        "small_article.html": generate_page("/small", 5000, 1.0),
+        "news_article.html": generate_page("/news", 60000, 0.5),
+    }
+
+    rows = "".join(
+        "<tr>" + "".join(f"<td>{rng.choice(words)} {rng.randint(0, 10**6)}</td>" for _ in range(8)) + "</tr>"
+        for _ in range(2000)
+    )
+    pages["huge_table.html"] = f"<html><body><table>{rows}</table></body></html>".encode("utf-8")
+
+    depth = 3000
+    nested = "<div><span>level</span>" * depth + "deep text" + "</div>" * depth
+    pages["deep_nesting.html"] = f"<html><body>{nested}</body></html>".encode("utf-8")
+
+    images = "".join(f'<img src="/images/{i}.jpg" alt="image {i}"><br>' for i in range(4000))
+    pages["many_images.html"] = f"<html><body>{paragraphs(rng, words, 5)}{images}</body></html>".encode("utf-8")
+
+    script = "var x = [" + ",".join(str(rng.randint(0, 10**6)) for _ in range(20000)) + "];"
+    style = "".join(f".c{i} {{ color: #{i:06x}; }}" for i in range(3000))
+    pages["script_heavy.html"] = (
+        f"<html><head><style>{style}</style><script>{script}</script></head>"
+        f"<body>{paragraphs(rng, words, 10)}</body></html>"
+    ).encode("utf-8")
+
+    broken = "".join(f"<div><p>{rng.choice(words)}<b><i>{rng.choice(words)}</p></div></b><td>" for _ in range(3000))
+    pages["broken_markup.html"] = f"<html><body>{broken}".encode("utf-8")
+
+    french = "le la les des est une pour qui dans à été très où même déjà français".split()
+    pages["latin1_no_charset.html"] = f"<html><body>{paragraphs(rng, french, 100)}</body></html>".encode("iso-8859-1")
+    russian = "и в не на я быть он с что а по это она этот к но они мы".split()
+    pages["cp1251_meta.html"] = (
+        f'<html><head><meta charset="windows-1251"></head><body>{paragraphs(rng, russian, 100)}</body></html>'
+    ).encode("windows-1251")
+    japanese = "日本 東京 大学 研究 情報 技術 世界 時間 新聞 経済 社会".split()
+    pages["shift_jis.html"] = (
+        '<html lang="ja"><head><meta http-equiv="Content-Type" content="text/html; charset=shift_jis"></head>'
+        f"<body>{paragraphs(rng, japanese, 100)}</body></html>"
+    ).encode("shift_jis")
+    return pages
+
+
+def main():
+    for name, page in make_pages().items():
+        with open(os.path.join(CORPUS_DIR, name), "wb") as f:
+            f.write(page)
+
+
+if __name__ == "__main__":
+    main()
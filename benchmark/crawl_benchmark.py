@@ -0,0 +1,183 @@
+"""crawl_benchmark runs urls2dataset against a local synthetic site across settings and records the throughput
+
+python -m benchmark.crawl_benchmark --pages 5000 --processes "[1,4]" --threads "[16,64]" --latency_median 0.05
+"""
+
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+from .synthetic_site import SyntheticSite
+
+
+def _measured_call(queue, func, kwargs):
+    try:
+        result = func(**kwargs)
+    except Exception as err:  # pylint: disable=broad-except
+        queue.put({"error": repr(err)})
+        raise
+    usage = [resource.getrusage(who) for who in [resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN]]
+    # ru_maxrss is in KB on linux, bytes on macos
+    rss_unit = 1 if sys.platform == "darwin" else 1024
+    queue.put(
+        {
+            "result": result,
+            "cpu_seconds": sum(u.ru_utime + u.ru_stime for u in usage),
+            "peak_rss_mb": max(u.ru_maxrss for u in usage) * rss_unit / 1024**2,
+        }
+    )
+
+
+def run_measured(func, **kwargs):
+    """Call func(**kwargs) in a fresh process, return its result and its wall time, cpu time and peak rss
+
+    CPU time and peak rss include the processes started by func once they are joined,
+    peak rss is the one of the largest process
+    """
+    ctx = multiprocessing.get_context("spawn")
+    queue = ctx.Queue()
+    start = time.perf_counter()
+    process = ctx.Process(target=_measured_call, args=(queue, func, kwargs))
+    process.start()
+    output = queue.get()
+    process.join()
+    duration = time.perf_counter() - start
+    if "error" in output:
+        raise RuntimeError(f"{func.__name__} failed: {output['error']}")
+    measures = {
+        "duration": duration,
+        "cpu_seconds": output["cpu_seconds"],
+        "cpu_utilization": output["cpu_seconds"] / duration,
+        "peak_rss_mb": output["peak_rss_mb"],
+    }
+    return output["result"], measures
+
+
+def read_stats(output_folder):
+    """Sum the shard stats of an output folder"""
+    totals = {"count": 0, "successes": 0, "failed_to_download": 0, "bytes_downloaded": 0}
+    for name in os.listdir(output_folder):
+        if name.endswith("_stats.json"):
+            with open(os.path.join(output_folder, name), encoding="utf-8") as f:
+                stats = json.load(f)
+            for k in totals:
+                totals[k] += stats[k]
+    return totals
+
+
+def _run_urls2dataset(**kwargs):
+    from urls2dataset import urls2dataset  # pylint: disable=import-outside-toplevel
+
+    urls2dataset(**kwargs)
+    return read_stats(kwargs["output_folder"])
+
+
+def run_config(url_list, output_folder, input_format="txt", **kwargs):
+    """Run urls2dataset in a fresh process, return its stats, throughput, cpu time and peak rss"""
+    stats, measures = run_measured(
+        _run_urls2dataset,
+        url_list=url_list,
+        input_format=input_format,
+        output_folder=output_folder,
+        incremental_mode="overwrite",
+        write_index=False,
+        **kwargs,
+    )
+    return {
+        **stats,
+        **measures,
+        "pages_per_sec": stats["count"] / measures["duration"],
+        "mb_per_sec": stats["bytes_downloaded"] / measures["duration"] / 1024**2,
+    }
+
+
+def environment():
+    """Where and on what code a benchmark ran"""
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "HEAD"], text=True, stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {"time": time.time(), "commit": commit, "python": platform.python_version(), "cpu_count": os.cpu_count()}
+
+
+def record_result(results_file, result):
+    if results_file is not None:
+        with open(results_file, "a", encoding="utf-8") as f:
+            f.write(json.dumps(result) + "\n")
+
+
+def benchmark(
+    pages=2000,
+    processes=(1, 2),
+    threads=(16, 64),
+    distributors=("multiprocessing",),
+    number_sample_per_shard=500,
+    output_format="parquet",
+    page_size=20000,
+    latency_median=0.02,
+    latency_sigma=0.5,
+    error_rate=0.01,
+    media_density=1.0,
+    hosts=4,
+    config=None,
+    results_file="benchmark_results.jsonl",
+):
+    """Crawl a synthetic site with every combination of processes, threads and distributors
+
+    One json line per run is appended to results_file with the settings, the environment and the measures
+    """
+    site_settings = {
+        "page_size": page_size,
+        "latency_median": latency_median,
+        "latency_sigma": latency_sigma,
+        "error_rate": error_rate,
+        "media_density": media_density,
+        "hosts": hosts,
+    }
+    results = []
+    with SyntheticSite(**site_settings) as site, tempfile.TemporaryDirectory() as tmp_dir:
+        url_list = os.path.join(tmp_dir, "urls.txt")
+        with open(url_list, "w", encoding="utf-8") as f:
+            f.write("\n".join(site.urls(pages)))
+        for processes_count, thread_count, distributor in itertools.product(processes, threads, distributors):
+            settings = {
+                "processes_count": processes_count,
+                "thread_count": thread_count,
+                "distributor": distributor,
+                "number_sample_per_shard": number_sample_per_shard,
+                "output_format": output_format,
+                "config": config or {},
+            }
+            measures = run_config(url_list, os.path.join(tmp_dir, "output"), **settings)
+            result = {
+                **environment(),
+                "pages": pages,
+                **site_settings,
+                **settings,
+                **measures,
+            }
+            print(
+                f"processes {processes_count} threads {thread_count} {distributor}: "
+                f"{result['pages_per_sec']:.1f} pages/s, {result['mb_per_sec']:.2f} MB/s, "
+                f"cpu {result['cpu_utilization']:.2f}, peak rss {result['peak_rss_mb']:.0f} MB"
+            )
+            results.append(result)
+            record_result(results_file, result)
+    return results
+
+
+def main():
+    import fire  # pylint: disable=import-outside-toplevel
+
+    fire.Fire(benchmark)
+
+
+if __name__ == "__main__":
+    main()
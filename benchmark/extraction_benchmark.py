@@ -0,0 +1,155 @@
+"""extraction_benchmark times the cpu bound functions of data_reader on the pages of benchmark/corpus
+
+python -m benchmark.extraction_benchmark --rounds 50 --functions "[parser_bytes,extract_plain_text]"
+
+Like pytest-benchmark, each function runs a number of rounds after a warmup and min/mean/median/stddev are reported.
+Allocations are measured with tracemalloc in a separate round so that tracing doesn't slow the timed rounds,
+tracemalloc only sees python allocations, not the ones made inside resiliparse.
+"""
+
+import os
+import statistics
+import time
+import tracemalloc
+
+from .corpus.make_corpus import CORPUS_DIR
+from .crawl_benchmark import environment, record_result
+
+URL = "http://example.com/page.html"
+
+
+def load_corpus(corpus_dir=CORPUS_DIR):
+    """Dict of page name to html bytes"""
+    return {
+        name: open(os.path.join(corpus_dir, name), "rb").read()  # pylint: disable=consider-using-with
+        for name in sorted(os.listdir(corpus_dir))
+        if name.endswith(".html")
+    }
+
+
+def benchmark_cases(html_bytes):
+    """Dict of function name to (setup, func), setup runs untimed before each round and returns the args of func"""
+    # pylint: disable=import-outside-toplevel
+    from resiliparse.extract.html2text import extract_plain_text
+    from resiliparse.parse import bytes_to_str, detect_encoding
+    from resiliparse.parse.html import HTMLTree
+
+    from urls2dataset.data_reader import parser_bytes
+    from urls2dataset.encoding import decode_html
+
+    encoding = detect_encoding(html_bytes)
+    html = bytes_to_str(html_bytes, encoding)
+
+    def parsed_tree():
+        return (HTMLTree.parse_from_bytes(html_bytes, encoding),)
+
+    def media_tree():
+        return (parser_bytes(URL, HTMLTree.parse_from_bytes(html_bytes, encoding))[0],)
+
+    def extract_media_struct(tree):
+        return extract_plain_text(
+            tree,
+            preserve_formatting=False,
+            main_content=False,
+            list_bullets=False,
+            alt_texts=True,
+            links=False,
+            form_fields=False,
+            noscript=False,
+        )
+
+    def lang_detect(text):
+        from ftlangdetect import detect
+
+        return detect(text[:100], low_memory=True)
+
+    return {
+        "detect_encoding": (lambda: (html_bytes,), detect_encoding),
+        "bytes_to_str": (lambda: (html_bytes, encoding), bytes_to_str),
+        "decode_html": (lambda: (html_bytes,), decode_html),
+        "parse": (lambda: (html_bytes, encoding), HTMLTree.parse_from_bytes),
+        "parser_bytes": (lambda: (URL, parsed_tree()[0]), parser_bytes),
+        "extract_plain_text": (lambda: (html,), extract_plain_text),
+        "extract_plain_text_media_struct": (media_tree, extract_media_struct),
+        "lang_detect": (lambda: (extract_plain_text(html).replace("\n", " "),), lang_detect),
+    }
+
+
+def measure(setup, func, rounds=20, warmup=1):
+    """Timings of rounds calls of func(*setup()) and the python memory they allocate"""
+    for _ in range(warmup):
+        func(*setup())
+    timings = []
+    for _ in range(rounds):
+        args = setup()
+        start = time.perf_counter()
+        func(*args)
+        timings.append(time.perf_counter() - start)
+
+    args = setup()
+    tracemalloc.start()
+    try:
+        before, _ = tracemalloc.get_traced_memory()
+        result = func(*args)
+        after, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    del result
+    return {
+        "rounds": rounds,
+        "min": min(timings),
+        "mean": statistics.mean(timings),
+        "median": statistics.median(timings),
+        "stddev": statistics.stdev(timings) if rounds > 1 else 0.0,
+        "peak_alloc_bytes": peak - before,
+        "retained_bytes": after - before,
+    }
+
+
+def benchmark(
+    functions=None, pages=None, rounds=20, warmup=1, corpus_dir=CORPUS_DIR, results_file="benchmark_results.jsonl"
+):
+    """Measure every function on every page of the corpus, return and optionally record one result per pair
+
+    A function that can't run here (e.g. the language detection model can't be downloaded) is skipped with a message
+    """
+    corpus = load_corpus(corpus_dir)
+    results = []
+    skipped = set()
+    for page, html_bytes in corpus.items():
+        if pages is not None and page not in pages:
+            continue
+        for function, (setup, func) in benchmark_cases(html_bytes).items():
+            if (functions is not None and function not in functions) or function in skipped:
+                continue
+            try:
+                measures = measure(setup, func, rounds, warmup)
+            except Exception as err:  # pylint: disable=broad-except
+                print(f"skipping {function}: {err}")
+                skipped.add(function)
+                continue
+            result = {
+                **environment(),
+                "benchmark": "extraction",
+                "function": function,
+                "page": page,
+                "page_bytes": len(html_bytes),
+                **measures,
+            }
+            print(
+                f"{function:<32} {page:<24} median {measures['median'] * 1000:9.3f} ms "
+                f"stddev {measures['stddev'] * 1000:8.3f} ms peak alloc {measures['peak_alloc_bytes'] / 1024:9.1f} KB"
+            )
+            results.append(result)
+            record_result(results_file, result)
+    return results
+
+
+def main():
+    import fire  # pylint: disable=import-outside-toplevel
+
+    fire.Fire(benchmark)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""startup_benchmark measures how long the download processes take from their start to their first fetch
+
+Processes are replaced after 5 shards, each new process reports the startup_latency of its first shard
+
+python -m benchmark.startup_benchmark --processes 4 --start_methods "[spawn,forkserver]"
+"""
+
+import json
+import os
+import statistics
+import tempfile
+
+from .crawl_benchmark import environment, record_result, run_measured
+from .synthetic_site import SyntheticSite
+
+
+def read_startup_latencies(output_folder):
+    """Startup latencies of the shards that were the first of their process"""
+    latencies = []
+    for name in os.listdir(output_folder):
+        if name.endswith("_stats.json"):
+            with open(os.path.join(output_folder, name), encoding="utf-8") as f:
+                stats = json.load(f)
+            if "startup_latency" in stats:
+                latencies.append(stats["startup_latency"])
+    return latencies
+
+
+def _run_urls2dataset(**kwargs):
+    from urls2dataset import urls2dataset  # pylint: disable=import-outside-toplevel
+
+    urls2dataset(**kwargs)
+    return read_startup_latencies(kwargs["output_folder"])
+
+
+def benchmark(
+    pages=2000,
+    processes=4,
+    thread_count=16,
+    number_sample_per_shard=100,
+    start_methods=("spawn", "forkserver"),
+    results_file="benchmark_results.jsonl",
+):
+    """Crawl a synthetic site with each start method, record the startup latencies of the download processes"""
+    results = []
+    with SyntheticSite(page_size=2000, latency_median=0.001) as site, tempfile.TemporaryDirectory() as tmp_dir:
+        url_list = os.path.join(tmp_dir, "urls.txt")
+        with open(url_list, "w", encoding="utf-8") as f:
+            f.write("\n".join(site.urls(pages)))
+        for start_method in start_methods:
+            latencies, measures = run_measured(
+                _run_urls2dataset,
+                url_list=url_list,
+                input_format="txt",
+                output_format="parquet",
+                output_folder=os.path.join(tmp_dir, "output"),
+                incremental_mode="overwrite",
+                write_index=False,
+                processes_count=processes,
+                thread_count=thread_count,
+                number_sample_per_shard=number_sample_per_shard,
+                start_method=start_method,
+            )
+            result = {
+                **environment(),
+                "benchmark": "startup",
+                "pages": pages,
+                "processes_count": processes,
+                "number_sample_per_shard": number_sample_per_shard,
+                "start_method": start_method,
+                "started_processes": len(latencies),
+                "startup_latency_median": statistics.median(latencies),
+                "startup_latency_max": max(latencies),
+                **measures,
+            }
+            print(
+                f"{start_method}: {len(latencies)} processes, startup latency median "
+                f"{result['startup_latency_median']:.3f}s max {result['startup_latency_max']:.3f}s, "
+                f"job {result['duration']:.1f}s"
+            )
+            results.append(result)
+            record_result(results_file, result)
+    return results
+
+
+def main():
+    import fire  # pylint: disable=import-outside-toplevel
+
+    fire.Fire(benchmark)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+"""synthetic_site serves generated html pages locally so that crawls can be benchmarked without the network"""
+
+import http.server
+import math
+import random
+import threading
+import time
+
+WORDS = "the of and to in is was for on that with as by at from his her it an were are which this be or".split()
+MEDIA = [
+    '<img src="/media/{i}.jpg" alt="image {i}">',
+    '<video><source src="/media/{i}.mp4"></video>',
+    '<audio src="/media/{i}.mp3"></audio>',
+    '<iframe src="/embed/{i}.html"></iframe>',
+]
+
+
+def generate_page(path, page_size=20000, media_density=1.0, seed=0):
+    """Html page of about page_size bytes with media_density media elements per KB, the same for a given path"""
+    rng = random.Random(f"{seed}-{path}")
+    media_count = int(media_density * page_size / 1024)
+    parts = [f'<html lang="en"><head><title>page {path}</title></head><body><nav><a href="/">home</a></nav>']
+    size = len(parts[0])
+    i = 0
+    while size < page_size:
+        paragraph = "<p>" + " ".join(rng.choice(WORDS) for _ in range(rng.randint(20, 80))) + "</p>"
+        if i < media_count:
+            paragraph += rng.choice(MEDIA).format(i=i)
+        parts.append(paragraph)
+        size += len(paragraph)
+        i += 1
+    for j in range(i, media_count):
+        parts.append(rng.choice(MEDIA).format(i=j))
+    parts.append("</body></html>")
+    return "".join(parts).encode("utf-8")
+
+
+class SyntheticHandler(http.server.BaseHTTPRequestHandler):
+    """Serve the page of a path after a lognormal latency, or an error with probability error_rate"""
+
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        site = self.server.site
+        rng = random.Random(f"{site.seed}-{self.path}-request")
+        if site.latency_median > 0:
+            time.sleep(rng.lognormvariate(math.log(site.latency_median), site.latency_sigma))
+        if rng.random() < site.error_rate:
+            self.send_error(rng.choice([404, 500, 503]))
+            return
+        body = generate_page(self.path, site.page_size, site.media_density, site.seed)
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        pass
+
+
+class SyntheticSite:
+    """Local http servers for hosts distinct hosts
+
+    Hosts are the loopback addresses 127.0.0.1, 127.0.0.2, ... so that clients see distinct hosts
+    (connection pools, per host limits) without a resolver, loopback addresses other than 127.0.0.1 need linux.
+    """
+
+    def __init__(
+        self, page_size=20000, latency_median=0.0, latency_sigma=0.5, error_rate=0.0, media_density=1.0, hosts=1, seed=0
+    ):
+        self.page_size = page_size
+        self.latency_median = latency_median
+        self.latency_sigma = latency_sigma
+        self.error_rate = error_rate
+        self.media_density = media_density
+        self.hosts = hosts
+        self.seed = seed
+        self.servers = []
+
+    def start(self):
+        for i in range(self.hosts):
+            server = http.server.ThreadingHTTPServer((f"127.0.0.{i + 1}", 0), SyntheticHandler)
+            server.daemon_threads = True
+            server.site = self
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            self.servers.append(server)
+        return self
+
+    def stop(self):
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+        self.servers = []
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def urls(self, count):
+        """count page urls spread round robin over the hosts"""
+        urls = []
+        for i in range(count):
+            host, port = self.servers[i % len(self.servers)].server_address[:2]
+            urls.append(f"http://{host}:{port}/page/{i}.html")
+        return urls
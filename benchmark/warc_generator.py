@@ -0,0 +1,103 @@
+"""warc_generator writes gzipped WARC files that look like Common Crawl ones, to run the cc path offline
+
+python -m benchmark.warc_generator output.warc.gz --records 10000
+"""
+
+import gzip
+import random
+import uuid
+from datetime import datetime, timezone
+
+import fsspec
+
+from .synthetic_site import generate_page
+
+# (charset, language, words) of the html pages, the words need the charset to be encoded
+ENCODINGS = [
+    ("utf-8", "en", "the of and to in is was for on that with as by at from".split()),
+    ("utf-8", "de", "der die und in den von zu das mit sich des auf für ist im dem nicht über".split()),
+    ("iso-8859-1", "fr", "le la les des est une pour qui dans à été très où même déjà français".split()),
+    ("windows-1251", "ru", "и в не на я быть он с что а по это она этот к но они мы".split()),
+    ("shift_jis", "ja", "日本 東京 大学 研究 情報 技術 世界 時間 新聞 経済 社会".split()),
+    ("gb2312", "zh", "中国 北京 大学 研究 信息 技术 世界 时间 新闻 经济 社会".split()),
+]
+# (content type, probability), non html records are skipped by the sharder but still have to be read
+CONTENT_TYPES = [("text/html", 0.8), ("application/pdf", 0.05), ("image/jpeg", 0.1), ("text/plain", 0.05)]
+
+
+def html_page(rng, url, page_size, media_density):
+    """Html page in a random charset, declared in the http header, in a meta tag or not at all"""
+    charset, language, words = rng.choice(ENCODINGS)
+    if language == "en":
+        body = generate_page(url, page_size, media_density, rng.random())
+    else:
+        paragraphs = []
+        size = 0
+        while size < page_size:
+            paragraphs.append("<p>" + " ".join(rng.choice(words) for _ in range(rng.randint(20, 80))) + "</p>")
+            size += len(paragraphs[-1].encode(charset))
+        meta = f'<meta charset="{charset}">' if rng.random() < 0.5 else ""
+        head = f"<head>{meta}<title>{rng.choice(words)}</title></head>"
+        page = f"<html lang=\"{language}\">{head}<body>{''.join(paragraphs)}</body></html>"
+        body = page.encode(charset)
+    declared = rng.random() < 0.7
+    return body, f"text/html; charset={charset}" if declared else "text/html"
+
+
+def warc_record(warc_type, url, content_type, payload, record_date):
+    headers = [
+        "WARC/1.0",
+        f"WARC-Type: {warc_type}",
+        f"WARC-Date: {record_date}",
+        f"WARC-Record-ID: <urn:uuid:{uuid.uuid4()}>",
+        f"Content-Type: {content_type}",
+        f"Content-Length: {len(payload)}",
+    ]
+    if url is not None:
+        headers.insert(2, f"WARC-Target-URI: {url}")
+    return "\r\n".join(headers).encode("utf-8") + b"\r\n\r\n" + payload + b"\r\n\r\n"
+
+
+def generate_warc(output_file, records=1000, median_page_size=20000, media_density=1.0, seed=0):
+    """Write records response records (with their request records) as a gzipped WARC, one gzip member per record
+
+    Page sizes follow a lognormal distribution around median_page_size, returns the number of html responses
+    """
+    rng = random.Random(seed)
+    record_date = datetime(2023, 1, 1, tzinfo=timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+    html_count = 0
+    with fsspec.open(output_file, "wb") as f:
+        info = b"software: urls2dataset benchmark\r\nformat: WARC File Format 1.0\r\n"
+        f.write(gzip.compress(warc_record("warcinfo", None, "application/warc-fields", info, record_date)))
+        for i in range(records):
+            url = f"http://host{rng.randint(0, 999)}.example.com/page/{i}.html"
+            request = f"GET /page/{i}.html HTTP/1.1\r\nHost: {url.split('/')[2]}\r\n\r\n".encode("utf-8")
+            f.write(
+                gzip.compress(warc_record("request", url, "application/http; msgtype=request", request, record_date))
+            )
+
+            content_type = rng.choices([c for c, _ in CONTENT_TYPES], [p for _, p in CONTENT_TYPES])[0]
+            page_size = max(200, int(rng.lognormvariate(0, 1) * median_page_size))
+            if content_type == "text/html":
+                body, content_type = html_page(rng, url, page_size, media_density)
+                html_count += 1
+            elif content_type == "text/plain":
+                body = " ".join(rng.choice(ENCODINGS[0][2]) for _ in range(page_size // 4)).encode("utf-8")
+            else:
+                body = rng.randbytes(page_size)
+            http_headers = f"HTTP/1.1 200 OK\r\nContent-Type: {content_type}\r\nContent-Length: {len(body)}\r\n\r\n"
+            payload = http_headers.encode("utf-8") + body
+            f.write(
+                gzip.compress(warc_record("response", url, "application/http; msgtype=response", payload, record_date))
+            )
+    return html_count
+
+
+def main():
+    import fire  # pylint: disable=import-outside-toplevel
+
+    fire.Fire(generate_warc)
+
+
+if __name__ == "__main__":
+    main()
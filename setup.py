@@ -15,7 +15,7 @@ if __name__ == "__main__":
 
     setup(
         name="python_template",
-        packages=find_packages(),
+        packages=find_packages(exclude=["benchmark*", "tests*"]),
         include_package_data=True,
         version="1.0.0",
         license="MIT",
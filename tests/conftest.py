@@ -0,0 +1,55 @@
+"""Fixtures shared by the tests"""
+
+import http.server
+import threading
+import time
+
+import pytest
+
+
+class SlowHandler(http.server.BaseHTTPRequestHandler):
+    """Serve a small page, slowly under /slow/, after a 503 under /flaky/, never under /unavailable/
+
+    robots.txt disallows /private/
+    """
+
+    def do_GET(self):
+        if self.path == "/robots.txt":
+            self.server.robots_requests += 1
+            body = b"User-agent: *\nDisallow: /private/\n"
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        if self.path.startswith("/slow/"):
+            time.sleep(0.1)
+        if self.path.startswith("/unavailable/") or (
+            self.path.startswith("/flaky/") and self.path not in self.server.failed_paths
+        ):
+            self.server.failed_paths.add(self.path)
+            self.send_response(503 if self.path.startswith("/flaky/") else 429)
+            self.send_header("Retry-After", "1" if self.path.startswith("/flaky/") else "0")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        body = f"<html><body><p>page {self.path}</p></body></html>".encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        pass
+
+
+@pytest.fixture
+def http_server():
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), SlowHandler)
+    server.failed_paths = set()
+    server.robots_requests = 0
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
@@ -0,0 +1,31 @@
+"""Helpers shared by the tests"""
+
+import random
+
+import pyarrow as pa
+
+
+def get_schema():
+    return pa.schema(
+        [
+            pa.field("url", pa.string()),
+            pa.field("key", pa.string()),
+            pa.field("status", pa.string()),
+            pa.field("error_message", pa.string()),
+            pa.field("language", pa.string()),
+        ]
+    )
+
+
+def write_samples(sample_writer, n, text_size=0):
+    for i in range(n):
+        key = f"{i:05d}"
+        meta = {
+            "url": f"http://example.com/{i}",
+            "media": {"language": "en"},
+            "key": key,
+            "status": "success",
+            "error_message": None,
+        }
+        # random hex so that the text doesn't compress away
+        sample_writer.write(f"text {i}" + random.Random(i).randbytes(text_size // 2).hex(), key, None, meta)
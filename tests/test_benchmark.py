@@ -0,0 +1,88 @@
+import json
+import requests
+
+from benchmark.cc_benchmark import benchmark as cc_benchmark
+from benchmark.crawl_benchmark import benchmark
+from benchmark.extraction_benchmark import benchmark as extraction_benchmark, load_corpus
+from benchmark.startup_benchmark import benchmark as startup_benchmark
+from benchmark.synthetic_site import SyntheticSite, generate_page
+
+
+def test_synthetic_site():
+    assert generate_page("/a", 10000, 2.0) == generate_page("/a", 10000, 2.0)
+    assert len(generate_page("/a", 10000, 2.0)) >= 10000
+    assert generate_page("/a", 10000, 2.0).count(b'src="/') >= 19
+
+    with SyntheticSite(page_size=1000, error_rate=0.5, hosts=2) as site:
+        urls = site.urls(40)
+        assert len(set(u.split("/")[2] for u in urls)) == 2
+        statuses = [requests.get(url, timeout=5).status_code for url in urls]
+    assert 0 < statuses.count(200) < 40
+
+
+def test_crawl_benchmark(tmp_path):
+    results_file = tmp_path / "results.jsonl"
+    results = benchmark(
+        pages=100,
+        processes=[1],
+        threads=[4, 8],
+        number_sample_per_shard=50,
+        page_size=2000,
+        latency_median=0.001,
+        results_file=str(results_file),
+    )
+    assert len(results) == 2
+    lines = [json.loads(line) for line in results_file.read_text().splitlines()]
+    assert [line["thread_count"] for line in lines] == [4, 8]
+    for line in lines:
+        assert line["count"] == 100
+        assert line["pages_per_sec"] > 0
+        assert line["peak_rss_mb"] > 0
+
+
+def test_cc_benchmark(tmp_path):
+    results_file = tmp_path / "results.jsonl"
+    results = cc_benchmark(
+        records=200,
+        median_page_size=3000,
+        processes=[1],
+        threads=[4],
+        number_sample_per_shard=100,
+        # generated pages have a lang attribute, no language detection model is needed
+        config={"media_elems": True},
+        results_file=str(results_file),
+    )
+    assert [r["benchmark"] for r in results] == ["cc_sharding", "cc_extraction", "cc_end_to_end"]
+    sharding, extraction, end_to_end = results
+    # about 80% of the records are html pages
+    assert 100 < sharding["docs"] < 200
+    assert extraction["docs"] == sharding["docs"]
+    assert extraction["errors"] == 0
+    assert end_to_end["count"] == sharding["docs"]
+    assert end_to_end["successes"] == sharding["docs"]
+    assert len(results_file.read_text().splitlines()) == 3
+
+
+def test_extraction_benchmark(tmp_path):
+    results_file = tmp_path / "results.jsonl"
+    functions = ["detect_encoding", "decode_html", "parse", "parser_bytes", "extract_plain_text"]
+    results = extraction_benchmark(functions=functions, rounds=2, warmup=0, results_file=str(results_file))
+    pages = load_corpus()
+    assert len(pages) >= 10
+    assert {(r["function"], r["page"]) for r in results} == {(f, p) for f in functions for p in pages}
+    for result in results:
+        assert 0 < result["min"] <= result["median"]
+        assert result["peak_alloc_bytes"] >= 0
+    assert len(results_file.read_text().splitlines()) == len(results)
+
+
+def test_startup_benchmark(tmp_path):
+    results_file = tmp_path / "results.jsonl"
+    results = startup_benchmark(
+        pages=100, processes=1, number_sample_per_shard=50, thread_count=4, results_file=str(results_file)
+    )
+    assert [r["start_method"] for r in results] == ["spawn", "forkserver"]
+    for result in results:
+        assert result["started_processes"] == 1
+        assert 0 < result["startup_latency_median"] <= result["startup_latency_max"]
+    assert len(results_file.read_text().splitlines()) == 2
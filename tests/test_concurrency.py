@@ -0,0 +1,90 @@
+import threading
+
+import pytest
+
+from urls2dataset import concurrency
+from urls2dataset.concurrency import AIMDConcurrency, ConcurrencyLimiter
+
+
+class FakeClock:
+    def __init__(self):
+        self.wall = 0.0
+        self.cpu = 0.0
+
+    def run(self, controller, seconds, samples, errors=0, cpu=0.1):
+        """Finish samples samples over seconds, using cpu of a core"""
+        wall, cpu_time = self.wall, self.cpu
+        for i in range(samples):
+            self.wall = wall + seconds * (i + 1) / samples
+            self.cpu = cpu_time + cpu * seconds * (i + 1) / samples
+            controller.record(i < errors)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(concurrency.time, "perf_counter", lambda: clock.wall)
+    monkeypatch.setattr(concurrency.time, "process_time", lambda: clock.cpu)
+    return clock
+
+
+def test_aimd_concurrency(clock):
+    controller = AIMDConcurrency(4, 2, 6, interval=1.0)
+    # fetches keep up, additive increase up to the max
+    for _ in range(3):
+        clock.run(controller, 1.0, 100)
+    assert controller.limit == 6
+    # cpu bound, multiplicative decrease
+    clock.run(controller, 1.0, 100, cpu=0.95)
+    assert controller.limit == 3
+    clock.run(controller, 1.0, 100)
+    assert controller.limit == 4
+    # raising the concurrency made the throughput collapse
+    clock.run(controller, 1.0, 50)
+    assert controller.limit == 2
+    # timeouts appear, the min bound holds
+    clock.run(controller, 1.0, 100)
+    clock.run(controller, 1.0, 100, errors=50)
+    assert controller.limit == 2
+    # a constant error rate (dead urls) isn't congestion
+    clock.run(controller, 1.0, 100, errors=50)
+    assert controller.limit == 3
+
+    trajectory = controller.trajectory()
+    assert [p["concurrency"] for p in trajectory] == [4, 5, 6, 6, 3, 4, 2, 3, 2, 3]
+    assert trajectory[4]["cpu"] == pytest.approx(0.95)
+    assert trajectory[-1]["error_rate"] == pytest.approx(0.5)
+
+
+def test_limiter_close_unblocks():
+    limiter = ConcurrencyLimiter(1)
+    assert limiter.acquire()
+    results = []
+    thread = threading.Thread(target=lambda: results.append(limiter.acquire()))
+    thread.start()
+    limiter.set_limit(2)
+    thread.join()
+    thread = threading.Thread(target=lambda: results.append(limiter.acquire()))
+    thread.start()
+    limiter.close()
+    thread.join()
+    assert results == [True, False]
+
+
+def test_limiter_byte_budget():
+    limiter = ConcurrencyLimiter(4, max_bytes=100)
+    assert limiter.acquire() and limiter.acquire()
+    limiter.add_bytes(60)
+    limiter.add_bytes(60)
+    results = []
+    thread = threading.Thread(target=lambda: results.append(limiter.acquire()))
+    thread.start()
+    thread.join(0.1)
+    # blocked by the bytes, not by the count
+    assert thread.is_alive()
+    limiter.release(60)
+    thread.join()
+    assert results == [True]
+    limiter.add_bytes(30)
+    assert limiter.peak_bytes == 120
+    assert limiter.in_flight_bytes == 90
@@ -0,0 +1,173 @@
+import pytest
+import json
+import os
+import tarfile
+from functools import partial
+import fsspec
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from urls2dataset.data_writer import (
+    ArrowSampleWriter,
+    FilesSampleWriter,
+    JsonlZstSampleWriter,
+    ParquetSampleWriter,
+    RollingSampleWriter,
+    ThreadedSampleWriter,
+    WebDatasetSampleWriter,
+)
+
+from helpers import get_schema, write_samples
+
+
+@pytest.mark.parametrize("output_folder", ["local", "memory://threaded_writer"])
+def test_threaded_parquet_writer(output_folder, tmp_path):
+    if output_folder == "local":
+        output_folder = str(tmp_path)
+    sample_writer = ThreadedSampleWriter(
+        ParquetSampleWriter(0, output_folder, False, 5, get_schema(), block_size=5 * 1024**2),
+        queue_size=2,
+    )
+    write_samples(sample_writer, 250)
+    sample_writer.close()
+
+    assert sample_writer.blocked_time >= 0
+    fs, output_path = fsspec.core.url_to_fs(output_folder)
+    with fs.open(f"{output_path}/00000.parquet", "rb") as f:
+        table = pq.read_table(f)
+    assert table.num_rows == 250
+    assert sorted(table["key"].to_pylist()) == [f"{i:05d}" for i in range(250)]
+    assert table["url"][0].as_py() == "http://example.com/0"
+
+
+@pytest.mark.parametrize("compression", [None, "zstd"])
+@pytest.mark.parametrize("save_parquet_meta", [True, False])
+def test_webdataset_writer(compression, save_parquet_meta, tmp_path):
+    output_folder = str(tmp_path)
+    sample_writer = WebDatasetSampleWriter(
+        0, output_folder, True, 5, get_schema(), compression=compression, save_parquet_meta=save_parquet_meta
+    )
+    write_samples(sample_writer, 10)
+    sample_writer.close()
+
+    suffix = "" if compression is None else ".zst"
+    with tarfile.open(f"{output_folder}/00000.tar") as tar:
+        names = tar.getnames()
+        meta = tar.extractfile(f"00003.json{suffix}").read()
+        text = tar.extractfile(f"00003.txt{suffix}").read()
+    assert len(names) == 30
+    assert f"00003.caption.txt{suffix}" in names
+    if compression is not None:
+        meta = pa.CompressedInputStream(pa.BufferReader(meta), compression).read()
+        text = pa.CompressedInputStream(pa.BufferReader(text), compression).read()
+    assert text.decode("utf-8") == "text 3"
+    assert json.loads(meta)["url"] == "http://example.com/3"
+    assert b"\n" not in meta
+
+    if save_parquet_meta:
+        table = pq.read_table(f"{output_folder}/00000.parquet")
+        assert table.num_rows == 10
+        assert table["language"][0].as_py() == "en"
+    else:
+        assert not (tmp_path / "00000.parquet").exists()
+
+
+@pytest.mark.parametrize("sample_writer_class", [ParquetSampleWriter, WebDatasetSampleWriter])
+def test_rolling_writer(sample_writer_class, tmp_path):
+    output_folder = str(tmp_path)
+    sample_writer_class = partial(sample_writer_class, write_index=True)
+    sample_writer = RollingSampleWriter(sample_writer_class, 64 * 1024, 7, output_folder, False, 5, get_schema())
+    write_samples(sample_writer, 400, text_size=1000)
+    sample_writer.close()
+
+    extension = "parquet" if sample_writer_class.func is ParquetSampleWriter else "tar"
+    files = sorted(f for f in os.listdir(output_folder) if f.endswith(extension))
+    assert sample_writer.parts > 1
+    assert files == [f"00007_{part:04d}.{extension}" for part in range(sample_writer.parts)]
+    # every part but the last one reaches the target size
+    for f in files[:-1]:
+        assert os.path.getsize(f"{output_folder}/{f}") >= 64 * 1024
+    keys = pq.read_table(f"{output_folder}/_index/shards").column("key").to_pylist()
+    assert sorted(keys) == [f"{i:05d}" for i in range(400)]
+
+
+@pytest.mark.parametrize("compression", [None, "zstd"])
+def test_arrow_writer(compression, tmp_path):
+    output_folder = str(tmp_path)
+    sample_writer = ArrowSampleWriter(0, output_folder, False, 5, get_schema(), compression=compression)
+    write_samples(sample_writer, 250)
+    sample_writer.close()
+
+    with pa.memory_map(f"{output_folder}/00000.arrow") as source:
+        table = pa.ipc.open_stream(source).read_all()
+    assert table.num_rows == 250
+    assert table["text"][42].as_py() == "text 42"
+    assert table["language"][0].as_py() == "en"
+
+
+def test_jsonl_zst_writer(tmp_path):
+    output_folder = str(tmp_path)
+    sample_writer = JsonlZstSampleWriter(0, output_folder, True, 5, get_schema())
+    write_samples(sample_writer, 50)
+    sample_writer.close()
+
+    with pa.CompressedInputStream(pa.OSFile(f"{output_folder}/00000.jsonl.zst"), "zstd") as stream:
+        lines = stream.read().decode("utf-8").splitlines()
+    assert len(lines) == 50
+    sample = json.loads(lines[7])
+    assert sample["text"] == "text 7"
+    assert sample["url"] == "http://example.com/7"
+    assert sample["caption"] == ""
+
+
+def test_files_writer(tmp_path):
+    output_folder = str(tmp_path)
+    sample_writer = FilesSampleWriter(0, output_folder, False, 5, get_schema(), buffer_size=16)
+    write_samples(sample_writer, 50)
+    sample_writer.close()
+
+    files = os.listdir(f"{output_folder}/00000")
+    assert len(files) == 100
+    with open(f"{output_folder}/00000/00007.txt", encoding="utf-8") as f:
+        assert f.read() == "text 7"
+    with open(f"{output_folder}/00000/00007.json", encoding="utf-8") as f:
+        assert json.load(f)["url"] == "http://example.com/7"
+    assert pq.read_table(f"{output_folder}/00000.parquet").num_rows == 50
+
+
+class FailingWriter:
+    """Fail to write the samples of failing_keys, record the written keys"""
+
+    def __init__(self, failing_keys):
+        self.failing_keys = failing_keys
+        self.written = []
+        self.closed = False
+
+    def write(self, text, key, caption, meta):
+        if key in self.failing_keys:
+            raise ValueError(f"can't write {key}")
+        self.written.append(key)
+
+    def close(self):
+        self.closed = True
+
+
+def test_threaded_writer_failures():
+    sample_writer = ThreadedSampleWriter(FailingWriter({"00001", "00003"}))
+    write_samples(sample_writer, 5)
+    # a failed sample (no text) isn't a write failure of a downloaded sample
+    sample_writer.write({}, "00003", None, {})
+    sample_writer.close()
+    assert sample_writer.take_write_failures() == ["00001", "00003"]
+    assert sample_writer.take_write_failures() == []
+    assert sample_writer.sample_writer.written == ["00000", "00002", "00004"]
+    sample_writer.abort()
+
+
+def test_threaded_writer_abort():
+    sample_writer = ThreadedSampleWriter(FailingWriter(set()))
+    write_samples(sample_writer, 50)
+    sample_writer.abort()
+    assert not sample_writer.thread.is_alive()
+    assert sample_writer.sample_writer.closed
+    assert len(sample_writer.sample_writer.written) <= 50
@@ -0,0 +1,145 @@
+import pytest
+import json
+import os
+import shutil
+from functools import partial
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from urls2dataset import urls2dataset
+from urls2dataset.distributor import (
+    multiprocessing_distributor,
+    pyspark_distributor,
+    ray_distributor,
+    requeue_leased,
+    WorkStealingScheduler,
+)
+from urls2dataset.lease import LEASED, ShardLeases
+from urls2dataset.manifest import Manifest
+
+
+class FlakyWorker:
+    """Fails the first attempt of odd shards, marks done shards in a folder"""
+
+    def __init__(self, folder):
+        self.folder = folder
+
+    def __call__(self, row):
+        shard_id, _ = row
+        attempt_file = f"{self.folder}/{shard_id}.attempt"
+        if shard_id % 2 == 1 and not os.path.exists(attempt_file):
+            open(attempt_file, "w").close()
+            return (False, row)
+        open(f"{self.folder}/{shard_id}.done", "w").close()
+        return (True, row)
+
+
+@pytest.mark.parametrize("distributor", ["multiprocessing", "forkserver", "pyspark", "ray"])
+def test_distributor(distributor, tmp_path):
+    if distributor == "pyspark":
+        pytest.importorskip("pyspark")
+        if shutil.which("java") is None:
+            pytest.skip("pyspark needs java")
+        distributor_fn = pyspark_distributor
+    elif distributor == "ray":
+        ray = pytest.importorskip("ray")
+        ray.init(num_cpus=2, runtime_env={"env_vars": {"PYTHONPATH": os.path.dirname(__file__)}})
+        distributor_fn = ray_distributor
+    elif distributor == "forkserver":
+        distributor_fn = partial(multiprocessing_distributor, start_method="forkserver")
+    else:
+        distributor_fn = multiprocessing_distributor
+
+    shards = [(i, f"shard_{i}") for i in range(10)]
+    try:
+        distributor_fn(2, FlakyWorker(str(tmp_path)), shards, 4, 1)
+    finally:
+        if distributor == "ray":
+            ray.shutdown()
+
+    assert sorted(f for f in os.listdir(tmp_path) if f.endswith(".done")) == sorted(f"{i}.done" for i in range(10))
+
+
+def test_work_stealing_splits_straggler(http_server, tmp_path):
+    url_list = tmp_path / "urls.txt"
+    urls = [f"{http_server}/slow/{i}" for i in range(200)] + [f"{http_server}/fast/{i}" for i in range(400)]
+    url_list.write_text("\n".join(urls))
+    output_folder = str(tmp_path / "output")
+
+    urls2dataset(
+        url_list=str(url_list),
+        input_format="txt",
+        output_format="parquet",
+        output_folder=output_folder,
+        processes_count=2,
+        thread_count=2,
+        number_sample_per_shard=200,
+        distributor="work_stealing",
+    )
+
+    with open(f"{output_folder}/00000_stats.json", encoding="utf-8") as f:
+        stats = json.load(f)
+    assert stats["count"] == 200
+    assert stats["successes"] == 200
+    assert stats["split_count"] >= 2
+    files = [f for f in os.listdir(output_folder) if f.startswith("00000") and f.endswith(".parquet")]
+    assert len(files) == stats["split_count"]
+    tables = [pq.read_table(f"{output_folder}/{f}") for f in files]
+    assert len(set(pa.concat_tables(tables)["key"].to_pylist())) == 200
+    assert not any(f.endswith("_stats.json") for f in os.listdir(f"{output_folder}/_tmp"))
+    assert Manifest(output_folder, 5).done_shards() == {0, 1, 2}
+
+
+class LeasedWorker:
+    """Shards are leased by another worker during their first two runs"""
+
+    def __init__(self):
+        self.shard_leases = ShardLeases("unused", 5, ttl=0.1)
+        self.runs = {}
+
+    def __call__(self, row):
+        self.runs[row] = self.runs.get(row, 0) + 1
+        return (LEASED if self.runs[row] <= 2 else True, row)
+
+
+def test_requeue_leased():
+    worker = LeasedWorker()
+    leased_shards = []
+
+    def run(gen):
+        for row in gen:
+            status, _ = worker(row)
+            if status == LEASED:
+                leased_shards.append(row)
+        return []
+
+    run([(0, "shard_0"), (1, "shard_1")])
+    requeue_leased(run, leased_shards, worker, 1)
+    assert worker.runs == {(0, "shard_0"): 3, (1, "shard_1"): 3}
+    assert leased_shards == []
+
+
+def test_remove_failed_splits(tmp_path):
+    worker = FlakyWorker(str(tmp_path))
+    worker.output_folder = str(tmp_path)
+    worker.oom_shard_count = 5
+    scheduler = WorkStealingScheduler(None, 2, worker, None, 100, 0.5)
+    # shard 0 failed after being split in 2, shard 1 was split and merged
+    scheduler.split_counts = {0: 2, 1: 2}
+    scheduler.pending_pieces = {0: None, 1: 0}
+    kept = ["00000.parquet", "00001_split01.parquet", "_tmp/00000.json"]
+    removed = [
+        "00000_split01.parquet",
+        "00000_split02_0000.parquet",
+        "_index/shards/00000_split01.parquet",
+        "_tmp/00000_split00_stats.json",
+        "_tmp/00000_split02_stats.json",
+        "_tmp/checkpoints/00000_split01.json",
+    ]
+    for name in kept + removed:
+        (tmp_path / name).parent.mkdir(parents=True, exist_ok=True)
+        (tmp_path / name).write_text("")
+
+    scheduler.remove_failed_splits()
+    assert all((tmp_path / name).exists() for name in kept)
+    assert not any((tmp_path / name).exists() for name in removed)
@@ -0,0 +1,266 @@
+import pytest
+import json
+import os
+import socket
+from functools import partial
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from urls2dataset.data_writer import ParquetSampleWriter, RollingSampleWriter
+from urls2dataset.download_worker import DownloadWorker, compute_key
+from urls2dataset.lease import LEASED, ShardLeases
+from urls2dataset.profiler import merge_profiles
+from urls2dataset.robots import RobotsCache
+
+
+class FailingParquetWriter(ParquetSampleWriter):
+    """Fail to write every 5th downloaded sample"""
+
+    def write(self, text, key, caption, meta):
+        if isinstance(text, str) and int(key) % 5 == 0:
+            raise OSError("disk full")
+        super().write(text, key, caption, meta)
+
+
+class CrashingReader:
+    """Wrap a data reader, count the calls and crash after max_calls of them"""
+
+    def __init__(self, data_reader, max_calls=None):
+        self.data_reader = data_reader
+        self.max_calls = max_calls
+        self.calls = 0
+
+    def __call__(self, row, timer=None):
+        self.calls += 1
+        if self.max_calls is not None and self.calls > self.max_calls:
+            raise RuntimeError("worker crashed")
+        return self.data_reader(row, timer)
+
+
+def get_worker(output_folder, checkpoint_interval=None, sample_writer_class=None, **kwargs):
+    return DownloadWorker(
+        sample_writer_class=sample_writer_class or partial(RollingSampleWriter, ParquetSampleWriter, None),
+        save_caption=False,
+        output_folder=output_folder,
+        column_list=["url"],
+        thread_count=4,
+        timeout=3,
+        number_sample_per_shard=200,
+        oom_shard_count=5,
+        tmp_dir="/tmp",
+        config={},
+        postprocess_func=None,
+        common_crawl=False,
+        filters_config=[],
+        clean_text=False,
+        checkpoint_interval=checkpoint_interval,
+        **kwargs,
+    )
+
+
+def make_shard(folder, shard_id, urls):
+    """Write the input shard of urls to {folder}/_tmp, return its file"""
+    shard_file = f"{folder}/_tmp/{shard_id}_shard.feather"
+    os.makedirs(f"{folder}/_tmp", exist_ok=True)
+    table = pa.table({"url": urls})
+    with pa.OSFile(shard_file, "wb") as f:
+        with pa.ipc.new_file(f, table.schema) as writer:
+            writer.write_table(table)
+    return shard_file
+
+
+def read_stats(folder, shard_id):
+    with open(f"{folder}/{shard_id:05d}_stats.json", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def test_resume_from_checkpoint(http_server, tmp_path):
+    output_folder = str(tmp_path)
+    shard_file = make_shard(output_folder, 0, [f"{http_server}/fast/{i}" for i in range(200)])
+
+    worker = get_worker(output_folder, 50)
+    worker.data_reader = CrashingReader(worker.data_reader, max_calls=120)
+    with pytest.raises(RuntimeError):
+        worker.download_shard((0, shard_file))
+    with open(f"{output_folder}/_tmp/checkpoints/00000.json", encoding="utf-8") as f:
+        checkpoint = json.load(f)
+    assert len(checkpoint["keys"]) >= 50
+    assert checkpoint["parts"] == len(checkpoint["keys"]) // 50
+
+    worker = get_worker(output_folder, 50)
+    worker.data_reader = CrashingReader(worker.data_reader)
+    worker.download_shard((0, shard_file))
+    assert worker.data_reader.calls == 200 - len(checkpoint["keys"])
+
+    stats = read_stats(output_folder, 0)
+    assert stats["count"] == 200
+    assert stats["successes"] == 200
+    assert stats["resumed_samples"] == len(checkpoint["keys"])
+    assert stats["stage_timings"]["network"]["count"] == 200 - len(checkpoint["keys"])
+    assert stats["stage_timings"]["write"]["count"] == 200 - len(checkpoint["keys"])
+    files = sorted(f for f in os.listdir(output_folder) if f.endswith(".parquet"))
+    assert files == [f"00000_{part:04d}.parquet" for part in range(stats["output_parts"])]
+    keys = pa.concat_tables([pq.read_table(f"{output_folder}/{f}") for f in files])["key"].to_pylist()
+    assert sorted(keys) == [f"{i:08d}" for i in range(200)]
+    assert not os.path.exists(f"{output_folder}/_tmp/checkpoints/00000.json")
+
+
+def test_profile_shard(http_server, tmp_path):
+    output_folder = str(tmp_path)
+    shard_file = make_shard(output_folder, 3, [f"{http_server}/fast/{i}" for i in range(20)])
+
+    worker = get_worker(output_folder, profile=True, profile_fraction=1.0)
+    assert worker((3, shard_file)) == (True, (3, shard_file))
+    assert os.path.exists(f"{output_folder}/00003_profile.prof")
+
+    report = merge_profiles(output_folder, report_file=f"{output_folder}/report.txt")
+    assert "Merged profiles of 1 shards" in report
+    # fetch threads are profiled too
+    assert "data_reader.py" in report
+    assert os.path.exists(f"{output_folder}/_profile.prof")
+
+
+def test_adaptive_concurrency(http_server, tmp_path):
+    output_folder = str(tmp_path)
+    shard_file = make_shard(output_folder, 1, [f"{http_server}/fast/{i}" for i in range(100)])
+
+    worker = get_worker(output_folder, adaptive_concurrency=True, max_thread_count=8)
+    worker.download_shard((1, shard_file))
+    stats = read_stats(output_folder, 1)
+    assert stats["successes"] == 100
+    assert stats["concurrency_trajectory"][0] == {"time": 0.0, "concurrency": 4}
+    assert all(1 <= p["concurrency"] <= 8 for p in stats["concurrency_trajectory"])
+
+
+def test_retry_transient_failures(http_server, tmp_path):
+    output_folder = str(tmp_path)
+    urls = [
+        f"{http_server}/{path}/{i}" for path, n in [("fast", 20), ("flaky", 10), ("unavailable", 5)] for i in range(n)
+    ]
+    shard_file = make_shard(output_folder, 2, urls)
+
+    worker = get_worker(output_folder, retry_backoff=0.1)
+    worker.download_shard((2, shard_file))
+    stats = read_stats(output_folder, 2)
+    assert stats["count"] == 35
+    # flaky urls asked for a 1s wait with Retry-After
+    assert stats["duration"] >= 1
+    assert stats["successes"] == 30
+    assert stats["recovered_successes"] == 10
+    assert stats["failed_to_download"] == 5
+    assert stats["status_dict"]["response 429"] == 5
+    assert stats["retried_samples"] == 10 + 5 * 2
+    keys = pq.read_table(f"{output_folder}/00002_0000.parquet")["key"].to_pylist()
+    assert sorted(keys) == [f"{i:08d}" for i in range(2000, 2030)]
+
+
+def test_dead_host_short_circuited(http_server, tmp_path):
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        dead_port = s.getsockname()[1]
+    output_folder = str(tmp_path)
+    urls = [f"http://127.0.0.1:{dead_port}/{i}" for i in range(40)] + [f"{http_server}/fast/{i}" for i in range(10)]
+    shard_file = make_shard(output_folder, 4, urls)
+
+    worker = get_worker(output_folder)
+    worker.download_shard((4, shard_file))
+    stats = read_stats(output_folder, 4)
+    assert stats["successes"] == 10
+    assert stats["failed_to_download"] == 40
+    # the circuit opens after 5 failures, a few more fetches were already in flight
+    assert stats["short_circuited"] >= 40 - 5 - 2 * 4
+    assert stats["status_dict"]["host_unreachable"] == stats["short_circuited"]
+
+
+def test_robots_disallowed(http_server, tmp_path):
+    output_folder = str(tmp_path)
+    shard_file = make_shard(
+        output_folder, 5, [f"{http_server}/{path}/{i}" for path in ["fast", "private"] for i in range(10)]
+    )
+
+    worker = get_worker(output_folder, robots=RobotsCache(f"{output_folder}/_tmp/robots.sqlite"))
+    worker.download_shard((5, shard_file))
+    stats = read_stats(output_folder, 5)
+    assert stats["successes"] == 10
+    assert stats["disallowed_by_robots"] == 10
+    assert stats["status_dict"]["disallowed_by_robots"] == 10
+
+
+def test_memory_budget(http_server, tmp_path):
+    output_folder = str(tmp_path)
+    shard_file = make_shard(output_folder, 6, [f"{http_server}/fast/{i}" for i in range(50)])
+
+    # a page is about 15 bytes of text, the budget stops new fetches while 2 pages wait, the shard still completes
+    worker = get_worker(output_folder, max_buffered_bytes=30)
+    worker.download_shard((6, shard_file))
+    stats = read_stats(output_folder, 6)
+    assert stats["successes"] == 50
+    # fetches already started when the budget is reached still land
+    assert 0 < stats["peak_buffered_bytes"] < 30 + 2 * 4 * 20
+
+
+def test_leased_shard(http_server, tmp_path):
+    output_folder = str(tmp_path)
+    shard_file = make_shard(output_folder, 7, [f"{http_server}/fast/{i}" for i in range(20)])
+
+    worker = get_worker(output_folder, shard_leases=ShardLeases(output_folder, 5, ttl=60, settle_time=0))
+    other_lease = ShardLeases(output_folder, 5, ttl=60, settle_time=0).claim(7)
+    # the shard is run again later, its input is kept
+    assert worker((7, shard_file)) == (LEASED, (7, shard_file))
+    assert os.path.exists(shard_file)
+    other_lease.release()
+
+    lease = worker.shard_leases.claim(7)
+    lease.lost = True
+    with pytest.raises(RuntimeError, match="lease of shard 7 was lost"):
+        worker.download_shard((7, shard_file), lease=lease)
+    lease.release()
+    assert not os.path.exists(f"{output_folder}/00007_stats.json")
+
+    assert worker((7, shard_file)) == (True, (7, shard_file))
+    assert os.path.exists(f"{output_folder}/00007_stats.json")
+    assert not os.path.exists(shard_file)
+
+
+def test_write_failures(http_server, tmp_path):
+    output_folder = str(tmp_path)
+    shard_file = make_shard(output_folder, 8, [f"{http_server}/fast/{i}" for i in range(20)])
+
+    worker = get_worker(output_folder, sample_writer_class=FailingParquetWriter)
+    worker.download_shard((8, shard_file))
+    stats = read_stats(output_folder, 8)
+    assert stats["successes"] == 16
+    assert stats["failed_to_write"] == 4
+    assert stats["status_dict"] == {"success": 16, "failed_to_write": 4}
+    assert pq.read_table(f"{output_folder}/00008.parquet").num_rows == 16
+
+
+def test_split_shard(http_server, tmp_path):
+    output_folder = str(tmp_path)
+    shard_file = make_shard(output_folder, 9, [f"{http_server}/fast/{i}" for i in range(20)])
+
+    worker = get_worker(output_folder)
+    scratch_bytes = {"written": 0, "read": 0}
+    # the first 8 samples were dispatched before the split
+    split_rows = worker.split_shard(9, shard_file, list(range(8, 20)), 3, scratch_bytes)
+    assert [split_id for _, _, split_id in split_rows] == [1, 2, 3]
+    assert scratch_bytes["read"] == os.path.getsize(shard_file)
+    assert scratch_bytes["written"] == sum(os.path.getsize(split_file) for _, split_file, _ in split_rows)
+
+    for (shard_id, split_file, split_id), piece_keys in zip(split_rows, [range(8, 12), range(12, 16), range(16, 20)]):
+        with pa.OSFile(split_file, "rb") as f:
+            split_table = pa.ipc.open_file(f).read_all()
+        assert split_table["__key__"].to_pylist() == list(piece_keys)
+        assert split_table["url"].to_pylist() == [f"{http_server}/fast/{i}" for i in piece_keys]
+
+        worker.download_shard((shard_id, split_file, split_id))
+        table = pq.read_table(f"{output_folder}/00009_split{split_id:02d}_0000.parquet")
+        urls = {compute_key(i, 9, 3, 5): f"{http_server}/fast/{i}" for i in piece_keys}
+        assert sorted(table["key"].to_pylist()) == sorted(urls)
+        for key, url, text in zip(table["key"].to_pylist(), table["url"].to_pylist(), table["text"].to_pylist()):
+            assert url == urls[key]
+            assert url[len(http_server) :] in text
+        with open(f"{output_folder}/_tmp/00009_split{split_id:02d}_stats.json", encoding="utf-8") as f:
+            assert json.load(f)["successes"] == len(piece_keys)
+        # the piece removes its input once done
+        assert not os.path.exists(split_file)
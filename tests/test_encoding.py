@@ -0,0 +1,74 @@
+import http.server
+import threading
+
+import pytest
+
+from urls2dataset.data_reader import URLDownloader
+from urls2dataset.encoding import decode_html, header_charset
+
+RUSSIAN = "<html><body><p>" + "это текст на русском языке " * 20 + "</p></body></html>"
+
+
+@pytest.mark.parametrize(
+    "content_type, expected",
+    [
+        ("text/html; charset=UTF-8", "utf-8"),
+        ('text/html; charset="iso-8859-1"', "cp1252"),
+        ("text/html;charset=shift_jis; foo=bar", "shift_jis"),
+        ("text/html; charset=bogus", None),
+        ("text/html", None),
+        (None, None),
+    ],
+)
+def test_header_charset(content_type, expected):
+    assert header_charset(content_type) == expected
+
+
+@pytest.mark.parametrize(
+    "html, content_type, expected_encoding",
+    [
+        # the header wins over the meta tag
+        ('<meta charset="cp1251">' + RUSSIAN, "text/html; charset=windows-1251", "cp1251"),
+        ('<meta charset="windows-1251">' + RUSSIAN, "text/html", "cp1251"),
+        ('<meta http-equiv="Content-Type" content="text/html; charset=windows-1251">' + RUSSIAN, None, "cp1251"),
+        # an unknown declared charset falls back to the meta tag
+        ('<meta charset="windows-1251">' + RUSSIAN, "text/html; charset=bogus", "cp1251"),
+        (RUSSIAN, None, "cp1251"),
+    ],
+)
+def test_decode_html(html, content_type, expected_encoding):
+    text, encoding = decode_html(html.encode("windows-1251"), content_type)
+    assert encoding == expected_encoding
+    assert text == html
+
+
+def test_decode_html_wrong_charset():
+    # a page declared utf-8 that isn't decodes without raising
+    text, _ = decode_html(RUSSIAN.encode("windows-1251"), "text/html; charset=utf-8")
+    assert text.startswith("<html><body><p>")
+
+
+class Cp1251Handler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = RUSSIAN.encode("windows-1251")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        pass
+
+
+def test_url_downloader_non_utf8():
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Cp1251Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        text, _, error, _ = URLDownloader(3, host_failure_threshold=None)(
+            f"http://127.0.0.1:{server.server_address[1]}/"
+        )
+    finally:
+        server.shutdown()
+    assert error is None
+    assert "это текст на русском языке" in text
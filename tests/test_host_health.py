@@ -0,0 +1,52 @@
+import time
+
+import requests
+
+from urls2dataset import data_reader
+from urls2dataset.data_reader import URLDownloader
+from urls2dataset.host_health import HOST_UNREACHABLE, CircuitBreaker, host_breaker
+
+
+def test_circuit_breaker():
+    breaker = CircuitBreaker(failure_threshold=3, cooldown=0.2)
+    for _ in range(2):
+        assert breaker.allow("a")
+        breaker.failure("a")
+    # a success resets the count
+    breaker.success("a")
+    for _ in range(3):
+        assert breaker.allow("a")
+        breaker.failure("a")
+    assert not breaker.allow("a")
+    assert breaker.allow("b")
+
+    time.sleep(0.2)
+    # half open, one probe at a time, its failure opens the circuit again
+    assert breaker.allow("a")
+    assert not breaker.allow("a")
+    breaker.failure("a")
+    assert not breaker.allow("a")
+    time.sleep(0.2)
+    assert breaker.allow("a")
+    breaker.success("a")
+    assert breaker.allow("a") and breaker.allow("a")
+
+    assert host_breaker(3, 0.2) is host_breaker(3, 0.2)
+
+
+def test_probe_ends_on_any_error(monkeypatch):
+    def broken_get(*args, **kwargs):
+        raise requests.exceptions.ChunkedEncodingError("connection broken")
+
+    monkeypatch.setattr(data_reader.requests, "get", broken_get)
+    downloader = URLDownloader(timeout=1, host_failure_threshold=2, host_cooldown=0.2)
+    url = "http://broken.example/page"
+    for _ in range(2):
+        assert downloader(url)[2] == "connection broken"
+    assert downloader(url)[2] == HOST_UNREACHABLE
+    time.sleep(0.2)
+    # the failed probe opens the circuit again, the next probe goes through after the cooldown
+    assert downloader(url)[2] == "connection broken"
+    assert downloader(url)[2] == HOST_UNREACHABLE
+    time.sleep(0.2)
+    assert downloader(url)[2] == "connection broken"
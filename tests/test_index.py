@@ -0,0 +1,79 @@
+import pytest
+import json
+
+from urls2dataset.data_writer import (
+    ArrowSampleWriter,
+    FilesSampleWriter,
+    JsonlZstSampleWriter,
+    ParquetSampleWriter,
+    WebDatasetSampleWriter,
+)
+from urls2dataset.index import DatasetIndex, build_index
+
+from helpers import get_schema, write_samples
+
+
+@pytest.mark.parametrize(
+    "sample_writer_class",
+    [ParquetSampleWriter, WebDatasetSampleWriter, ArrowSampleWriter, JsonlZstSampleWriter, FilesSampleWriter],
+)
+def test_index_lookup(sample_writer_class, tmp_path):
+    output_folder = str(tmp_path)
+    for shard_id in range(3):
+        sample_writer = sample_writer_class(shard_id, output_folder, False, 5, get_schema(), write_index=True)
+        write_samples(sample_writer, 150)
+        sample_writer.close()
+
+    assert build_index(output_folder) == 450
+    index = DatasetIndex(output_folder)
+
+    entries = index.lookup(key="00042")
+    assert len(entries) == 3
+    assert {e["file"].split(".")[0].split("/")[0] for e in entries} == {"00000", "00001", "00002"}
+    assert len(index.lookup(url="http://example.com/149")) == 3
+    assert index.lookup(key="missing") == []
+
+    sample = index.read(index.lookup(key="00120")[0])
+    if sample_writer_class is WebDatasetSampleWriter:
+        assert sample["txt"] == b"text 120"
+        assert json.loads(sample["json"])["url"] == "http://example.com/120"
+    elif sample_writer_class is FilesSampleWriter:
+        assert sample["txt"] == b"text 120"
+    else:
+        assert sample["text"] == "text 120"
+        assert sample["url"] == "http://example.com/120"
+
+
+def test_empty_index(tmp_path):
+    # every shard failed, no shard index was written
+    output_folder = str(tmp_path)
+    assert build_index(output_folder) == 0
+    assert DatasetIndex(output_folder).lookup(key="00000") == []
+    assert DatasetIndex(output_folder).lookup(url="http://example.com/0") == []
+
+
+def test_incremental_index(tmp_path, capsys):
+    output_folder = str(tmp_path)
+
+    def write_shard(shard_id, n):
+        sample_writer = ParquetSampleWriter(shard_id, output_folder, False, 5, get_schema(), write_index=True)
+        write_samples(sample_writer, n)
+        sample_writer.close()
+
+    write_shard(0, 100)
+    write_shard(1, 100)
+    assert build_index(output_folder) == 200
+    write_shard(2, 50)
+    assert build_index(output_folder) == 250
+    assert build_index(output_folder) == 250
+    assert "is up to date" in capsys.readouterr().out
+
+    index = DatasetIndex(output_folder)
+    assert {e["file"] for e in index.lookup(key="00042")} == {"00000.parquet", "00001.parquet", "00002.parquet"}
+    assert [e["file"] for e in index.lookup(url="http://example.com/70")] == ["00000.parquet", "00001.parquet"]
+    assert list(index.key_hashes) == sorted(index.key_hashes)
+
+    # a redone shard replaces its entries
+    write_shard(1, 80)
+    assert build_index(output_folder) == 230
+    assert len(DatasetIndex(output_folder).lookup(url="http://example.com/90")) == 1
@@ -0,0 +1,75 @@
+import json
+import time
+
+from urls2dataset.lease import ShardLeases
+
+
+def test_claim_release(tmp_path):
+    output_folder = str(tmp_path)
+    leases = ShardLeases(output_folder, 5, ttl=60, settle_time=0)
+    other_leases = ShardLeases(output_folder, 5, ttl=60, settle_time=0)
+
+    lease = leases.claim(3)
+    assert lease is not None
+    assert other_leases.claim(3) is None
+    lease.release()
+    assert not (tmp_path / "_tmp" / "leases" / "00003.lease").exists()
+
+    lease = other_leases.claim(3)
+    assert lease is not None
+    lease.release()
+
+    (tmp_path / "00003_stats.json").write_text("{}")
+    assert leases.claim(3) is None
+
+
+def test_expired_lease_is_reclaimed(tmp_path):
+    output_folder = str(tmp_path)
+    lease_file = tmp_path / "_tmp" / "leases" / "00001.lease"
+    lease_file.parent.mkdir(parents=True)
+    lease_file.write_text(json.dumps({"owner": "crashed-node", "heartbeat": time.time() - 120}))
+
+    lease = ShardLeases(output_folder, 5, ttl=60, settle_time=0).claim(1)
+    assert lease is not None
+    assert json.loads(lease_file.read_text())["owner"] == lease.owner
+    lease.release()
+
+
+def test_heartbeat(tmp_path):
+    lease = ShardLeases(str(tmp_path), 5, ttl=0.5, settle_time=0).claim(2)
+    first_heartbeat = json.loads(open(lease.lease_file).read())["heartbeat"]
+    time.sleep(0.5)
+    assert json.loads(open(lease.lease_file).read())["heartbeat"] > first_heartbeat
+    assert ShardLeases(str(tmp_path), 5, ttl=0.5, settle_time=0).claim(2) is None
+    lease.release()
+
+
+def test_heartbeat_survives_errors(tmp_path, monkeypatch):
+    lease = ShardLeases(str(tmp_path), 5, ttl=0.5, settle_time=0).claim(4)
+    open_file = lease.fs.open
+    failures = []
+
+    def flaky_open(path, mode="rb", **kwargs):
+        if mode == "w" and not failures:
+            failures.append(path)
+            raise OSError("transient error")
+        return open_file(path, mode, **kwargs)
+
+    monkeypatch.setattr(lease.fs, "open", flaky_open)
+    first_heartbeat = json.loads(open(lease.lease_file).read())["heartbeat"]
+    time.sleep(0.5)
+    assert failures
+    assert json.loads(open(lease.lease_file).read())["heartbeat"] > first_heartbeat
+    assert not lease.lost
+    lease.release()
+
+
+def test_adopt(tmp_path):
+    leases = ShardLeases(str(tmp_path), 5, ttl=60, settle_time=0)
+    lease = leases.claim(5)
+    adopted = leases.adopt(5, lease.owner)
+    lease.stop()
+    assert (tmp_path / "_tmp" / "leases" / "00005.lease").exists()
+    assert ShardLeases(str(tmp_path), 5, ttl=60, settle_time=0).claim(5) is None
+    adopted.release()
+    assert not (tmp_path / "_tmp" / "leases" / "00005.lease").exists()
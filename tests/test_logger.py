@@ -0,0 +1,80 @@
+import json
+import multiprocessing
+import os
+
+from urls2dataset.logger import LoggerProcess, merge_stats
+from urls2dataset.timing import StageTimer
+
+
+def test_logger_process(capfd, tmp_path):
+    ctx = multiprocessing.get_context("spawn")
+    with ctx.Manager() as manager:
+        stats_queue = manager.Queue()
+        logger_process = LoggerProcess(
+            str(tmp_path),
+            False,
+            "urls2dataset",
+            {},
+            stats_queue,
+            log_interval=0,
+            metrics_file=str(tmp_path / "metrics.prom"),
+        )
+        logger_process.start()
+        timer = StageTimer()
+        timer.record("network", 0.5)
+        for i in range(3):
+            stats_queue.put(
+                {
+                    "count": 10,
+                    "successes": 8,
+                    "failed_to_download": 2,
+                    "failed_to_subsample": 0,
+                    "bytes_downloaded": 1000,
+                    "start_time": i,
+                    "end_time": i + 1,
+                    "status_dict": {"success": 8, "timeout": 2},
+                    "stage_timings": timer.summary(),
+                }
+            )
+        logger_process.join()
+
+    lines = capfd.readouterr().out.splitlines()
+    assert sum(line.startswith("worker") for line in lines) == 3
+    total = [line for line in lines if line.startswith("total")][-1]
+    assert "success: 0.800" in total
+    assert "count: 30" in total
+
+    metrics = (tmp_path / "metrics.prom").read_text()
+    assert "urls2dataset_shards_total 3\n" in metrics
+    assert 'urls2dataset_stage_seconds_count{stage="network"} 3\n' in metrics
+
+
+def test_merge_stats(tmp_path):
+    stats_files = []
+    for i in range(2):
+        stats_file = tmp_path / f"00003_split{i:02d}_stats.json"
+        stats_file.write_text(
+            json.dumps(
+                {
+                    "count": 10,
+                    "successes": 5 + i,
+                    "start_time": i,
+                    "end_time": 10 - i,
+                    "status_dict": {"success": 5 + i},
+                    "peak_buffered_bytes": 100 * (i + 1),
+                    "concurrency_trajectory": [i],
+                }
+            )
+        )
+        stats_files.append(str(stats_file))
+
+    stats = merge_stats(str(tmp_path), 3, stats_files, 5)
+    assert stats["count"] == 20
+    assert stats["successes"] == 11
+    assert stats["duration"] == 10
+    assert stats["status_dict"] == {"success": 11}
+    assert stats["peak_buffered_bytes"] == 200
+    assert stats["concurrency_trajectory"] == [0, 1]
+    assert stats["split_count"] == 2
+    assert json.loads((tmp_path / "00003_stats.json").read_text()) == stats
+    assert not any(os.path.exists(f) for f in stats_files)
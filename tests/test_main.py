@@ -1,19 +1,108 @@
 import pytest
-from urls2dataset import urls2dataset
+import json
+import multiprocessing
 import os
+import tarfile
+import pyarrow.parquet as pq
 
+from urls2dataset import main, urls2dataset
+from urls2dataset.logger import LoggerProcess
+from benchmark.synthetic_site import SyntheticSite
 
-@pytest.mark.parametrize("url_list", ["test-files/urls.txt"])
-def test_urls2dataset(url_list):
-    output_folder = "test_output"
-    urls2dataset(
-        url_list=url_list,
-        input_format="txt",
-        output_format="parquet",
-        output_folder=output_folder,
-        processes_count=1,
-        number_sample_per_shard=100,
-        thread_count=1,
-    )
-
-    assert len(os.listdir(output_folder)) > 0
+
+@pytest.mark.parametrize("output_format,shard_compression", [("parquet", "lz4"), ("webdataset", None)])
+def test_urls2dataset(output_format, shard_compression, tmp_path):
+    url_list = tmp_path / "urls.txt"
+    output_folder = str(tmp_path / "output")
+    scratch_dir = tmp_path / "scratch"
+    scratch_dir.mkdir()
+    with SyntheticSite(page_size=5000, error_rate=0.1) as site:
+        url_list.write_text("\n".join(site.urls(150)))
+        urls2dataset(
+            url_list=str(url_list),
+            input_format="txt",
+            output_format=output_format,
+            output_folder=output_folder,
+            processes_count=1,
+            number_sample_per_shard=100,
+            thread_count=4,
+            tmp_dir=str(scratch_dir),
+            shard_compression=shard_compression,
+        )
+
+    stats_files = sorted(f for f in os.listdir(output_folder) if f.endswith("_stats.json"))
+    assert stats_files == ["00000_stats.json", "00001_stats.json"]
+    stats = [json.load(open(f"{output_folder}/{f}", encoding="utf-8")) for f in stats_files]
+    assert sum(s["count"] for s in stats) == 150
+    assert 100 < sum(s["successes"] for s in stats) < 150
+    # each shard is written once and read once, then the scratch folder is removed
+    assert all(s["scratch_bytes_written"] == s["scratch_bytes_read"] > 0 for s in stats)
+    assert os.listdir(scratch_dir) == []
+    # both shards ran in the same process, the first one reports its startup
+    assert sum("startup_latency" in s for s in stats) == 1
+
+
+def test_webdataset_postprocess_with_failures(tmp_path):
+    url_list = tmp_path / "urls.txt"
+    output_folder = str(tmp_path / "output")
+    with SyntheticSite(page_size=2000, error_rate=0.3) as site:
+        url_list.write_text("\n".join(site.urls(100)))
+        urls2dataset(
+            url_list=str(url_list),
+            input_format="txt",
+            output_format="webdataset",
+            output_folder=output_folder,
+            processes_count=1,
+            number_sample_per_shard=100,
+            thread_count=4,
+            postprocess_func=len,
+            webdataset_compression="zstd",
+        )
+
+    with open(f"{output_folder}/00000_stats.json", encoding="utf-8") as f:
+        stats = json.load(f)
+    assert 0 < stats["failed_to_download"] < 100
+    # failed samples have no postproc_value, their meta rows are still written
+    table = pq.read_table(f"{output_folder}/00000.parquet")
+    assert table.num_rows == 100
+    assert table["postproc_value"].null_count == stats["failed_to_download"]
+    with tarfile.open(f"{output_folder}/00000.tar") as tar:
+        assert sum(name.endswith(".txt.zst") for name in tar.getnames()) == stats["successes"]
+
+
+def test_failed_setup_stops_processes(tmp_path, monkeypatch):
+    def broken_worker(**kwargs):
+        raise ValueError("invalid worker setting")
+
+    monkeypatch.setattr(main, "DownloadWorker", broken_worker)
+    url_list = tmp_path / "urls.txt"
+    url_list.write_text("http://127.0.0.1:1/0\n")
+    with pytest.raises(ValueError, match="invalid worker setting"):
+        urls2dataset(url_list=str(url_list), input_format="txt", output_folder=str(tmp_path / "output"))
+    # a logger process left running would keep the interpreter from exiting
+    assert not any(isinstance(p, LoggerProcess) for p in multiprocessing.active_children())
+
+
+def test_incremental_without_manifest(tmp_path):
+    url_list = tmp_path / "urls.txt"
+    output_folder = tmp_path / "output"
+    output_folder.mkdir()
+    # shard 0 was committed by a version without the manifest
+    (output_folder / "00000_stats.json").write_text("{}")
+    with SyntheticSite(page_size=1000) as site:
+        url_list.write_text("\n".join(site.urls(20)))
+        urls2dataset(
+            url_list=str(url_list),
+            input_format="txt",
+            output_format="parquet",
+            output_folder=str(output_folder),
+            processes_count=1,
+            number_sample_per_shard=10,
+            thread_count=2,
+            incremental_mode="incremental",
+        )
+
+    assert (output_folder / "00000_stats.json").read_text() == "{}"
+    assert not (output_folder / "00000.parquet").exists()
+    assert (output_folder / "00001.parquet").exists()
+    assert json.loads((output_folder / "00001_stats.json").read_text())["count"] == 10
@@ -0,0 +1,34 @@
+import pytest
+import os
+
+from urls2dataset.manifest import Manifest
+
+
+@pytest.mark.parametrize("output_folder", ["local", "memory://manifest"])
+def test_manifest(output_folder, tmp_path):
+    if output_folder == "local":
+        output_folder = str(tmp_path)
+    manifest = Manifest(output_folder, 5)
+    assert manifest.done_shards() == set()
+
+    for shard_id in [3, 1, 7]:
+        manifest.add(shard_id)
+    assert manifest.done_shards() == {1, 3, 7}
+    manifest.compact()
+    manifest.add(8)
+    # a second node compacting the same manifest
+    Manifest(output_folder, 5).compact()
+    manifest.compact()
+    assert manifest.done_shards() == {1, 3, 7, 8}
+
+
+def test_rebuild_manifest(tmp_path):
+    for shard_name in ["00000", "00002", "00002_split01", "other"]:
+        (tmp_path / f"{shard_name}_stats.json").write_text("{}")
+    (tmp_path / "config.json").write_text("{}")
+    manifest = Manifest(str(tmp_path), 5)
+    manifest.add(4)
+    manifest.rebuild()
+    assert manifest.done_shards() == {0, 2, 4}
+    assert os.listdir(tmp_path / "_manifest" / "log") == []
+    assert len(os.listdir(tmp_path / "_manifest" / "done")) == 1
@@ -0,0 +1,32 @@
+import time
+from email.utils import formatdate
+
+import pytest
+
+from urls2dataset.data_reader import parse_retry_after
+from urls2dataset.retry import RetryQueue
+
+
+@pytest.mark.parametrize("value, expected", [(None, 0), ("7", 7), ("-3", 0), ("soon", 0), ("http date", 30)])
+def test_parse_retry_after(value, expected):
+    if value == "http date":
+        value = formatdate(time.time() + 30, usegmt=True)
+    assert parse_retry_after(value) == pytest.approx(expected, abs=2)
+
+
+def test_retry_queue_caps():
+    retries = RetryQueue(retries=2, max_retries=3, backoff=0.01, max_delay=5, seed=0)
+    retries.started()
+    assert retries.schedule("a", 0, 0)
+    assert retries.schedule("a", 0, 0)
+    # per sample cap
+    assert not retries.schedule("a", 0, 0)
+    # Retry-After above max_delay
+    assert not retries.schedule("b", 1, 10)
+    assert retries.schedule("c", 2, 0)
+    # per shard cap
+    assert not retries.schedule("d", 3, 0)
+    assert retries.is_retry(2) and not retries.is_retry(3)
+    assert [retries.next() for _ in range(3)] in (["a", "a", "c"], ["a", "c", "a"], ["c", "a", "a"])
+    retries.finished()
+    assert retries.next() is None
@@ -0,0 +1,57 @@
+import http.server
+import pickle
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from urls2dataset.robots import RobotsCache, robots_parser
+
+
+class RobotsHandler(http.server.BaseHTTPRequestHandler):
+    """robots.txt disallowing /private/, slowly so that concurrent checks overlap"""
+
+    def do_GET(self):
+        self.server.robots_requests += 1
+        time.sleep(0.2)
+        body = b"User-agent: *\nDisallow: /private/\n"
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        pass
+
+
+@pytest.mark.parametrize(
+    "status, allowed", [(200, [True, False]), (404, [True, True]), (503, [False, False]), (0, [False, False])]
+)
+def test_robots_parser(status, allowed):
+    parser = robots_parser(status, "User-agent: *\nDisallow: /private/\n")
+    assert [parser.can_fetch("*", f"http://a.com/{path}/1") for path in ["public", "private"]] == allowed
+
+
+def test_robots_cache(tmp_path):
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), RobotsHandler)
+    server.robots_requests = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    origin = f"http://127.0.0.1:{server.server_address[1]}"
+    try:
+        cache = RobotsCache(str(tmp_path / "robots.sqlite"), ttl=1)
+        # the copy has its own connection like the cache of another worker process
+        caches = [cache, pickle.loads(pickle.dumps(cache))]
+        urls = [f"{origin}/{path}/{i}" for i in range(10) for path in ["public", "private"]]
+        with ThreadPoolExecutor(8) as executor:
+            allowed = list(executor.map(lambda i: caches[i % 2].allowed(urls[i]), range(len(urls))))
+        assert allowed == [True, False] * 10
+        assert server.robots_requests == 1
+
+        time.sleep(1)
+        assert not caches[1].allowed(f"{origin}/private/0")
+        assert server.robots_requests == 2
+        assert not caches[0].allowed(f"{origin}/private/0")
+        assert server.robots_requests == 2
+    finally:
+        server.shutdown()
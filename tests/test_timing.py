@@ -0,0 +1,36 @@
+from urls2dataset.timing import BUCKETS, StageTimer, merge_stage_timings, prometheus_text
+
+
+def test_stage_timer():
+    timer = StageTimer()
+    for i in range(100):
+        timer.record("network", (i + 1) / 1000)
+    with timer.time("parse"):
+        pass
+    summary = timer.summary()
+
+    assert summary["network"]["count"] == 100
+    assert abs(summary["network"]["total"] - 5.05) < 1e-9
+    assert abs(summary["network"]["p50"] - 0.0505) < 1e-9
+    assert summary["network"]["p50"] <= summary["network"]["p95"] <= summary["network"]["p99"] <= 0.1
+    assert len(summary["network"]["buckets"]) == len(BUCKETS) + 1
+    assert sum(summary["network"]["buckets"]) == 100
+    assert summary["parse"]["count"] == 1
+
+
+def test_merge_and_prometheus():
+    a, b = StageTimer(), StageTimer()
+    for i in range(10):
+        a.record("network", 0.01)
+        b.record("network", 1.0)
+    b.record("write", 0.001)
+    merged = merge_stage_timings(a.summary(), b.summary())
+
+    assert merged["network"]["count"] == 20
+    assert merged["network"]["p50"] <= 0.0128 < 1.0 <= merged["network"]["p99"]
+    assert merged["write"]["count"] == 1
+
+    text = prometheus_text({"samples_total": 20}, merged)
+    assert "urls2dataset_samples_total 20\n" in text
+    assert 'urls2dataset_stage_seconds_bucket{stage="network",le="+Inf"} 20\n' in text
+    assert 'urls2dataset_stage_seconds_count{stage="write"} 1\n' in text
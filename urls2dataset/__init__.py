@@ -1,3 +1,4 @@
 """urls2dataset"""
 
 from urls2dataset.main import urls2dataset
+from urls2dataset.index import DatasetIndex, build_index
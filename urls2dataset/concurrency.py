@@ -0,0 +1,152 @@
+"""concurrency module bounds the number of samples fetched at the same time in a shard"""
+
+import threading
+import time
+
+
+class ConcurrencyLimiter:
+    """Semaphore whose limit can change while it's in use, close() unblocks the waiting acquires
+
+    With max_bytes, no slot is given while the fetched results waiting to be processed hold max_bytes or more,
+    at least one sample stays in flight so that the shard always progresses.
+    """
+
+    def __init__(self, limit, max_bytes=None):
+        self.limit = limit
+        self.max_bytes = max_bytes
+        self.in_flight = 0
+        self.in_flight_bytes = 0
+        self.peak_bytes = 0
+        self.closed = False
+        self.condition = threading.Condition()
+
+    def _full(self):
+        if self.in_flight >= self.limit:
+            return True
+        return self.max_bytes is not None and self.in_flight > 0 and self.in_flight_bytes >= self.max_bytes
+
+    def acquire(self):
+        """Wait for a free slot, return False if the limiter was closed meanwhile"""
+        with self.condition:
+            while not self.closed and self._full():
+                self.condition.wait()
+            if self.closed:
+                return False
+            self.in_flight += 1
+            return True
+
+    def add_bytes(self, size):
+        """Account the size of a fetched result until its slot is released"""
+        with self.condition:
+            self.in_flight_bytes += size
+            self.peak_bytes = max(self.peak_bytes, self.in_flight_bytes)
+
+    def release(self, size=0):
+        with self.condition:
+            self.in_flight -= 1
+            self.in_flight_bytes -= size
+            self.condition.notify()
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def set_limit(self, limit):
+        with self.condition:
+            self.limit = limit
+            self.condition.notify_all()
+
+    def record(self, error):
+        """Called once per finished sample, a fixed limit ignores it"""
+
+    def trajectory(self):
+        return []
+
+
+class AIMDConcurrency(ConcurrencyLimiter):
+    """Adjust the concurrency every interval seconds from the samples finished in that interval
+
+    The concurrency grows by increase while the fetches keep up, and is multiplied by decrease when the process
+    is cpu bound (the fetch threads then only contend for the GIL), when the error rate rises by more than
+    error_margin over the previous interval (timeouts of overloaded hosts or of a saturated link) or when the
+    throughput falls by more than throughput_drop after the concurrency was raised.
+    """
+
+    def __init__(
+        self,
+        initial,
+        min_concurrency,
+        max_concurrency,
+        interval=5.0,
+        increase=1,
+        decrease=0.5,
+        max_cpu=0.9,
+        error_margin=0.1,
+        throughput_drop=0.2,
+        max_bytes=None,
+    ):
+        if not 1 <= min_concurrency <= max_concurrency:
+            raise ValueError(f"Invalid concurrency bounds {min_concurrency} and {max_concurrency}")
+        super().__init__(min(max(initial, min_concurrency), max_concurrency), max_bytes)
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.interval = interval
+        self.increase = increase
+        self.decrease = decrease
+        self.max_cpu = max_cpu
+        self.error_margin = error_margin
+        self.throughput_drop = throughput_drop
+        self.lock = threading.Lock()
+        self.start_time = time.perf_counter()
+        self.window_start = self.start_time
+        self.window_cpu = time.process_time()
+        self.completed = 0
+        self.errors = 0
+        self.previous = None
+        self.points = [{"time": 0.0, "concurrency": self.limit}]
+
+    def record(self, error):
+        with self.lock:
+            self.completed += 1
+            self.errors += int(error)
+            now = time.perf_counter()
+            if now - self.window_start >= self.interval:
+                self.adjust(now)
+
+    def adjust(self, now):
+        elapsed = now - self.window_start
+        cpu_time = time.process_time()
+        window = {
+            "concurrency": self.limit,
+            "throughput": self.completed / elapsed,
+            "error_rate": self.errors / max(self.completed, 1),
+            "cpu": (cpu_time - self.window_cpu) / elapsed,
+        }
+        previous = self.previous
+        congested = window["cpu"] >= self.max_cpu or (
+            previous is not None
+            and (
+                window["error_rate"] > previous["error_rate"] + self.error_margin
+                or (
+                    window["concurrency"] > previous["concurrency"]
+                    and window["throughput"] < (1 - self.throughput_drop) * previous["throughput"]
+                )
+            )
+        )
+        if congested:
+            limit = max(self.min_concurrency, int(self.limit * self.decrease))
+        else:
+            limit = min(self.max_concurrency, self.limit + self.increase)
+        self.set_limit(limit)
+        self.points.append({"time": now - self.start_time, **window, "concurrency": limit})
+        self.previous = window
+        self.window_start = now
+        self.window_cpu = cpu_time
+        self.completed = 0
+        self.errors = 0
+
+    def trajectory(self):
+        """Concurrency after each adjustment, with the throughput, error rate and cpu use of the interval before it"""
+        with self.lock:
+            return list(self.points)
@@ -4,13 +4,17 @@ import requests
 import io
 from resiliparse.parse.html import HTMLTree
 from resiliparse.extract.html2text import extract_plain_text
-from resiliparse.parse import detect_encoding, bytes_to_str
 import hashlib
 from urllib.parse import urljoin, urlparse
 import time
-from ftlangdetect import detect
+from email.utils import parsedate_to_datetime
 import ast
 
+from .timing import StageTimer
+from .encoding import decode_html
+from .host_health import HOST_UNREACHABLE, host_breaker
+from .robots import DISALLOWED_BY_ROBOTS
+
 _HEADERS = {
     "accept": "*/*",
     "accept-language": "en-US,en;q=0.9",
@@ -20,6 +24,23 @@ _HEADERS = {
 }
 _HEADERS = {}
 
+# responses worth fetching again later, timeouts are retried too, other failures are final
+TRANSIENT_STATUSES = {429, 502, 503, 504}
+
+
+def parse_retry_after(value):
+    """Seconds to wait given by a Retry-After header, in seconds or as an http date, 0 if missing or invalid"""
+    if value is None:
+        return 0.0
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return 0.0
+
 
 def get_extension(url: str) -> str:
     """Parse the URL using the urlparse method
@@ -135,96 +156,165 @@ class CCDownloader:
     def __init__(self, config):
         self.config = config
 
-    def __call__(self, data):
+    def __call__(self, data, timer=None):
+        """Return text, media, error and retry_after, documents are local so retry_after is always None"""
+        timer = timer if timer is not None else StageTimer()
         html, url = ast.literal_eval(data)
-        text, media, lang = None, None, None
+        text, media, lang = None, {}, None
         try:
             if self.config.get("media_elems"):
-                tree = HTMLTree.parse(html)
-                tree, media = parser_bytes(url, tree)
+                with timer.time("parse"):
+                    tree = HTMLTree.parse(html)
+                with timer.time("parser_bytes"):
+                    tree, media = parser_bytes(url, tree)
                 lang = tree.document.query_selector("html").getattr("lang")
 
-            if self.config.get("save_media_struct"):
-                text = extract_plain_text(
-                    tree,
-                    preserve_formatting=False,
-                    main_content=False,
-                    list_bullets=False,
-                    alt_texts=True,
-                    links=False,
-                    form_fields=False,
-                    noscript=False,
-                )
-            else:
-                text = extract_plain_text(html)
+            with timer.time("extract_plain_text"):
+                if self.config.get("save_media_struct"):
+                    text = extract_plain_text(
+                        tree,
+                        preserve_formatting=False,
+                        main_content=False,
+                        list_bullets=False,
+                        alt_texts=True,
+                        links=False,
+                        form_fields=False,
+                        noscript=False,
+                    )
+                else:
+                    text = extract_plain_text(html)
             error = None
             if lang is None:
-                lang = detect(text[:100], low_memory=True)["lang"]
+                with timer.time("lang_detect"):
+                    from ftlangdetect import detect  # pylint: disable=import-outside-toplevel
+
+                    lang = detect(text[:100], low_memory=True)["lang"]
             lang = str(lang).replace("Language.", "")
             media["language"] = lang
 
         except Exception as err:
             error = str(err)
-        return text, media, error
+        return text, media, error, None
 
 
 class URLDownloader:
-    def __init__(self, timeout, headers=None, config={}):
+    def __init__(self, timeout, headers=None, config={}, host_failure_threshold=5, host_cooldown=60.0, robots=None):
         self.timeout = timeout
         self.headers = headers if headers is not None else _HEADERS
         self.config = config
+        # None disables the circuit breaker
+        self.host_failure_threshold = host_failure_threshold
+        self.host_cooldown = host_cooldown
+        # RobotsCache checked before each fetch, None to ignore robots.txt
+        self.robots = robots
 
-    def __call__(self, url):
+    def __call__(self, url, timer=None):
+        """Return text, media, error and retry_after
+
+        retry_after is None unless the failure is transient, it's then the delay the server asked for, or 0
+        """
+        timer = timer if timer is not None else StageTimer()
 
         media = {}
 
         text = None
+        retry_after = None
+        if self.robots is not None:
+            with timer.time("robots"):
+                allowed = self.robots.allowed(url, self.headers.get("user-agent", "*"))
+            if not allowed:
+                return text, media, DISALLOWED_BY_ROBOTS, retry_after
+        host = urlparse(url).netloc
+        breaker = None
+        if self.host_failure_threshold is not None:
+            breaker = host_breaker(self.host_failure_threshold, self.host_cooldown)
+            if not breaker.allow(host):
+                return text, media, HOST_UNREACHABLE, retry_after
+        fetched = False
         try:
-            resp = requests.get(url, headers=self.headers, timeout=self.timeout)
+            with timer.time("network"):
+                resp = requests.get(url, headers=self.headers, timeout=self.timeout)
+                html_bytes = resp.content
+            fetched = True
+            if breaker is not None:
+                breaker.success(host)
             error = f"response {resp.status_code}"
+            if resp.status_code in TRANSIENT_STATUSES:
+                retry_after = parse_retry_after(resp.headers.get("Retry-After"))
             if resp.status_code == 200:
-                html_bytes = resp.content
+                with timer.time("decode"):
+                    html, _ = decode_html(html_bytes, resp.headers.get("Content-Type"))
+                lang = None
                 if self.config.get("media_elems"):
-                    encoding = detect_encoding(html_bytes)
-                    tree = HTMLTree.parse_from_bytes(html_bytes, encoding)
+                    with timer.time("parse"):
+                        tree = HTMLTree.parse(html)
                     lang = tree.document.query_selector("html").getattr("lang")
+                    with timer.time("parser_bytes"):
+                        tree, media = parser_bytes(url, tree)
+                with timer.time("extract_plain_text"):
+                    if self.config.get("save_media_struct"):
+                        text = extract_plain_text(
+                            tree,
+                            preserve_formatting=False,
+                            main_content=False,
+                            list_bullets=False,
+                            alt_texts=True,
+                            links=False,
+                            form_fields=False,
+                            noscript=False,
+                        )
+                    else:
+                        text = extract_plain_text(html)
+                if self.config.get("media_elems"):
                     if lang is None:
-                        lang = detector.detect_language_of(text)
-                    media["language"] = lang
-                    tree, media = parser_bytes(url, tree)
-                if self.config.get("save_media_struct"):
-                    text = extract_plain_text(
-                        tree,
-                        preserve_formatting=False,
-                        main_content=False,
-                        list_bullets=False,
-                        alt_texts=True,
-                        links=False,
-                        form_fields=False,
-                        noscript=False,
-                    )
-                else:
-                    text = extract_plain_text(html_bytes.decode())
+                        with timer.time("lang_detect"):
+                            from ftlangdetect import detect  # pylint: disable=import-outside-toplevel
+
+                            lang = detect(text[:100], low_memory=True)["lang"]
+                    media["language"] = str(lang).replace("Language.", "")
                 error = None
 
+        except requests.Timeout as err:
+            print(err)
+            error = str(err)
+            retry_after = 0.0
         except Exception as err:
             print(err)
             error = str(err)
+        finally:
+            # any error before the response is read counts against the host, it also ends a half open probe
+            if breaker is not None and not fetched:
+                breaker.failure(host)
 
-        return text, media, error
+        return text, media, error, retry_after
 
 
 class DataReader:
     """URLs data reader provide data for a URL"""
 
-    def __init__(self, dl_timeout, tmp_dir, config, common_crawl=False) -> None:
+    def __init__(
+        self,
+        dl_timeout,
+        tmp_dir,
+        config,
+        common_crawl=False,
+        host_failure_threshold=5,
+        host_cooldown=60.0,
+        robots=None,
+    ) -> None:
         if common_crawl:
             self.downloader = CCDownloader(config)
         else:
-            self.downloader = URLDownloader(dl_timeout, config=config)
-
-    def __call__(self, row):
+            self.downloader = URLDownloader(
+                dl_timeout,
+                config=config,
+                host_failure_threshold=host_failure_threshold,
+                host_cooldown=host_cooldown,
+                robots=robots,
+            )
+
+    def __call__(self, row, timer=None):
         key, url = row
 
-        text, media, error_message = self.downloader(url)
-        return key, text, media, error_message
+        text, media, error_message, retry_after = self.downloader(url, timer)
+        return key, text, media, error_message, retry_after
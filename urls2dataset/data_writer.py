@@ -2,49 +2,86 @@
 
 import json
 import os
+import queue
+import threading
+import time
+import traceback
 
 import fsspec
 import numpy as np
 import pyarrow as pa
 import pyarrow.parquet as pq
-import webdataset as wds
 import json
 import ast
 
+from .index import ShardIndexWriter
+
+
+def get_url(url):
+    """CC shards store the url as the repr of a (HTML, URL) tuple"""
+    if url.startswith("("):
+        return ast.literal_eval(url)[1]
+    return url
+
+
+def json_default(obj):
+    """some meta data may not be JSON serializable"""
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, bytes):
+        return obj.decode("utf-8", errors="replace")
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def meta_row(meta):
+    """Row of the meta parquet written next to tars and files"""
+    media = meta["media"] if meta["media"] is not None else {}
+    return {
+        **meta,
+        "language": media.get("language"),
+        "media": json.dumps(media, separators=(",", ":")).encode("utf-8"),
+    }
+
 
 class BufferedParquetWriter:
     """Write samples to parquet files incrementally with a buffer"""
 
-    def __init__(self, output_file, schema, buffer_size=100):
+    def __init__(self, output_file, schema, buffer_size=100, block_size=None):
         self.buffer_size = buffer_size
         self.schema = schema
         self._initiatlize_buffer()
         fs, output_path = fsspec.core.url_to_fs(output_file)
 
-        self.output_fd = fs.open(output_path, "wb")
+        self.output_fd = fs.open(output_path, "wb", block_size=block_size)
         self.parquet_writer = pq.ParquetWriter(self.output_fd, schema)
+        self.row_groups = 0
 
     def _initiatlize_buffer(self):
         self.current_buffer_size = 0
         self.buffer = {k: [] for k in self.schema.names}
 
     def _add_sample_to_buffer(self, sample):
+        # fields a sample lacks (postproc_value of a failed fetch...) are null, the columns keep the same length
         for k in self.schema.names:
-            self.buffer[k].append(sample[k])
+            self.buffer[k].append(sample.get(k))
         self.current_buffer_size += 1
 
     def write(self, sample):
+        """Buffer a sample, return the (row_group, row) it will be written to"""
         if self.current_buffer_size >= self.buffer_size:
             self.flush()
+        location = (self.row_groups, self.current_buffer_size)
         self._add_sample_to_buffer(sample)
+        return location
 
     def flush(self):
-        """Write the buffer to disk"""
+        """Write the buffer to disk as one row group"""
         if self.current_buffer_size == 0:
             return
 
         df = pa.Table.from_pydict(self.buffer, self.schema)
-        self.parquet_writer.write_table(df)
+        self.parquet_writer.write_table(df, row_group_size=df.num_rows)
+        self.row_groups += 1
         self._initiatlize_buffer()
 
     def close(self):
@@ -65,6 +102,8 @@ class ParquetSampleWriter:
         save_caption,
         oom_shard_count,
         schema,
+        block_size=None,
+        write_index=False,
     ):
         self.oom_shard_count = oom_shard_count
         schema = schema.append(pa.field("text", pa.string()))
@@ -76,8 +115,10 @@ class ParquetSampleWriter:
             )
         )
         output_file = f"{output_folder}/{shard_name}.parquet"
-        self.buffered_parquet_writer = BufferedParquetWriter(output_file, schema, 100)
+        self.buffered_parquet_writer = BufferedParquetWriter(output_file, schema, 100, block_size)
         self.save_caption = save_caption
+        self.file_name = f"{shard_name}.parquet"
+        self.index = ShardIndexWriter(output_folder, shard_name) if write_index else None
 
     def write(self, text, key, caption, meta):
         """Keep sample in memory then write to disk when close() is called"""
@@ -86,26 +127,33 @@ class ParquetSampleWriter:
         media = meta.pop("media")
         sample["language"] = None
         if media is not None:
-            sample["language"] = media.pop("language")
+            sample["language"] = media.pop("language", None)
             sample["media"] = json.dumps(media, indent=2).encode("utf-8")
 
-        url = ast.literal_eval(meta["url"])
-
-        if isinstance(url, tuple):  # CC returns (HTML, URL)
-            url = url[1]
-    
-        meta["url"] = url
+        meta["url"] = get_url(meta["url"])
 
         sample.update(meta)
         if type(text) == str:
-            self.buffered_parquet_writer.write(sample)
+            row_group, row = self.buffered_parquet_writer.write(sample)
+            if self.index is not None:
+                self.index.add(key, meta["url"], self.file_name, row_group=row_group, row=row)
+
+    @property
+    def bytes_written(self):
+        return self.buffered_parquet_writer.output_fd.tell()
 
     def close(self):
         self.buffered_parquet_writer.close()
+        if self.index is not None:
+            self.index.close()
 
 
 class WebDatasetSampleWriter:
-    """WebDatasetSampleWriter is a video+caption writer to webdataset"""
+    """WebDatasetSampleWriter is a text+caption writer to webdataset
+
+    Each sample is stored as {key}.txt, {key}.json and optionally {key}.caption.txt,
+    members get a .zst suffix when compression is "zstd"
+    """
 
     def __init__(
         self,
@@ -114,7 +162,13 @@ class WebDatasetSampleWriter:
         save_caption,
         oom_shard_count,
         schema,
+        block_size=None,
+        compression=None,
+        save_parquet_meta=True,
+        write_index=False,
     ):
+        if compression not in (None, "zstd"):
+            raise ValueError(f"Invalid webdataset compression {compression}")
         self.oom_shard_count = oom_shard_count
         shard_name = (
             shard_id
@@ -125,35 +179,65 @@ class WebDatasetSampleWriter:
         )
         self.shard_id = shard_id
         fs, output_path = fsspec.core.url_to_fs(output_folder)
-        self.tar_fd = fs.open(f"{output_path}/{shard_name}.tar", "wb")
-        self.tarwriter = wds.TarWriter(self.tar_fd)
+        self.tar_fd = fs.open(f"{output_path}/{shard_name}.tar", "wb", block_size=block_size)
+        # members are encoded here, skip the extension based encoder of webdataset
+        import webdataset as wds  # pylint: disable=import-outside-toplevel
+
+        self.tarwriter = wds.TarWriter(self.tar_fd, encoder=False)
         self.save_caption = save_caption
-        self.buffered_parquet_writer = BufferedParquetWriter(output_folder + "/" + shard_name + ".parquet", schema, 100)
+        self.compression = compression
+        self.suffix = "" if compression is None else ".zst"
+        self.buffered_parquet_writer = (
+            BufferedParquetWriter(output_folder + "/" + shard_name + ".parquet", schema, 100, block_size)
+            if save_parquet_meta
+            else None
+        )
+        self.file_name = f"{shard_name}.tar"
+        self.index = ShardIndexWriter(output_folder, shard_name) if write_index else None
+
+    def _encode(self, data):
+        data = data.encode("utf-8")
+        if self.compression is not None:
+            data = pa.compress(data, codec=self.compression, asbytes=True)
+        return data
 
     def write(self, text, key, caption, meta):
         """write sample to tars"""
+        meta["url"] = get_url(meta["url"])
         sample = {"__key__": key}
-        sample["text"] = text
-
+        if isinstance(text, str):
+            sample["txt" + self.suffix] = self._encode(text)
         if self.save_caption:
-            sample["txt"] = str(caption) if caption is not None else ""
-        # some meta data may not be JSON serializable
-        for k, v in meta.items():
-            if isinstance(v, np.ndarray):
-                meta[k] = v.tolist()
-        sample["json"] = json.dumps(meta, indent=4)
+            sample["caption.txt" + self.suffix] = self._encode(str(caption) if caption is not None else "")
+        sample["json" + self.suffix] = self._encode(json.dumps(meta, separators=(",", ":"), default=json_default))
 
+        offset = self.tarwriter.tarstream.offset
         self.tarwriter.write(sample)
-        self.buffered_parquet_writer.write(meta)
+        if self.index is not None:
+            length = self.tarwriter.tarstream.offset - offset
+            self.index.add(key, meta["url"], self.file_name, offset=offset, length=length)
+        if self.buffered_parquet_writer is not None:
+            self.buffered_parquet_writer.write(meta_row(meta))
+
+    @property
+    def bytes_written(self):
+        return self.tarwriter.tarstream.offset
 
     def close(self):
-        self.buffered_parquet_writer.close()
+        if self.buffered_parquet_writer is not None:
+            self.buffered_parquet_writer.close()
         self.tarwriter.close()
         self.tar_fd.close()
+        if self.index is not None:
+            self.index.close()
 
 
 class FilesSampleWriter:
-    """FilesSampleWriter is a caption+video writer to files"""
+    """FilesSampleWriter is a text+caption writer to one folder per shard
+
+    Each sample is stored as {key}.txt, {key}.json and optionally {key}.caption.txt,
+    files are buffered in memory and written by batches of buffer_size samples
+    """
 
     def __init__(
         self,
@@ -162,6 +246,9 @@ class FilesSampleWriter:
         save_caption,
         oom_shard_count,
         schema,
+        block_size=None,
+        write_index=False,
+        buffer_size=100,
     ):
         self.oom_shard_count = oom_shard_count
         shard_name = (
@@ -172,37 +259,185 @@ class FilesSampleWriter:
             )
         )
         self.shard_id = shard_id
+        self.shard_name = shard_name
         self.fs, self.subfolder = fsspec.core.url_to_fs(f"{output_folder}/{shard_name}")
-        if not self.fs.exists(self.subfolder):
-            self.fs.mkdir(self.subfolder)
+        self.fs.makedirs(self.subfolder, exist_ok=True)
         self.save_caption = save_caption
-        self.buffered_parquet_writer = BufferedParquetWriter(output_folder + "/" + shard_name + ".parquet", schema, 100)
+        self.buffer_size = buffer_size
+        self.buffer = {}
+        self.buffered_samples = 0
+        self.bytes_written = 0
+        self.buffered_parquet_writer = BufferedParquetWriter(
+            output_folder + "/" + shard_name + ".parquet", schema, 100, block_size
+        )
+        self.index = ShardIndexWriter(output_folder, shard_name) if write_index else None
 
     def write(self, text, key, caption, meta):
-        """Write sample to disk"""
-        filename = f"{self.subfolder}/{key}.{self.encode_formats[modality]}"
-        with self.fs.open(filename, "w") as f:
-            f.write(text)
-
+        """Buffer the files of a sample, write them when buffer_size samples are buffered"""
+        meta["url"] = get_url(meta["url"])
+        if isinstance(text, str):
+            self.buffer[f"{self.subfolder}/{key}.txt"] = text.encode("utf-8")
+            if self.index is not None:
+                self.index.add(key, meta["url"], f"{self.shard_name}/{key}.txt")
         if self.save_caption:
             caption = str(caption) if caption is not None else ""
-            caption_filename = f"{self.subfolder}/{key}.txt"
-            with self.fs.open(caption_filename, "w") as f:
-                f.write(str(caption))
+            self.buffer[f"{self.subfolder}/{key}.caption.txt"] = caption.encode("utf-8")
+        j = json.dumps(meta, separators=(",", ":"), default=json_default)
+        self.buffer[f"{self.subfolder}/{key}.json"] = j.encode("utf-8")
 
-        # some meta data may not be JSON serializable
-        for k, v in meta.items():
-            if isinstance(v, np.ndarray):
-                meta[k] = v.tolist()
-        j = json.dumps(meta, indent=4)
-        meta_filename = f"{self.subfolder}/{key}.json"
-        with self.fs.open(meta_filename, "w") as f:
-            f.write(j)
+        self.buffered_parquet_writer.write(meta_row(meta))
+        self.buffered_samples += 1
+        if self.buffered_samples >= self.buffer_size:
+            self.flush()
 
-        self.buffered_parquet_writer.write(meta)
+    def flush(self):
+        """Write the buffered files, object stores upload them concurrently"""
+        if len(self.buffer) == 0:
+            return
+        self.fs.pipe(self.buffer)
+        self.bytes_written += sum(len(v) for v in self.buffer.values())
+        self.buffer = {}
+        self.buffered_samples = 0
 
     def close(self):
+        self.flush()
         self.buffered_parquet_writer.close()
+        if self.index is not None:
+            self.index.close()
+
+
+class ArrowSampleWriter:
+    """ArrowSampleWriter is a text writer to an Arrow IPC stream
+
+    Record batches of buffer_size samples are written with compressed buffers (zstd by default),
+    with compression=None the file can be memory mapped and read without any copy
+    """
+
+    def __init__(
+        self,
+        shard_id,
+        output_folder,
+        save_caption,
+        oom_shard_count,
+        schema,
+        block_size=None,
+        write_index=False,
+        compression="zstd",
+        buffer_size=100,
+    ):
+        self.oom_shard_count = oom_shard_count
+        shard_name = (
+            shard_id
+            if isinstance(shard_id, str)
+            else "{shard_id:0{oom_shard_count}d}".format(  # pylint: disable=consider-using-f-string
+                shard_id=shard_id, oom_shard_count=oom_shard_count
+            )
+        )
+        self.schema = schema.append(pa.field("text", pa.string()))
+        fs, output_path = fsspec.core.url_to_fs(output_folder)
+        self.output_fd = fs.open(f"{output_path}/{shard_name}.arrow", "wb", block_size=block_size)
+        self.stream_writer = pa.ipc.new_stream(
+            self.output_fd, self.schema, options=pa.ipc.IpcWriteOptions(compression=compression)
+        )
+        self.save_caption = save_caption
+        self.buffer_size = buffer_size
+        self.batches = 0
+        self._initialize_buffer()
+        self.file_name = f"{shard_name}.arrow"
+        self.index = ShardIndexWriter(output_folder, shard_name) if write_index else None
+
+    def _initialize_buffer(self):
+        self.current_buffer_size = 0
+        self.buffer = {k: [] for k in self.schema.names}
+
+    def write(self, text, key, caption, meta):
+        """Buffer the sample, write a record batch when buffer_size samples are buffered"""
+        if not isinstance(text, str):
+            return
+        sample = meta_row(meta)
+        sample["url"] = get_url(meta["url"])
+        sample["key"] = key
+        sample["text"] = text
+        for k in self.schema.names:
+            self.buffer[k].append(sample.get(k))
+        if self.index is not None:
+            self.index.add(key, sample["url"], self.file_name, row_group=self.batches, row=self.current_buffer_size)
+        self.current_buffer_size += 1
+        if self.current_buffer_size >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if self.current_buffer_size == 0:
+            return
+        self.stream_writer.write_batch(pa.RecordBatch.from_pydict(self.buffer, self.schema))
+        self.batches += 1
+        self._initialize_buffer()
+
+    @property
+    def bytes_written(self):
+        return self.output_fd.tell()
+
+    def close(self):
+        self.flush()
+        self.stream_writer.close()
+        self.output_fd.close()
+        if self.index is not None:
+            self.index.close()
+
+
+class JsonlZstSampleWriter:
+    """JsonlZstSampleWriter is a text writer to zstd compressed json lines, one line per sample"""
+
+    def __init__(
+        self,
+        shard_id,
+        output_folder,
+        save_caption,
+        oom_shard_count,
+        schema,
+        block_size=None,
+        write_index=False,
+    ):
+        self.oom_shard_count = oom_shard_count
+        shard_name = (
+            shard_id
+            if isinstance(shard_id, str)
+            else "{shard_id:0{oom_shard_count}d}".format(  # pylint: disable=consider-using-f-string
+                shard_id=shard_id, oom_shard_count=oom_shard_count
+            )
+        )
+        fs, output_path = fsspec.core.url_to_fs(output_folder)
+        self.output_fd = fs.open(f"{output_path}/{shard_name}.jsonl.zst", "wb", block_size=block_size)
+        self.stream = pa.CompressedOutputStream(pa.PythonFile(self.output_fd, mode="w"), "zstd")
+        self.save_caption = save_caption
+        self.lines = 0
+        self.file_name = f"{shard_name}.jsonl.zst"
+        self.index = ShardIndexWriter(output_folder, shard_name) if write_index else None
+
+    def write(self, text, key, caption, meta):
+        """Compress one json line for the sample"""
+        if not isinstance(text, str):
+            return
+        meta["url"] = get_url(meta["url"])
+        media = meta["media"] if meta["media"] is not None else {}
+        sample = {"key": key, "text": text, **meta, "language": media.get("language")}
+        if self.save_caption:
+            sample["caption"] = str(caption) if caption is not None else ""
+        line = json.dumps(sample, separators=(",", ":"), default=json_default) + "\n"
+        self.stream.write(line.encode("utf-8"))
+        if self.index is not None:
+            self.index.add(key, meta["url"], self.file_name, row=self.lines)
+        self.lines += 1
+
+    @property
+    def bytes_written(self):
+        return self.output_fd.tell()
+
+    def close(self):
+        self.stream.close()
+        self.output_fd.close()
+        if self.index is not None:
+            self.index.close()
 
 
 class DummySampleWriter:
@@ -215,7 +450,7 @@ class DummySampleWriter:
         save_caption,
         oom_shard_count,
         schema,
-        encode_formats,
+        block_size=None,
     ):
         pass
 
@@ -224,3 +459,152 @@ class DummySampleWriter:
 
     def close(self):
         pass
+
+
+class RollingSampleWriter:
+    """Split the output of a shard into parts of about max_shard_bytes
+
+    Parts are named {shard_name}_{part:04d} so the names only depend on the shard id.
+    Without max_shard_bytes parts are only closed by roll(), numbering starts at first_part.
+    """
+
+    def __init__(
+        self,
+        sample_writer_class,
+        max_shard_bytes,
+        shard_id,
+        output_folder,
+        save_caption,
+        oom_shard_count,
+        schema,
+        first_part=0,
+    ):
+        self.sample_writer_class = sample_writer_class
+        self.max_shard_bytes = max_shard_bytes
+        self.shard_name = (
+            shard_id
+            if isinstance(shard_id, str)
+            else "{shard_id:0{oom_shard_count}d}".format(  # pylint: disable=consider-using-f-string
+                shard_id=shard_id, oom_shard_count=oom_shard_count
+            )
+        )
+        self.writer_args = (output_folder, save_caption, oom_shard_count, schema)
+        self.part = first_part
+        self.sample_writer = self._open_part()
+
+    def _open_part(self):
+        return self.sample_writer_class(f"{self.shard_name}_{self.part:04d}", *self.writer_args)
+
+    def write(self, text, key, caption, meta):
+        if self.sample_writer is None:
+            self.part += 1
+            self.sample_writer = self._open_part()
+        self.sample_writer.write(text, key, caption, meta)
+        if self.max_shard_bytes is not None and self.sample_writer.bytes_written >= self.max_shard_bytes:
+            self.roll()
+
+    def roll(self):
+        """Close the current part, the next sample opens a new one"""
+        if self.sample_writer is not None:
+            self.sample_writer.close()
+            self.sample_writer = None
+
+    @property
+    def parts(self):
+        return self.part + 1
+
+    def close(self):
+        if self.sample_writer is not None:
+            self.sample_writer.close()
+
+
+class ThreadedSampleWriter:
+    """Run a sample writer on a dedicated thread behind a bounded queue
+
+    The calling thread only blocks when the queue is full, the time spent blocked is kept in blocked_time.
+    The keys of the downloaded samples that failed to write are collected until take_write_failures() is called.
+    """
+
+    def __init__(self, sample_writer, queue_size=100, timer=None, profiler=None):
+        self.sample_writer = sample_writer
+        self.timer = timer
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.blocked_time = 0.0
+        self.roll_error = None
+        self.write_failures = []
+        self.aborted = False
+        self.closed = False
+        run = self._run if profiler is None else profiler.wrap(self._run)
+        self.thread = threading.Thread(target=run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            if self.aborted:
+                continue
+            if isinstance(item, threading.Event):
+                try:
+                    self.sample_writer.roll()
+                except Exception as err:  # pylint: disable=broad-except
+                    self.roll_error = err
+                item.set()
+                continue
+            try:
+                start = time.perf_counter()
+                self.sample_writer.write(*item)
+                if self.timer is not None:
+                    self.timer.record("write", time.perf_counter() - start)
+            except Exception as err:  # pylint: disable=broad-except
+                traceback.print_exc()
+                print(f"Sample {item[1]} failed to write: {err}")
+                if isinstance(item[0], str):
+                    self.write_failures.append(item[1])
+
+    def write(self, text, key, caption, meta):
+        start = time.perf_counter()
+        self.queue.put((text, key, caption, meta))
+        self.blocked_time += time.perf_counter() - start
+
+    def roll(self):
+        """Wait for the queued samples to be written then close the current part of a RollingSampleWriter
+
+        Returns the number of parts that are complete on the output filesystem
+        """
+        start = time.perf_counter()
+        done = threading.Event()
+        self.queue.put(done)
+        done.wait()
+        self.blocked_time += time.perf_counter() - start
+        if self.roll_error is not None:
+            raise self.roll_error
+        return self.sample_writer.parts
+
+    def take_write_failures(self):
+        """Keys of the samples that failed to write since the last call, call it once the queue is drained"""
+        failures, self.write_failures = self.write_failures, []
+        return failures
+
+    def close(self):
+        """Wait for the queue to drain then close the underlying writer"""
+        start = time.perf_counter()
+        self.queue.put(None)
+        self.thread.join()
+        self.closed = True
+        self.sample_writer.close()
+        self.blocked_time += time.perf_counter() - start
+
+    def abort(self):
+        """Stop the writer thread without writing the queued samples and close the underlying writer"""
+        if self.closed:
+            return
+        self.aborted = True
+        self.queue.put(None)
+        self.thread.join()
+        self.closed = True
+        try:
+            self.sample_writer.close()
+        except Exception as err:  # pylint: disable=broad-except
+            print(f"failed to close the writer of an aborted shard: {err}")
@@ -1,4 +1,4 @@
-"""distributor defines the distribution strategies for img2dataset"""
+"""distributor defines the distribution strategies for urls2dataset"""
 import os
 import time
 import subprocess
@@ -11,6 +11,9 @@ from itertools import islice, chain
 import fsspec
 from tqdm import tqdm
 
+from .lease import LEASED
+from .logger import merge_stats
+
 
 def retrier(runf, failed_shards, max_shard_retry):
     # retry failed shards max_shard_retry times
@@ -26,22 +29,376 @@ def retrier(runf, failed_shards, max_shard_retry):
         )
 
 
-def multiprocessing_distributor(processes_count, worker, input_sharder, _, max_shard_retry):
+def requeue_leased(runf, leased_shards, worker, max_shard_retry):
+    """Run the shards leased by other workers again every lease ttl, until they are done or claimed
+
+    runf appends the shards still leased to leased_shards, the lease of a dead worker expires after its ttl
+    """
+    while len(leased_shards) > 0:
+        shards = list(leased_shards)
+        leased_shards.clear()
+        ttl = worker.shard_leases.ttl
+        print(f"{len(shards)} shards are leased by other workers, claiming them again in {ttl}s")
+        time.sleep(ttl)
+        retrier(runf, runf(shards), max_shard_retry)
+
+
+# modules every download process imports, imported once by the fork server with the forkserver start method
+FORKSERVER_PRELOAD = ["urls2dataset.download_worker"]
+
+
+def process_context(start_method):
+    """Multiprocessing context of the download processes
+
+    With spawn each process, and each process replacing one after maxtasksperchild shards, starts an interpreter
+    and imports the download modules again. With forkserver they are forked from a server that preloaded them.
+    """
+    ctx = get_context(start_method)
+    if start_method == "forkserver":
+        ctx.set_forkserver_preload(FORKSERVER_PRELOAD)
+    return ctx
+
+
+def multiprocessing_distributor(processes_count, worker, input_sharder, _, max_shard_retry, start_method="spawn"):
     """Distribute the work to the processes using multiprocessing"""
-    ctx = get_context("spawn")
+    ctx = process_context(start_method)
     with ctx.Pool(processes_count, maxtasksperchild=5) as process_pool:
+        leased_shards = []
 
         def run(gen):
             failed_shards = []
             for (status, row) in tqdm(process_pool.imap_unordered(worker, gen)):
                 if status is False:
                     failed_shards.append(row)
+                elif status == LEASED:
+                    leased_shards.append(row)
             return failed_shards
 
         failed_shards = run(input_sharder)
 
         retrier(run, failed_shards, max_shard_retry)
+        requeue_leased(run, leased_shards, worker, max_shard_retry)
 
         process_pool.terminate()
         process_pool.join()
         del process_pool
+
+
+class ShardProgress:
+    """Progress of the running shards and split requests, shared by the workers and the work stealing scheduler
+
+    Shards are identified by their row, workers report how many samples of a shard they handed to their fetch threads
+    """
+
+    def __init__(self, manager, check_interval=1.0):
+        self.progress = manager.dict()
+        self.split_requests = manager.dict()
+        self.splits = manager.dict()
+        self.lease_owners = manager.dict()
+        self.check_interval = check_interval
+
+    def update(self, row, dispatched, count):
+        self.progress[row] = (dispatched, count)
+
+    def finish(self, row):
+        self.progress.pop(row, None)
+
+    def requested_splits(self, row):
+        return self.split_requests.get(row, 0)
+
+    def publish_splits(self, row, split_rows, lease_owner=None):
+        if lease_owner is not None:
+            self.lease_owners[row] = lease_owner
+        self.splits[row] = split_rows
+
+    def request_splits(self, row, pieces):
+        self.split_requests[row] = pieces
+
+
+class WorkStealingScheduler:
+    """Submit shards to a process pool and split the remainder of straggler shards between idle processes
+
+    Once all shards are submitted, the running shard with the most samples left is asked to stop
+    and to write its remaining samples to one sub shard per idle process.
+    The stats of the pieces are merged under the original shard id when they are all done,
+    the lease of the original shard is held by the scheduler until then.
+    """
+
+    def __init__(self, process_pool, processes_count, worker, shard_progress, min_split_size, poll_interval):
+        self.process_pool = process_pool
+        self.processes_count = processes_count
+        self.worker = worker
+        self.shard_progress = shard_progress
+        self.min_split_size = min_split_size
+        self.poll_interval = poll_interval
+        self.pending_pieces = {}
+        self.split_counts = {}
+        self.split_leases = {}
+        self.leased_shards = []
+        self.tail_start = None
+        self.end_time = None
+
+    def _merge_split_stats(self, shard_id):
+        fs, output_path = fsspec.core.url_to_fs(self.worker.output_folder)
+        shard_name = "{shard_id:0{oom_shard_count}d}".format(  # pylint: disable=consider-using-f-string
+            shard_id=shard_id, oom_shard_count=self.worker.oom_shard_count
+        )
+        stats_files = [
+            f"{output_path}/_tmp/{shard_name}_split{split_id:02d}_stats.json"
+            for split_id in range(self.split_counts[shard_id] + 1)
+        ]
+        stats = merge_stats(self.worker.output_folder, shard_id, stats_files, self.worker.oom_shard_count)
+        if self.worker.manifest is not None:
+            self.worker.manifest.add(shard_id)
+        if self.worker.stats_queue is not None:
+            self.worker.stats_queue.put(stats)
+        self._release_split_lease(shard_id)
+
+    def _release_split_lease(self, shard_id):
+        lease = self.split_leases.pop(shard_id, None)
+        if lease is not None:
+            lease.release()
+
+    def remove_failed_splits(self):
+        """Remove the outputs of the pieces of the split shards that failed, the next run redoes them unsplit
+
+        Called once all the pieces finished, the output of the original piece is overwritten by the next run
+        """
+        fs, output_path = fsspec.core.url_to_fs(self.worker.output_folder)
+        for shard_id, pending in self.pending_pieces.items():
+            if pending == 0:
+                continue
+            shard_name = "{shard_id:0{oom_shard_count}d}".format(  # pylint: disable=consider-using-f-string
+                shard_id=shard_id, oom_shard_count=self.worker.oom_shard_count
+            )
+            paths = []
+            for pattern in [
+                f"{output_path}/{shard_name}_split*",
+                f"{output_path}/_index/shards/{shard_name}_split*",
+                f"{output_path}/_tmp/{shard_name}_split*_stats.json",
+                f"{output_path}/_tmp/checkpoints/{shard_name}_split*",
+            ]:
+                paths += fs.glob(pattern)
+            print(f"shard {shard_id} failed after being split, removing the {len(paths)} outputs of its pieces")
+            if len(paths) > 0:
+                fs.rm(paths, recursive=True)
+        for shard_id in list(self.split_leases):
+            self._release_split_lease(shard_id)
+
+    def _submit_splits(self, running):
+        """Submit the sub shards published by split shards"""
+        for row, split_rows in dict(self.shard_progress.splits).items():
+            shard_id = row[0]
+            if shard_id in self.split_counts:
+                continue
+            self.split_counts[shard_id] = len(split_rows)
+            owner = self.shard_progress.lease_owners.get(row)
+            if owner is not None:
+                self.split_leases[shard_id] = self.worker.shard_leases.adopt(shard_id, owner)
+            # the original shard is a piece too
+            self.pending_pieces[shard_id] = len(split_rows) + 1
+            for split_row in split_rows:
+                running[split_row] = self.process_pool.apply_async(self.worker, (split_row,))
+
+    def _on_done(self, row, status, running, failed_shards):
+        shard_id = row[0]
+        if status == LEASED:
+            self.leased_shards.append(row)
+            return
+        # splits are published before the result of the split shard is sent
+        self._submit_splits(running)
+        if shard_id not in self.pending_pieces:
+            if status is False:
+                failed_shards.append(row)
+            return
+        if status is False:
+            if len(row) > 2:
+                failed_shards.append(row)
+            else:
+                # retrying would process the samples moved to the sub shards twice,
+                # the outputs of the pieces are removed at the end of the job, restarting the command redoes it
+                print(f"shard {shard_id} failed after being split, restart the same command to redo it")
+                self.pending_pieces[shard_id] = None
+            return
+        if self.pending_pieces[shard_id] is None:
+            return
+        self.pending_pieces[shard_id] -= 1
+        if self.pending_pieces[shard_id] == 0:
+            self._merge_split_stats(shard_id)
+
+    def _steal(self, running):
+        """Ask the running shard with the most samples left to split between the idle processes"""
+        progress = dict(self.shard_progress.progress)
+        started = [row for row in running if row in progress]
+        idle = self.processes_count - len(started)
+        if len(started) < len(running) or idle <= 0:
+            return
+        if self.tail_start is None:
+            self.tail_start = time.time()
+        candidates = [
+            (count - dispatched, row)
+            for row, (dispatched, count) in progress.items()
+            if len(row) == 2 and row[0] not in self.split_counts and row not in self.shard_progress.split_requests
+        ]
+        if len(candidates) == 0:
+            return
+        remaining, row = max(candidates)
+        if remaining >= self.min_split_size:
+            self.shard_progress.request_splits(row, idle)
+
+    def run(self, gen):
+        """Process the shards of gen, return the failed ones"""
+        rows = iter(gen)
+        running = {}
+        failed_shards = []
+        exhausted = False
+        with tqdm() as pbar:
+            while True:
+                # keep one shard queued per process so that no process waits for the sharder
+                while not exhausted and len(running) < 2 * self.processes_count:
+                    row = next(rows, None)
+                    if row is None:
+                        exhausted = True
+                    else:
+                        running[row] = self.process_pool.apply_async(self.worker, (row,))
+                for row, result in list(running.items()):
+                    if not result.ready():
+                        continue
+                    del running[row]
+                    pbar.update(1)
+                    status, _ = result.get()
+                    self._on_done(row, status, running, failed_shards)
+                self._submit_splits(running)
+                if exhausted and len(running) == 0:
+                    break
+                if exhausted:
+                    self._steal(running)
+                time.sleep(self.poll_interval)
+        self.end_time = time.time()
+        return failed_shards
+
+
+def work_stealing_distributor(
+    processes_count,
+    worker,
+    input_sharder,
+    _,
+    max_shard_retry,
+    min_split_size=100,
+    poll_interval=0.5,
+    start_method="spawn",
+):
+    """Distribute the work to the processes using multiprocessing, splitting straggler shards between idle processes"""
+    ctx = process_context(start_method)
+    with ctx.Manager() as manager, ctx.Pool(processes_count, maxtasksperchild=5) as process_pool:
+        worker.shard_progress = ShardProgress(manager)
+        scheduler = WorkStealingScheduler(
+            process_pool, processes_count, worker, worker.shard_progress, min_split_size, poll_interval
+        )
+
+        failed_shards = scheduler.run(input_sharder)
+
+        retrier(scheduler.run, failed_shards, max_shard_retry)
+        requeue_leased(scheduler.run, scheduler.leased_shards, worker, max_shard_retry)
+        scheduler.remove_failed_splits()
+
+        if scheduler.tail_start is not None:
+            tail_latency = scheduler.end_time - scheduler.tail_start
+            print(f"Job tail latency: {tail_latency:.1f}s from the first idle process to the end of the job")
+
+        process_pool.terminate()
+        process_pool.join()
+        del process_pool
+
+
+def batcher(iterable, batch_size):
+    """Group the items of an iterable in lists of batch_size items"""
+    iterator = iter(iterable)
+    for first in iterator:
+        yield list(chain([first], islice(iterator, batch_size - 1)))
+
+
+def pyspark_distributor(processes_count, worker, input_sharder, subjob_size, max_shard_retry):
+    """Distribute the work to the executors using pyspark, by subjobs of subjob_size shards"""
+
+    with _spark_session(processes_count) as spark:
+        leased_shards = []
+
+        def run(gen):
+            failed_shards = []
+            for batch in batcher(gen, subjob_size):
+                rdd = spark.sparkContext.parallelize(batch, len(batch))
+                for (status, row) in rdd.map(worker).collect():
+                    if status is False:
+                        failed_shards.append(row)
+                    elif status == LEASED:
+                        leased_shards.append(row)
+            return failed_shards
+
+        failed_shards = run(input_sharder)
+
+        retrier(run, failed_shards, max_shard_retry)
+        requeue_leased(run, leased_shards, worker, max_shard_retry)
+
+
+@contextmanager
+def _spark_session(processes_count):
+    """Use the active spark session or start a local one with processes_count executors"""
+    from pyspark.sql import SparkSession  # pylint: disable=import-outside-toplevel
+
+    spark = SparkSession.getActiveSession()
+    owned = spark is None
+    if owned:
+        print("No pyspark session found, creating a new local one!")
+        spark = (
+            SparkSession.builder.config("spark.driver.memory", "16G")
+            .master("local[" + str(processes_count) + "]")
+            .appName("urls2dataset")
+            .getOrCreate()
+        )
+    try:
+        yield spark
+    finally:
+        if owned:
+            spark.stop()
+
+
+def _ray_download(worker, row):
+    return worker(row)
+
+
+def ray_distributor(processes_count, worker, input_sharder, subjob_size, max_shard_retry):
+    """Distribute the work to the ray cluster, by subjobs of subjob_size shards
+
+    Connects to the running ray cluster if there is one, otherwise starts a local one with processes_count cpus
+    """
+    import ray  # pylint: disable=import-outside-toplevel
+
+    if not ray.is_initialized():
+        ray.init(
+            address=os.environ.get("RAY_ADDRESS"), num_cpus=None if "RAY_ADDRESS" in os.environ else processes_count
+        )
+
+    ray_download = ray.remote(num_cpus=1)(_ray_download)
+    worker_ref = ray.put(worker)
+    leased_shards = []
+
+    def run(gen):
+        failed_shards = []
+        for batch in batcher(gen, subjob_size):
+            pending = [ray_download.remote(worker_ref, row) for row in batch]
+            with tqdm(total=len(pending)) as pbar:
+                while len(pending) > 0:
+                    done, pending = ray.wait(pending)
+                    for (status, row) in ray.get(done):
+                        if status is False:
+                            failed_shards.append(row)
+                        elif status == LEASED:
+                            leased_shards.append(row)
+                    pbar.update(len(done))
+        return failed_shards
+
+    failed_shards = run(input_sharder)
+
+    retrier(run, failed_shards, max_shard_retry)
+    requeue_leased(run, leased_shards, worker, max_shard_retry)
@@ -1,22 +1,35 @@
 """the downloader module handles the downloading"""
 
+import json
 import math
 import time
 import pyarrow as pa
 import traceback
+from contextlib import ExitStack
 
 import fsspec
+from fsspec.implementations.local import LocalFileSystem
 
 from multiprocessing.pool import ThreadPool
-from threading import Semaphore
 from typing import List, Any
 import numpy as np
 
 from .data_reader import DataReader
 from .logger import CappedCounter
-from .logger import write_stats
+from .logger import write_stats, commit_json
 from .subsamplers import Subsampler
 from .filters import Filter
+from .data_writer import ThreadedSampleWriter
+from .timing import StageTimer, process_start_time
+from .profiler import ShardProfiler, should_profile
+from .concurrency import AIMDConcurrency, ConcurrencyLimiter
+from .retry import RetryQueue
+from .host_health import HOST_UNREACHABLE
+from .robots import DISALLOWED_BY_ROBOTS
+from .lease import LEASED
+
+# wall clock time of the first fetch of this process
+_FIRST_FETCH = {}
 
 
 def compute_key(key, shard_id, oom_sample_per_shard, oom_shard_count):
@@ -60,7 +73,26 @@ class DownloadWorker:
         postprocess_func,
         common_crawl,
         filters_config,
-        clean_text
+        clean_text,
+        writer_queue_size=100,
+        shard_leases=None,
+        checkpoint_interval=None,
+        manifest=None,
+        stats_queue=None,
+        profile=False,
+        profile_fraction=0.05,
+        adaptive_concurrency=False,
+        min_thread_count=1,
+        max_thread_count=None,
+        url_retries=2,
+        max_retries_per_shard=1000,
+        retry_backoff=1.0,
+        max_retry_delay=60.0,
+        host_failure_threshold=5,
+        host_cooldown=60.0,
+        robots=None,
+        max_buffered_bytes=None,
+        shard_compression=None,
     ) -> None:
         self.sample_writer_class = sample_writer_class
         self.save_caption = save_caption
@@ -73,8 +105,37 @@ class DownloadWorker:
         self.config = config
         self.postprocess_func = postprocess_func
         self.filters_config = filters_config
-        self.data_reader = DataReader(timeout, tmp_dir=tmp_dir, config=config, common_crawl=common_crawl)
+        self.data_reader = DataReader(
+            timeout,
+            tmp_dir=tmp_dir,
+            config=config,
+            common_crawl=common_crawl,
+            host_failure_threshold=host_failure_threshold,
+            host_cooldown=host_cooldown,
+            robots=robots,
+        )
         self.clean_text = clean_text
+        self.writer_queue_size = writer_queue_size
+        self.shard_leases = shard_leases
+        self.checkpoint_interval = checkpoint_interval
+        self.manifest = manifest
+        # stats of committed shards are pushed to the logger process
+        self.stats_queue = stats_queue
+        self.profile = profile
+        self.profile_fraction = profile_fraction
+        # thread_count is then the starting concurrency of each shard
+        self.adaptive_concurrency = adaptive_concurrency
+        self.min_thread_count = min_thread_count
+        self.max_thread_count = max_thread_count or 4 * thread_count
+        self.url_retries = url_retries
+        self.max_retries_per_shard = max_retries_per_shard
+        self.retry_backoff = retry_backoff
+        self.max_retry_delay = max_retry_delay
+        self.max_buffered_bytes = max_buffered_bytes
+        # compression of the sub shards of split shards, like the input shards
+        self.shard_compression = shard_compression
+        # set by the work stealing distributor to report progress and receive split requests
+        self.shard_progress = None
         if clean_text:
             self.proc_text = TextCleaner()
 
@@ -83,26 +144,145 @@ class DownloadWorker:
         self,
         row,
     ):
+        lease = None
         try:
-            self.download_shard(row)
+            # sub shards of a split shard run under the lease of their shard
+            if self.shard_leases is not None and len(row) == 2:
+                lease = self.shard_leases.claim(row[0])
+                if lease is None:
+                    if not self.shard_leases.is_done(row[0]):
+                        print(f"shard {row[0]} is claimed by another worker, it will be claimed again later")
+                        return (LEASED, row)
+                    print(f"shard {row[0]} is done, skipping it")
+                    fs, shard_path = fsspec.core.url_to_fs(row[1])
+                    fs.rm(shard_path)
+                    return (True, row)
+            if self.profile and should_profile(row[0], self.profile_fraction):
+                self.profile_shard(row, lease)
+            else:
+                self.download_shard(row, lease=lease)
             return (True, row)
         except Exception as err:  # pylint: disable=broad-except
             traceback.print_exc()
             print(f"shard {row[0]} failed with error {err}")
             return (False, row)
+        finally:
+            if lease is not None and lease.handed_over:
+                lease.stop()
+            elif lease is not None:
+                lease.release()
+            if self.shard_progress is not None:
+                self.shard_progress.finish(row)
+
+    def profile_shard(self, row, lease=None):
+        """Download a shard under cProfile, the profile is written next to the shard stats"""
+        profiler = ShardProfiler()
+        with profiler.profile():
+            self.download_shard(row, profiler, lease)
+        profile_name = "{shard_id:0{oom_shard_count}d}".format(  # pylint: disable=consider-using-f-string
+            shard_id=row[0], oom_shard_count=self.oom_shard_count
+        )
+        if len(row) > 2:
+            profile_name += f"_split{row[2]:02d}"
+        profiler.dump(f"{self.output_folder}/{profile_name}_profile.prof")
+
+    def split_shard(self, shard_id, shard_file, keys, pieces, scratch_bytes):
+        """Write the rows of keys to pieces sub shards next to the shard file, return their rows"""
+        fs, shard_path = fsspec.core.url_to_fs(shard_file)
+        with fs.open(shard_path, "rb") as f:
+            df = pa.ipc.open_file(f).read_all()
+            scratch_bytes["read"] += f.size
+        df = df.take(pa.array(keys)).append_column("__key__", pa.array(keys, pa.int64()))
+        split_rows = []
+        for i, indices in enumerate(np.array_split(np.arange(len(keys)), pieces)):
+            split_id = i + 1
+            split_file = shard_file.rsplit(".", 1)[0] + f"_split{split_id:02d}.feather"
+            split_df = df.take(pa.array(indices))
+            fs, split_path = fsspec.core.url_to_fs(split_file)
+            with fs.open(split_path, "wb") as f:
+                options = pa.ipc.IpcWriteOptions(compression=self.shard_compression)
+                with pa.ipc.new_file(f, split_df.schema, options=options) as writer:
+                    writer.write_table(split_df)
+                scratch_bytes["written"] += f.tell()
+            split_rows.append((shard_id, split_file, split_id))
+        return split_rows
+
+    def _checkpoint_file(self, output_path, name):
+        return f"{output_path}/_tmp/checkpoints/{name}.json"
+
+    def load_checkpoint(self, name):
+        """Return the last checkpoint of a shard and remove the parts written after it
+
+        A shard without checkpoint gets an empty one, so that a crash before the first checkpoint
+        also leaves a trace that parts may have to be cleaned up.
+        """
+        fs, output_path = fsspec.core.url_to_fs(self.output_folder)
+        checkpoint_file = self._checkpoint_file(output_path, name)
+        if not fs.exists(checkpoint_file):
+            checkpoint = {"keys": [], "parts": 0, "successes": 0, "failed_to_download": 0}
+            checkpoint.update({"failed_to_subsample": 0, "bytes_downloaded": 0, "status_dict": {}})
+            checkpoint.update({"retried_samples": 0, "recovered_successes": 0, "short_circuited": 0})
+            checkpoint["disallowed_by_robots"] = 0
+            checkpoint["failed_to_write"] = 0
+            fs.makedirs(f"{output_path}/_tmp/checkpoints", exist_ok=True)
+            commit_json(fs, checkpoint_file, checkpoint)
+            return checkpoint
+        with fs.open(checkpoint_file, "r") as f:
+            checkpoint = json.load(f)
+        print(f"resuming shard {name} from its checkpoint, {len(checkpoint['keys'])} samples are already done")
+        stale_parts = fs.glob(f"{output_path}/{name}_[0-9][0-9][0-9][0-9]*") + fs.glob(
+            f"{output_path}/_index/shards/{name}_[0-9][0-9][0-9][0-9]*"
+        )
+        for stale_part in stale_parts:
+            if int(stale_part.split("/")[-1][len(name) + 1 : len(name) + 5]) >= checkpoint["parts"]:
+                fs.rm(stale_part, recursive=True)
+        return checkpoint
+
+    def write_checkpoint(self, name, checkpoint):
+        fs, output_path = fsspec.core.url_to_fs(self.output_folder)
+        commit_json(fs, self._checkpoint_file(output_path, name), checkpoint)
+
+    def remove_checkpoint(self, name):
+        fs, output_path = fsspec.core.url_to_fs(self.output_folder)
+        fs.rm(self._checkpoint_file(output_path, name))
 
     def download_shard(
         self,
         row,
+        profiler=None,
+        lease=None,
     ):
-        """Function to start an video downloading in one process"""
+        """Function to start an video downloading in one process
+
+        The shard is abandoned as soon as its lease is lost, another worker then owns its output files
+        """
 
-        shard_id, shard_file = row
+        shard_id, shard_file = row[:2]
+        # sub shards of a split shard carry their split number and the original keys of their rows
+        split_id = row[2] if len(row) > 2 else None
         start_time = time.time()
+        shard_name = "{shard_id:0{oom_shard_count}d}".format(  # pylint: disable=consider-using-f-string
+            shard_id=shard_id, oom_shard_count=self.oom_shard_count
+        )
 
         fs, shard_path = fsspec.core.url_to_fs(shard_file)
-        with fs.open(shard_path, "rb") as f:
-            df = pa.ipc.open_file(f).read_all()
+        if isinstance(fs, LocalFileSystem):
+            # pages of an uncompressed mapped shard are shared with the page cache, only the ones in use count in
+            # the rss, compressed buffers are decompressed in memory
+            source = pa.memory_map(shard_path)
+            df = pa.ipc.open_file(source).read_all()
+            shard_bytes = source.size()
+        else:
+            with fs.open(shard_path, "rb") as f:
+                df = pa.ipc.open_file(f).read_all()
+                shard_bytes = f.size
+        # the sharder wrote the shard once, the worker reads it, split shards are read again and their pieces written
+        scratch_bytes = {"written": shard_bytes if split_id is None else 0, "read": shard_bytes}
+        if split_id is not None:
+            keys = df["__key__"].to_pylist()
+            df = df.drop_columns(["__key__"])
+        else:
+            keys = range(df.num_rows)
         schema = df.schema
         schema = (
             schema.append(pa.field("key", pa.string()))
@@ -116,30 +296,102 @@ class DownloadWorker:
             schema = schema.append(pa.field("postproc_value", pa.binary()))
         schema = schema.append(pa.field("language", pa.string()))
 
-        pydict = df.select(self.column_list).to_pydict()
-        shard_to_dl = list(enumerate(zip(*(pydict[col] for col in self.column_list))))
-        del pydict
+        # the shard stays an arrow table, the values of a sample become python objects only while it's processed
+        columns = [df[col] for col in self.column_list]
+        url_column = df["url"]
         del df
+        rows = None if split_id is None else {key: i for i, key in enumerate(keys)}
+
+        def sample_values(key):
+            i = key if rows is None else rows[key]
+            return [column[i].as_py() for column in columns]
+
+        def sample_url(key):
+            return url_column[key if rows is None else rows[key]].as_py()
 
         status_dict = CappedCounter()
 
-        count = len(shard_to_dl)
+        count = len(keys)
         successes = 0
         failed_to_download = 0
         failed_to_subsample = 0
         bytes_downloaded = 0
-        url_indice = self.column_list.index("url")
+        retried_samples = 0
+        recovered_successes = 0
+        short_circuited = 0
+        disallowed_by_robots = 0
+        failed_to_write = 0
         caption_indice = self.column_list.index("caption") if "caption" in self.column_list else None
-        key_url_list = [(key, x[url_indice]) for key, x in shard_to_dl]
-
-        semaphore = Semaphore(self.thread_count)
-
-        if self.common_crawl:
-            pass
+        pending_keys = keys
+
+        writer_name = shard_name if split_id is None else f"{shard_name}_split{split_id:02d}"
+        writer_kwargs = {}
+        processed_keys: List[int] = []
+        if self.checkpoint_interval is not None:
+            # the output parts written before the last checkpoint are kept, their samples aren't downloaded again
+            checkpoint = self.load_checkpoint(writer_name)
+            processed_keys = checkpoint["keys"]
+            done_keys = set(processed_keys)
+            pending_keys = [key for key in keys if key not in done_keys]
+            successes = checkpoint["successes"]
+            failed_to_download = checkpoint["failed_to_download"]
+            failed_to_subsample = checkpoint["failed_to_subsample"]
+            bytes_downloaded = checkpoint["bytes_downloaded"]
+            retried_samples = checkpoint["retried_samples"]
+            recovered_successes = checkpoint["recovered_successes"]
+            short_circuited = checkpoint["short_circuited"]
+            disallowed_by_robots = checkpoint["disallowed_by_robots"]
+            failed_to_write = checkpoint.get("failed_to_write", 0)
+            status_dict = CappedCounter.load(checkpoint["status_dict"])
+            writer_kwargs["first_part"] = checkpoint["parts"]
+        resumed_count = len(processed_keys)
+        last_checkpoint = resumed_count
+
+        # bound the samples handed to the thread pool, the rest stays available for splitting
+        if self.adaptive_concurrency:
+            limiter = AIMDConcurrency(
+                self.thread_count, self.min_thread_count, self.max_thread_count, max_bytes=self.max_buffered_bytes
+            )
+            pool_size = self.max_thread_count
+        else:
+            limiter = ConcurrencyLimiter(2 * self.thread_count, self.max_buffered_bytes)
+            pool_size = self.thread_count
+        # samples that failed transiently, fetched again after the fresh ones
+        retries = RetryQueue(self.url_retries, self.max_retries_per_shard, self.retry_backoff, self.max_retry_delay)
+        split_rows = []
+        moved_keys = []
+        if self.shard_progress is not None:
+            self.shard_progress.update(row, resumed_count, count)
 
         def data_generator():
-            for e in key_url_list:
-                # semaphore.acquire()  # pylint: disable=(consider-using-with)
+            last_check = time.perf_counter()
+            for i, key in enumerate(pending_keys, start=resumed_count):
+                if not limiter.acquire():
+                    return
+                if (
+                    self.shard_progress is not None
+                    and split_id is None
+                    and time.perf_counter() - last_check > self.shard_progress.check_interval
+                ):
+                    last_check = time.perf_counter()
+                    self.shard_progress.update(row, i, count)
+                    pieces = self.shard_progress.requested_splits(row)
+                    if 0 < pieces <= count - i:
+                        moved_keys.extend(pending_keys[i - resumed_count :])
+                        split_rows.extend(self.split_shard(shard_id, shard_file, moved_keys, pieces, scratch_bytes))
+                        # the scheduler keeps the lease of the shard until the stats of its pieces are merged
+                        self.shard_progress.publish_splits(row, split_rows, lease.owner if lease is not None else None)
+                        if lease is not None:
+                            lease.handed_over = True
+                        limiter.release()
+                        break
+                retries.started()
+                yield key, sample_url(key)
+            while True:
+                e = retries.next()
+                if e is None or not limiter.acquire():
+                    return
+                retries.started()
                 yield e
 
         loader = data_generator()
@@ -150,23 +402,63 @@ class DownloadWorker:
         except:
             _filters = [lambda x: True]
 
-        # give schema to writer
-        sample_writer = self.sample_writer_class(
-            shard_id,
-            self.output_folder,
-            self.save_caption,
-            self.oom_shard_count,
-            schema,
+        # per sample time spent in each stage, written to the stats as histograms
+        timer = StageTimer()
+
+        # give schema to writer, writes happen on a separate thread so slow outputs don't stall the fetches
+        sample_writer = ThreadedSampleWriter(
+            self.sample_writer_class(
+                shard_id if split_id is None else writer_name,
+                self.output_folder,
+                self.save_caption,
+                self.oom_shard_count,
+                schema,
+                **writer_kwargs,
+            ),
+            self.writer_queue_size,
+            timer=timer,
+            profiler=profiler,
         )
         oom_sample_per_shard = math.ceil(math.log10(self.number_sample_per_shard))
-
-        with ThreadPool(self.thread_count) as thread_pool:
-            for key, texts, media, error_message in thread_pool.imap_unordered(
-                self.data_reader,  # pylint: disable=(unnecessary-lambda)
-                loader,
-            ):
+        reader = self.data_reader if profiler is None else profiler.wrap(self.data_reader)
+
+        def count_write_failures():
+            """Count the samples that failed to write as failures instead of successes"""
+            nonlocal successes, failed_to_write
+            for _ in sample_writer.take_write_failures():
+                successes -= 1
+                failed_to_write += 1
+                status_dict.counter["success"] -= 1
+                status_dict.increment("failed_to_write")
+
+        # the first shard of a process reports how long the process took from its start to its first fetch
+        first_shard = "time" not in _FIRST_FETCH
+
+        def fetch(sample):
+            _FIRST_FETCH.setdefault("time", time.time())
+            # results wait in the pool until the loop below processes them, their text counts in the byte budget
+            result = reader(sample, timer=timer)
+            limiter.add_bytes(len(result[1] or ""))
+            return result
+
+        # if the loop fails, the generator must be unblocked before the pool terminates, it waits for it
+        with ThreadPool(pool_size) as thread_pool, ExitStack() as stack:
+            stack.callback(limiter.close)
+            stack.callback(retries.close)
+            # a failed loop stops the writer thread and closes the output files, it's a no-op after close()
+            stack.callback(sample_writer.abort)
+            for key, texts, media, error_message, retry_after in thread_pool.imap_unordered(fetch, loader):
+                if lease is not None and lease.lost:
+                    raise RuntimeError(f"lease of shard {shard_id} was lost, abandoning it")
+                result_bytes = len(texts or "")
+                limiter.record(error_message is not None)
+                if retry_after is not None and retries.schedule((key, sample_url(key)), key, retry_after):
+                    limiter.release(result_bytes)
+                    retries.finished()
+                    continue
+                processed_keys.append(key)
                 try:
-                    _, sample_data = shard_to_dl[key]
+                    sample_data = sample_values(key)
                     str_key = compute_key(key, shard_id, oom_sample_per_shard, self.oom_shard_count)
                     meta = {
                         **{self.column_list[i]: sample_data[i] for i in range(len(self.column_list))},
@@ -179,6 +471,13 @@ class DownloadWorker:
 
                         failed_to_download += 1
                         status = "failed_to_download"
+                        if error_message == HOST_UNREACHABLE:
+                            # the circuit of the host was open, it wasn't fetched
+                            short_circuited += 1
+                            status = HOST_UNREACHABLE
+                        elif error_message == DISALLOWED_BY_ROBOTS:
+                            disallowed_by_robots += 1
+                            status = DISALLOWED_BY_ROBOTS
                         status_dict.increment(error_message)
                         meta["status"] = status
                         sample_writer.write(
@@ -187,11 +486,13 @@ class DownloadWorker:
                             sample_data[caption_indice] if caption_indice is not None else None,
                             meta,
                         )
-                        semaphore.release()
+                        limiter.release(result_bytes)
+                        retries.finished()
                         continue
 
                     if self.postprocess_func is not None:
-                        value, error_message = subsampler(texts)
+                        with timer.time("postprocess"):
+                            value, error_message = subsampler(texts)
                         if error_message is None:
                             meta["postproc_value"] = value
                         else:
@@ -201,18 +502,22 @@ class DownloadWorker:
 
                     metas = [meta]
                     sample = {**meta, "text": texts}
-                    for _filter in _filters:
-                        if _filter(sample):
-                            continue
+                    with timer.time("filters"):
+                        for _filter in _filters:
+                            if _filter(sample):
+                                continue
 
                     successes += 1
+                    if retries.is_retry(key):
+                        recovered_successes += 1
                     status = "success"
                     status_dict.increment(status)
 
                     meta["status"] = status
 
                     if self.clean_text:
-                        texts = self.proc_text(texts, lang=media['language'])
+                        with timer.time("pii"):
+                            texts = self.proc_text(texts, lang=media['language'])
 
                     text_caption = sample_data[caption_indice] if caption_indice is not None else None
                     sample_writer.write(
@@ -224,17 +529,57 @@ class DownloadWorker:
                 except Exception as err:  # pylint: disable=broad-except
                     traceback.print_exc()
                     print(f"Sample {key} failed to download: {err}")
-                semaphore.release()
+                limiter.release(result_bytes)
+                retries.finished()
+
+                if (
+                    self.checkpoint_interval is not None
+                    and len(processed_keys) - last_checkpoint >= self.checkpoint_interval
+                ):
+                    # close the current part so that everything the checkpoint points to is complete
+                    parts = sample_writer.roll()
+                    count_write_failures()
+                    self.write_checkpoint(
+                        writer_name,
+                        {
+                            "keys": processed_keys,
+                            "parts": parts,
+                            "successes": successes,
+                            "failed_to_download": failed_to_download,
+                            "failed_to_subsample": failed_to_subsample,
+                            "bytes_downloaded": bytes_downloaded,
+                            "status_dict": status_dict.dump(),
+                            "retried_samples": retried_samples + retries.retried,
+                            "recovered_successes": recovered_successes,
+                            "short_circuited": short_circuited,
+                            "disallowed_by_robots": disallowed_by_robots,
+                            "failed_to_write": failed_to_write,
+                        },
+                    )
+                    last_checkpoint = len(processed_keys)
 
             sample_writer.close()
+            count_write_failures()
             thread_pool.terminate()
             thread_pool.join()
             del thread_pool
 
+        if lease is not None and lease.lost:
+            raise RuntimeError(f"lease of shard {shard_id} was lost, abandoning it")
         end_time = time.time()
-        write_stats(
-            self.output_folder,
-            shard_id,
+        startup_stats = {}
+        process_start = process_start_time()
+        if first_shard and "time" in _FIRST_FETCH and process_start is not None:
+            startup_stats["startup_latency"] = _FIRST_FETCH["time"] - process_start
+        stats_folder, stats_shard_id = self.output_folder, shard_id
+        if split_id is not None or len(split_rows) > 0:
+            # the stats of the pieces of a split shard are merged by the distributor once all are done
+            count -= len(moved_keys)
+            stats_folder = self.output_folder + "/_tmp"
+            stats_shard_id = f"{shard_name}_split{split_id or 0:02d}"
+        stats = write_stats(
+            stats_folder,
+            stats_shard_id,
             count,
             successes,
             failed_to_download,
@@ -244,5 +589,32 @@ class DownloadWorker:
             end_time,
             status_dict,
             self.oom_shard_count,
+            extra_stats={
+                "writer_blocked_time": sample_writer.blocked_time,
+                "output_parts": getattr(sample_writer.sample_writer, "parts", 1),
+                "resumed_samples": resumed_count,
+                "stage_timings": timer.summary(),
+                "concurrency_trajectory": limiter.trajectory(),
+                # retries scheduled, and successes that took more than one attempt (they are also in successes)
+                "retried_samples": retried_samples + retries.retried,
+                "recovered_successes": recovered_successes,
+                # failed without a fetch because the circuit of their host was open, they are in failed_to_download
+                "short_circuited": short_circuited,
+                "disallowed_by_robots": disallowed_by_robots,
+                # downloaded samples whose write failed, they aren't in successes
+                "failed_to_write": failed_to_write,
+                # most text held by fetched samples waiting for the loop, bounded by max_buffered_bytes
+                "peak_buffered_bytes": limiter.peak_bytes,
+                "scratch_bytes_written": scratch_bytes["written"],
+                "scratch_bytes_read": scratch_bytes["read"],
+                **startup_stats,
+            },
         )
+        if stats_folder == self.output_folder:
+            if self.manifest is not None:
+                self.manifest.add(shard_id)
+            if self.stats_queue is not None:
+                self.stats_queue.put(stats)
+        if self.checkpoint_interval is not None:
+            self.remove_checkpoint(writer_name)
         fs.rm(shard_path)
@@ -0,0 +1,31 @@
+"""encoding module decodes html pages, trusting a declared charset before detecting one"""
+
+import re
+
+from resiliparse.parse import bytes_to_str, detect_encoding
+from resiliparse.parse.encoding import map_encoding_to_html5
+
+CHARSET_RE = re.compile(r"charset\s*=\s*[\"']?([^\s;\"']+)", re.IGNORECASE)
+# statistical detection reads at most that much of the start of a page
+DETECT_BYTES = 16 * 1024
+
+
+def header_charset(content_type):
+    """WHATWG name of the charset of a Content-Type header, None if it has none or an unknown one"""
+    match = CHARSET_RE.search(content_type or "")
+    if match is None:
+        return None
+    return map_encoding_to_html5(match.group(1), fallback_utf8=False)
+
+
+def decode_html(html_bytes, content_type=None):
+    """Decode a page, return its text and encoding
+
+    The charset of the Content-Type header is used if valid, then a meta charset in the first 1024 bytes,
+    then a detection on the first DETECT_BYTES. Undecodable bytes never fail the page, bytes_to_str falls back
+    to utf-8 and cp1252 and drops what still can't be decoded.
+    """
+    encoding = header_charset(content_type)
+    if encoding is None:
+        encoding = detect_encoding(html_bytes[:DETECT_BYTES], max_len=0, from_html_meta=True)
+    return bytes_to_str(html_bytes, encoding), encoding
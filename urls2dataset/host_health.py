@@ -0,0 +1,67 @@
+"""host_health module stops fetching from hosts that keep failing to connect or timing out"""
+
+import threading
+import time
+
+HOST_UNREACHABLE = "host_unreachable"
+
+
+class CircuitBreaker:
+    """Health of the hosts fetched by a process
+
+    After failure_threshold consecutive connect failures or timeouts of a host its circuit opens and its fetches
+    are short circuited. After cooldown seconds the circuit is half open, one fetch goes through as a probe,
+    its success closes the circuit and its failure opens it for another cooldown.
+    """
+
+    def __init__(self, failure_threshold=5, cooldown=60.0):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.lock = threading.Lock()
+        self.failures = {}
+        # host to the time its circuit opened, and to whether its probe is running
+        self.opened = {}
+        self.probing = set()
+
+    def allow(self, host):
+        """Whether a fetch of host may go through"""
+        with self.lock:
+            opened = self.opened.get(host)
+            if opened is None:
+                return True
+            if host in self.probing or time.monotonic() - opened < self.cooldown:
+                return False
+            self.probing.add(host)
+            return True
+
+    def success(self, host):
+        with self.lock:
+            self.failures.pop(host, None)
+            self.probing.discard(host)
+            if self.opened.pop(host, None) is not None:
+                print(f"host {host} is reachable again, closing its circuit")
+
+    def failure(self, host):
+        with self.lock:
+            self.failures[host] = self.failures.get(host, 0) + 1
+            if host in self.probing or (host not in self.opened and self.failures[host] >= self.failure_threshold):
+                if host not in self.opened:
+                    print(f"host {host} failed {self.failures[host]} times in a row, opening its circuit")
+                self.probing.discard(host)
+                self.opened[host] = time.monotonic()
+
+
+_BREAKERS = {}
+_BREAKERS_LOCK = threading.Lock()
+
+
+def host_breaker(failure_threshold, cooldown):
+    """The circuit breaker of this process, shared by the shards it downloads
+
+    Created on first use, workers are pickled to the processes and locks can't be
+    """
+    with _BREAKERS_LOCK:
+        key = (failure_threshold, cooldown)
+        if key not in _BREAKERS:
+            _BREAKERS[key] = CircuitBreaker(failure_threshold, cooldown)
+        return _BREAKERS[key]
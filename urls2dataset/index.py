@@ -0,0 +1,205 @@
+"""index module maps sample keys and urls to their location in the output shards"""
+
+import hashlib
+import io
+import json
+import tarfile
+
+import fsspec
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+
+INDEX_SCHEMA = pa.schema(
+    [
+        pa.field("key", pa.string()),
+        pa.field("url", pa.string()),
+        pa.field("file", pa.string()),
+        pa.field("offset", pa.int64()),
+        pa.field("length", pa.int64()),
+        pa.field("row_group", pa.int32()),
+        pa.field("row", pa.int32()),
+    ]
+)
+
+
+def hash_strings(strings):
+    """64 bits hashes of strings, stable across processes and runs"""
+    digests = b"".join(hashlib.blake2b(s.encode("utf-8"), digest_size=8).digest() for s in strings)
+    return np.frombuffer(digests, dtype="<u8")
+
+
+class ShardIndexWriter:
+    """Collect the location of the samples of one output file and write them to _index/shards on close
+
+    Tar samples are located by (offset, length) in bytes, parquet samples by (row_group, row),
+    arrow samples by (record batch, row) and jsonl.zst samples by line
+    """
+
+    def __init__(self, output_folder, shard_name):
+        self.output_file = f"{output_folder}/_index/shards/{shard_name}.parquet"
+        self.columns = {k: [] for k in INDEX_SCHEMA.names}
+
+    def add(self, key, url, file, offset=None, length=None, row_group=None, row=None):
+        for k, v in zip(INDEX_SCHEMA.names, (key, url, file, offset, length, row_group, row)):
+            self.columns[k].append(v)
+
+    def close(self):
+        fs, output_path = fsspec.core.url_to_fs(self.output_file)
+        fs.makedirs(output_path.rsplit("/", 1)[0], exist_ok=True)
+        with fs.open(output_path, "wb") as f:
+            pq.write_table(pa.Table.from_pydict(self.columns, INDEX_SCHEMA), f)
+
+
+def _read_array(fs, path):
+    with fs.open(path, "rb") as f:
+        return np.load(io.BytesIO(f.read()))
+
+
+def _load_merged_index(fs, output_path, shard_sizes):
+    """Return the shard indices merged in the global index, the index, its key hashes and the url hash of its rows
+
+    None when there is no global index or one of its shard indices was removed or rewritten since it was built
+    """
+    merged_file = f"{output_path}/_index/merged_shards.json"
+    if not fs.exists(merged_file):
+        return None
+    with fs.open(merged_file, "r") as f:
+        merged_sizes = json.load(f)
+    if any(shard_sizes.get(name) != size for name, size in merged_sizes.items()):
+        return None
+    with fs.open(output_path + "/_index/index.parquet", "rb") as f:
+        table = pq.read_table(f)
+    key_hashes = _read_array(fs, output_path + "/_index/key_hashes.npy")
+    url_order = _read_array(fs, output_path + "/_index/url_order.npy")
+    url_hashes = np.empty_like(key_hashes)
+    url_hashes[url_order] = _read_array(fs, output_path + "/_index/url_hashes.npy")
+    return merged_sizes, table, key_hashes, url_hashes
+
+
+def build_index(output_folder, rebuild=False):
+    """Merge the shard indices into a global index sorted by key hash
+
+    Writes _index/index.parquet and the sorted key hashes to _index/key_hashes.npy,
+    url hashes are sorted separately in _index/url_hashes.npy with the matching rows in _index/url_order.npy.
+    The shard indices merged so far are listed with their size in _index/merged_shards.json,
+    only the new ones are read on the next call, unless rebuild is set or a merged one changed.
+    Without any shard index (all the shards failed) the index is empty.
+    """
+    fs, output_path = fsspec.core.url_to_fs(output_folder)
+    fs.makedirs(output_path + "/_index", exist_ok=True)
+    shard_sizes = {
+        path.split("/")[-1]: info["size"]
+        for path, info in fs.glob(output_path + "/_index/shards/*.parquet", detail=True).items()
+    }
+    merged = None if rebuild else _load_merged_index(fs, output_path, shard_sizes)
+    if merged is None:
+        no_hashes = np.empty(0, dtype="<u8")
+        merged_sizes, table, key_hashes, url_hashes = {}, INDEX_SCHEMA.empty_table(), no_hashes, no_hashes
+    else:
+        merged_sizes, table, key_hashes, url_hashes = merged
+    new_shards = sorted(name for name in shard_sizes if name not in merged_sizes)
+    if len(shard_sizes) == 0:
+        print(f"No shard index in {output_folder}, writing an empty index")
+    elif len(new_shards) == 0:
+        print(f"The index of {output_folder} is up to date")
+        return table.num_rows
+
+    tables = [table]
+    for name in new_shards:
+        with fs.open(f"{output_path}/_index/shards/{name}", "rb") as f:
+            tables.append(pq.read_table(f))
+    new_table = pa.concat_tables(tables[1:]) if len(tables) > 1 else INDEX_SCHEMA.empty_table()
+    table = pa.concat_tables(tables)
+    key_hashes = np.concatenate([key_hashes, hash_strings(new_table["key"].to_pylist())])
+    url_hashes = np.concatenate([url_hashes, hash_strings(new_table["url"].to_pylist())])
+    # the merged rows are already sorted, the stable sort mostly merges them with the new ones
+    order = np.argsort(key_hashes, kind="stable")
+    table = table.take(pa.array(order))
+    key_hashes = key_hashes[order]
+    url_hashes = url_hashes[order]
+    url_order = np.argsort(url_hashes, kind="stable")
+
+    # a build interrupted after this point starts over from all the shard indices
+    if fs.exists(output_path + "/_index/merged_shards.json"):
+        fs.rm(output_path + "/_index/merged_shards.json")
+    with fs.open(output_path + "/_index/index.parquet", "wb") as f:
+        pq.write_table(table, f)
+    for name, array in [("key_hashes", key_hashes), ("url_hashes", url_hashes[url_order]), ("url_order", url_order)]:
+        with fs.open(f"{output_path}/_index/{name}.npy", "wb") as f:
+            np.save(f, array)
+    with fs.open(output_path + "/_index/merged_shards.json", "w") as f:
+        json.dump(shard_sizes, f)
+    return table.num_rows
+
+
+class DatasetIndex:
+    """Look up samples of an output folder by key or url using the global index built by build_index"""
+
+    def __init__(self, output_folder):
+        self.output_folder = output_folder
+        self.fs, self.output_path = fsspec.core.url_to_fs(output_folder)
+        with self.fs.open(self.output_path + "/_index/index.parquet", "rb") as f:
+            self.table = pq.read_table(f)
+        self.key_hashes = self._load_array("key_hashes")
+        self.url_hashes = self._load_array("url_hashes")
+        self.url_order = self._load_array("url_order")
+
+    def _load_array(self, name):
+        path = f"{self.output_path}/_index/{name}.npy"
+        if "file" in self.fs.protocol:
+            return np.load(path, mmap_mode="r")
+        with self.fs.open(path, "rb") as f:
+            return np.load(io.BytesIO(f.read()))
+
+    def _rows(self, hashes, value):
+        h = hash_strings([value])[0]
+        start = np.searchsorted(hashes, h, side="left")
+        end = np.searchsorted(hashes, h, side="right")
+        return range(start, end)
+
+    def lookup(self, key=None, url=None):
+        """Return the index entries (as dicts) matching a key or an url"""
+        if (key is None) == (url is None):
+            raise ValueError("Exactly one of key and url must be given")
+        if key is not None:
+            rows = list(self._rows(self.key_hashes, key))
+            column, value = "key", key
+        else:
+            rows = [int(self.url_order[i]) for i in self._rows(self.url_hashes, url)]
+            column, value = "url", url
+        entries = self.table.take(pa.array(rows, pa.int64())).to_pylist()
+        # hashes may collide, check the actual value
+        return [e for e in entries if e[column] == value]
+
+    def read(self, entry):
+        """Read the sample of an index entry
+
+        Returns a dict of member name to bytes for tars and files, a row dict for parquet, arrow and jsonl.zst
+        """
+        path = f"{self.output_path}/{entry['file']}"
+        with self.fs.open(path, "rb") as f:
+            if entry["file"].endswith(".tar"):
+                f.seek(entry["offset"])
+                data = f.read(entry["length"])
+                sample = {}
+                with tarfile.open(fileobj=io.BytesIO(data)) as tar:
+                    for member in tar.getmembers():
+                        sample[member.name.split(".", 1)[1]] = tar.extractfile(member).read()
+                return sample
+            if entry["file"].endswith(".parquet"):
+                row_group = pq.ParquetFile(f).read_row_group(entry["row_group"])
+                return row_group.slice(entry["row"], 1).to_pylist()[0]
+            if entry["file"].endswith(".arrow"):
+                reader = pa.ipc.open_stream(f)
+                for _ in range(entry["row_group"]):
+                    reader.read_next_batch()
+                return reader.read_next_batch().slice(entry["row"], 1).to_pylist()[0]
+            if entry["file"].endswith(".jsonl.zst"):
+                with pa.CompressedInputStream(pa.PythonFile(f, mode="r"), "zstd") as stream:
+                    for i, line in enumerate(io.TextIOWrapper(stream, encoding="utf-8")):
+                        if i == entry["row"]:
+                            return json.loads(line)
+                raise IndexError(f"{entry['file']} has no line {entry['row']}")
+            return {entry["file"].split(".", 1)[1]: f.read()}
@@ -7,11 +7,9 @@ import time
 import pyarrow.parquet as pq
 import pyarrow.csv as csv_pq
 import pyarrow as pa
-import pandas as pd
-from fastwarc import ArchiveIterator
 import fsspec
 import io
-from resiliparse.parse import detect_encoding, bytes_to_str
+from .encoding import decode_html
 import time
 import uuid
 
@@ -29,6 +27,8 @@ class InputSharder:
     - save_additional_columns: the list of additional columns to save
     - number_sample_per_shard: the number of samples per shard
     - done_shards: a set of already done shards
+    - tmp_path: the folder the shards are written to, created if needed
+    - compression: the IPC compression of the shards, lz4 or zstd, None to write them uncompressed
     """
 
     def __init__(
@@ -42,6 +42,7 @@ class InputSharder:
         done_shards,
         tmp_path,
         sampler=lambda x: x,
+        compression=None,
     ) -> None:
         self.input_format = input_format
         self.url_col = url_col
@@ -51,6 +52,7 @@ class InputSharder:
         self.done_shards = done_shards
         self.shard_sampler = sampler
         self.tmp_path = tmp_path
+        self.compression = compression
 
         if self.input_format != "cc":
             fs, url_path = fsspec.core.url_to_fs(url_list)
@@ -83,8 +85,12 @@ class InputSharder:
                 if self.input_format == "txt":
                     df = csv_pq.read_csv(file, read_options=csv_pq.ReadOptions(column_names=["url"]))
                 elif self.input_format == "json":
+                    import pandas as pd  # pylint: disable=import-outside-toplevel
+
                     df = pa.Table.from_pandas(pd.read_json(file))
                 elif self.input_format == "csv":
+                    import pandas as pd  # pylint: disable=import-outside-toplevel
+
                     df = pa.Table.from_pandas(pd.read_csv(file))
                 elif self.input_format == "tsv":
                     df = csv_pq.read_csv(file, parse_options=csv_pq.ParseOptions(delimiter="\t"))
@@ -105,6 +111,7 @@ class InputSharder:
                 df = pq.read_table(file, columns=columns_to_read)
 
         elif self.input_format == "cc":
+            from fastwarc import ArchiveIterator  # pylint: disable=import-outside-toplevel
 
             html = []
             with fsspec.open(input_file, mode="rb", compression="gzip") as f:
@@ -129,8 +136,7 @@ class InputSharder:
 
                             if content_type.startswith("text/html"):
                                 h = record.reader.read()
-                                encoding = detect_encoding(h)
-                                h = bytes_to_str(h, encoding)
+                                h, _ = decode_html(h, record.http_headers.get("Content-Type"))
                                 url = str(record.headers["WARC-Target-URI"])
                                 html.append(str((h, url)))
 
@@ -164,6 +170,10 @@ class InputSharder:
         if len(shards_to_write) == 0:
             return [], number_shards
 
+        fs, tmp_path = fsspec.core.url_to_fs(self.tmp_path)
+        fs.makedirs(tmp_path, exist_ok=True)
+        options = pa.ipc.IpcWriteOptions(compression=self.compression)
+
         def write_shard(t):
             full_shard_id, shard_id = t
             begin_shard = shard_id * self.number_sample_per_shard
@@ -173,12 +183,13 @@ class InputSharder:
             for i in range(10):
                 try:
                     fs, tmp_path = fsspec.core.url_to_fs(tmp_file)
-    
+
                     with fs.open(tmp_path, "wb") as file:
-                        with pa.ipc.new_file(file, df_shard.schema) as writer:
+                        with pa.ipc.new_file(file, df_shard.schema, options=options) as writer:
                             writer.write_table(df_shard)
-                       
-                    return (full_shard_id, tmp_file)
+                        shard_bytes = file.tell()
+
+                    return (full_shard_id, tmp_file, shard_bytes)
                 except Exception as e:  # pylint: disable=broad-except
                     if i != 9:
                         print(e)
@@ -205,6 +216,8 @@ class InputSharder:
                     raise e
 
         shards.sort(key=lambda k: k[0])
+        print(f"{sum(shard[2] for shard in shards) / 1024**2:.1f} MB of shards written to {self.tmp_path}")
+        shards = [shard[:2] for shard in shards]
 
         del df
 
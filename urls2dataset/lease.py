@@ -0,0 +1,135 @@
+"""lease module lets several nodes share the shards of one job through the output filesystem"""
+
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+
+import fsspec
+
+# status of a shard leased by another worker, the distributors run it again once its lease may have expired
+LEASED = "leased"
+
+
+def read_lease(fs, lease_file):
+    """Return the content of a lease file, None if it doesn't exist or is being written"""
+    try:
+        with fs.open(lease_file, "r") as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+class Lease:
+    """A claimed shard, the lease file is refreshed by a heartbeat thread until release() is called
+
+    lost is set once another worker reclaimed the lease, the shard must then be abandoned.
+    handed_over is set once another process adopted the lease, stop() then leaves the lease file to it.
+    """
+
+    def __init__(self, fs, lease_file, owner, heartbeat_interval):
+        self.fs = fs
+        self.lease_file = lease_file
+        self.owner = owner
+        self.heartbeat_interval = heartbeat_interval
+        self.lost = False
+        self.handed_over = False
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._heartbeat, daemon=True)
+        self.thread.start()
+
+    def _is_owner(self):
+        lease = read_lease(self.fs, self.lease_file)
+        return lease is not None and lease["owner"] == self.owner
+
+    def _heartbeat(self):
+        while not self.stopped.wait(self.heartbeat_interval):
+            try:
+                if not self._is_owner():
+                    self.lost = True
+                    print(f"lease {self.lease_file} was reclaimed by another worker")
+                    return
+                with self.fs.open(self.lease_file, "w") as f:
+                    json.dump({"owner": self.owner, "heartbeat": time.time()}, f)
+            except Exception as err:  # pylint: disable=broad-except
+                # the next heartbeats may still refresh the lease before it expires
+                print(f"failed to refresh lease {self.lease_file}: {err}")
+
+    def stop(self):
+        """Stop refreshing the lease without removing the lease file"""
+        self.stopped.set()
+        self.thread.join()
+
+    def release(self):
+        self.stop()
+        if self._is_owner():
+            self.fs.rm(self.lease_file)
+
+
+class ShardLeases:
+    """Claim shards with lease files in {output_folder}/_tmp/leases
+
+    A shard can be claimed when it is not committed (its stats file doesn't exist)
+    and nobody holds a lease on it whose heartbeat is more recent than ttl seconds.
+    Lease files are created exclusively when the filesystem supports it,
+    in all cases the lease is read back after settle_time to check which worker won it.
+    """
+
+    def __init__(self, output_folder, oom_shard_count, ttl=300, settle_time=1.0):
+        self.output_folder = output_folder
+        self.oom_shard_count = oom_shard_count
+        self.ttl = ttl
+        self.settle_time = settle_time
+
+    def _lease_file(self, output_path, shard_name):
+        return f"{output_path}/_tmp/leases/{shard_name}.lease"
+
+    def _shard_name(self, shard_id):
+        return "{shard_id:0{oom_shard_count}d}".format(  # pylint: disable=consider-using-f-string
+            shard_id=shard_id, oom_shard_count=self.oom_shard_count
+        )
+
+    def adopt(self, shard_id, owner):
+        """Keep refreshing a lease claimed by another process of this job, until release() is called"""
+        fs, output_path = fsspec.core.url_to_fs(self.output_folder, use_listings_cache=False)
+        return Lease(fs, self._lease_file(output_path, self._shard_name(shard_id)), owner, self.ttl / 5)
+
+    def is_done(self, shard_id):
+        fs, output_path = fsspec.core.url_to_fs(self.output_folder, use_listings_cache=False)
+        return fs.exists(f"{output_path}/{self._shard_name(shard_id)}_stats.json")
+
+    def claim(self, shard_id):
+        """Return a Lease on the shard, or None if it is done or leased by another worker"""
+        fs, output_path = fsspec.core.url_to_fs(self.output_folder, use_listings_cache=False)
+        shard_name = self._shard_name(shard_id)
+        if self.is_done(shard_id):
+            return None
+        lease_file = self._lease_file(output_path, shard_name)
+        fs.makedirs(f"{output_path}/_tmp/leases", exist_ok=True)
+        if fs.exists(lease_file):
+            lease = read_lease(fs, lease_file)
+            # a lease file being written has no content yet, use its modification time
+            heartbeat = lease["heartbeat"] if lease is not None else fs.modified(lease_file).timestamp()
+            if time.time() - heartbeat < self.ttl:
+                return None
+            print(f"reclaiming expired lease of shard {shard_id}")
+            fs.rm(lease_file)
+
+        owner = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex}"
+        content = json.dumps({"owner": owner, "heartbeat": time.time()})
+        try:
+            with fs.open(lease_file, "x") as f:
+                f.write(content)
+        except FileExistsError:
+            return None
+        except (ValueError, NotImplementedError):
+            # no exclusive creation on this filesystem, the last writer wins
+            with fs.open(lease_file, "w") as f:
+                f.write(content)
+        time.sleep(self.settle_time)
+        lease = read_lease(fs, lease_file)
+        if lease is None or lease["owner"] != owner:
+            return None
+        return Lease(fs, lease_file, owner, self.ttl / 5)
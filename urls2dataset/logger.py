@@ -1,13 +1,19 @@
-"""logging utils for the downloader"""
+"""logging utils for the downloader
+
+wandb takes seconds to import, it is only imported when enabled
+"""
 
-import wandb
 import time
 from collections import Counter
 import fsspec
+import http.server
 import json
 import multiprocessing
-import queue
+import threading
 import traceback
+import uuid
+
+from .timing import merge_stage_timings, prometheus_text
 
 
 class CappedCounter:
@@ -154,6 +160,8 @@ class SpeedLogger(Logger):
         )
 
         if self.enable_wandb:
+            import wandb  # pylint: disable=import-outside-toplevel
+
             wandb.log(
                 {
                     f"{self.prefix}/vid_per_sec": vid_per_sec,
@@ -177,6 +185,8 @@ class StatusTableLogger(Logger):
 
     def do_log(self, status_dict, count):  # pylint: disable=arguments-differ
         if self.enable_wandb:
+            import wandb  # pylint: disable=import-outside-toplevel
+
             status_table = wandb.Table(
                 columns=["status", "frequency", "count"],
                 data=[[k, 1.0 * v / count, v] for k, v in status_dict.most_common(self.max_status)],
@@ -196,6 +206,7 @@ def write_stats(
     end_time,
     status_dict,
     oom_shard_count,
+    extra_stats=None,
 ):
     """Write stats to disk"""
     stats = {
@@ -209,6 +220,8 @@ def write_stats(
         "end_time": end_time,
         "status_dict": status_dict.dump(),
     }
+    if extra_stats is not None:
+        stats.update(extra_stats)
     fs, output_path = fsspec.core.url_to_fs(output_folder)
     shard_name = (
         shard_id
@@ -218,14 +231,93 @@ def write_stats(
         )
     )
     json_file = f"{output_path}/{shard_name}_stats.json"
-    with fs.open(json_file, "w") as f:
-        json.dump(stats, f, indent=4)
+    commit_json(fs, json_file, stats)
+    return stats
+
+
+def commit_json(fs, json_file, data):
+    """Write then rename so that a stats file, which marks its shard as done, is never seen half written"""
+    tmp_file = f"{json_file}.{uuid.uuid4().hex}.tmp"
+    with fs.open(tmp_file, "w") as f:
+        json.dump(data, f, indent=4)
+    fs.mv(tmp_file, json_file)
+
+
+def merge_stats(output_folder, shard_id, stats_files, oom_shard_count):
+    """Merge the stats files of the pieces of a split shard into the stats file of the shard
+
+    Numbers are summed except the times and the peaks, status dicts are merged and lists are concatenated
+    """
+    fs, output_path = fsspec.core.url_to_fs(output_folder)
+    merged = {}
+    for stats_file in stats_files:
+        with fs.open(stats_file, "r") as f:
+            stats = json.load(f)
+        for k, v in stats.items():
+            if k not in merged:
+                merged[k] = v
+            elif k == "start_time":
+                merged[k] = min(merged[k], v)
+            elif k in ["end_time", "startup_latency", "peak_buffered_bytes"]:
+                merged[k] = max(merged[k], v)
+            elif k == "status_dict":
+                merged[k] = dict(Counter(merged[k]) + Counter(v))
+            elif k == "stage_timings":
+                merged[k] = merge_stage_timings(merged[k], v)
+            elif isinstance(v, (int, float, list)):
+                merged[k] += v
+    merged["duration"] = merged["end_time"] - merged["start_time"]
+    merged["split_count"] = len(stats_files)
+    shard_name = (
+        shard_id
+        if isinstance(shard_id, str)
+        else "{shard_id:0{oom_shard_count}d}".format(  # pylint: disable=consider-using-f-string
+            shard_id=shard_id, oom_shard_count=oom_shard_count
+        )
+    )
+    json_file = f"{output_path}/{shard_name}_stats.json"
+    commit_json(fs, json_file, merged)
+    fs.rm(stats_files)
+    return merged
+
+
+def write_metrics(metrics_file, metrics_text):
+    """Replace the metrics file, scrapers never see it half written"""
+    fs, metrics_path = fsspec.core.url_to_fs(metrics_file)
+    tmp_file = f"{metrics_path}.{uuid.uuid4().hex}.tmp"
+    with fs.open(tmp_file, "w") as f:
+        f.write(metrics_text)
+    fs.mv(tmp_file, metrics_path)
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    """Serve the metrics text of the server on /metrics"""
+
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = self.server.metrics_text.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        pass
 
 
 # https://docs.python.org/3/library/multiprocessing.html
-# logger process that reads stats files regularly, aggregates and send to wandb / print to terminal
+# logger process that receives the stats of the shards, aggregates and send to wandb / print to terminal
 class LoggerProcess(multiprocessing.context.SpawnProcess):
-    """Logger process that reads stats files regularly, aggregates and send to wandb / print to terminal"""
+    """Logger process that receives the stats of committed shards, aggregates and send to wandb / print to terminal
+
+    Workers put their shard stats dicts in stats_queue, a manager queue so that it can be sent to pool workers.
+    Each shard only updates running totals, the _stats.json files stay the durable record.
+    The totals and the stage timings can be exposed in Prometheus text format
+    in metrics_file and/or on http://localhost:{metrics_port}/metrics
+    """
 
     def __init__(
         self,
@@ -233,25 +325,27 @@ class LoggerProcess(multiprocessing.context.SpawnProcess):
         enable_wandb,
         wandb_project,
         config_parameters,
+        stats_queue,
         log_interval=5,
+        metrics_file=None,
+        metrics_port=None,
     ):
         super().__init__()
+        self.metrics_file = metrics_file
+        self.metrics_port = metrics_port
         self.log_interval = log_interval
         self.enable_wandb = enable_wandb
         self.output_folder = output_folder
-        self.stats_files = set()
         self.wandb_project = wandb_project
-        self.done_shards = set()
         self.config_parameters = config_parameters
-        ctx = multiprocessing.get_context("spawn")
-        self.q = ctx.Queue()
+        self.stats_queue = stats_queue
 
     def run(self):
         """Run logger process"""
 
-        fs, output_path = fsspec.core.url_to_fs(self.output_folder, use_listings_cache=False)
-
         if self.enable_wandb:
+            import wandb  # pylint: disable=import-outside-toplevel
+
             self.current_run = wandb.init(
                 project=self.wandb_project,
                 config=self.config_parameters,
@@ -259,74 +353,69 @@ class LoggerProcess(multiprocessing.context.SpawnProcess):
             )
         else:
             self.current_run = None
-        self.total_speed_logger = SpeedLogger("total", enable_wandb=self.enable_wandb)
+        self.total_speed_logger = SpeedLogger("total", enable_wandb=self.enable_wandb, min_interval=self.log_interval)
         self.status_table_logger = StatusTableLogger(enable_wandb=self.enable_wandb)
-        last_check = 0
         total_status_dict = CappedCounter()
+        stage_timings = {}
+        shards = 0
+        scratch_bytes = Counter()
+        metrics_server = None
+        if self.metrics_port is not None:
+            metrics_server = http.server.ThreadingHTTPServer(("", self.metrics_port), MetricsHandler)
+            metrics_server.metrics_text = prometheus_text({}, {})
+            threading.Thread(target=metrics_server.serve_forever, daemon=True).start()
         while True:
-            time.sleep(0.1)
-            try:
-                self.q.get(False)
-                last_one = True
-            except queue.Empty as _:
-                last_one = False
-            if not last_one and time.perf_counter() - last_check < self.log_interval:
-                continue
-
-            try:
-                # read stats files
-                stats_files = fs.glob(output_path + "/*.json")
-
-                # filter out files that have an id smaller that are already done
-                stats_files = [f for f in stats_files if int(f.split("/")[-1].split("_")[0]) not in self.done_shards]
-
-                # get new stats files
-                new_stats_files = set(stats_files) - self.stats_files
-                if len(new_stats_files) == 0:
-                    if last_one:
-                        self.finish()
-                        return
-
-                # read new stats files
-                for stats_file in new_stats_files:
-                    with fs.open(stats_file, "r") as f:
-                        try:
-                            stats = json.load(f)
-                            SpeedLogger("worker", enable_wandb=self.enable_wandb)(
-                                count=stats["count"],
-                                success=stats["successes"],
-                                failed_to_download=stats["failed_to_download"],
-                                failed_to_subsample=stats["failed_to_subsample"],
-                                bytes_downloaded=stats["bytes_downloaded"],
-                                start_time=stats["start_time"],
-                                end_time=stats["end_time"],
-                            )
-                            self.total_speed_logger(
-                                count=stats["count"],
-                                success=stats["successes"],
-                                failed_to_download=stats["failed_to_download"],
-                                failed_to_subsample=stats["failed_to_subsample"],
-                                bytes_downloaded=stats["bytes_downloaded"],
-                                start_time=stats["start_time"],
-                                end_time=stats["end_time"],
-                            )
-                            status_dict = CappedCounter.load(stats["status_dict"])
-                            total_status_dict.update(status_dict)
-                            self.status_table_logger(total_status_dict, self.total_speed_logger.count)
-                        except Exception as err:  # pylint: disable=broad-except
-                            print(f"failed to parse stats file {stats_file}", err)
-
-                    self.stats_files.add(stats_file)
-                last_check = time.perf_counter()
-
-                if last_one:
-                    self.finish()
-                    return
-            except Exception as e:  # pylint: disable=broad-except
-                traceback.print_exc()
-                print("logger error", e)
+            stats = self.stats_queue.get()
+            if stats is None:
+                if metrics_server is not None:
+                    metrics_server.shutdown()
                 self.finish()
                 return
+            try:
+                SpeedLogger("worker", enable_wandb=self.enable_wandb)(
+                    count=stats["count"],
+                    success=stats["successes"],
+                    failed_to_download=stats["failed_to_download"],
+                    failed_to_subsample=stats["failed_to_subsample"],
+                    bytes_downloaded=stats["bytes_downloaded"],
+                    start_time=stats["start_time"],
+                    end_time=stats["end_time"],
+                )
+                self.total_speed_logger(
+                    count=stats["count"],
+                    success=stats["successes"],
+                    failed_to_download=stats["failed_to_download"],
+                    failed_to_subsample=stats["failed_to_subsample"],
+                    bytes_downloaded=stats["bytes_downloaded"],
+                    start_time=stats["start_time"],
+                    end_time=stats["end_time"],
+                )
+                total_status_dict.update(CappedCounter.load(stats["status_dict"]))
+                self.status_table_logger(total_status_dict, self.total_speed_logger.count)
+                if self.metrics_file is not None or metrics_server is not None:
+                    shards += 1
+                    stage_timings = merge_stage_timings(stage_timings, stats.get("stage_timings", {}))
+                    scratch_bytes.update({k: stats.get(f"scratch_bytes_{k}", 0) for k in ["written", "read"]})
+                    metrics_text = prometheus_text(
+                        {
+                            "shards_total": shards,
+                            "samples_total": self.total_speed_logger.count,
+                            "successes_total": self.total_speed_logger.success,
+                            "failed_to_download_total": self.total_speed_logger.failed_to_download,
+                            "failed_to_subsample_total": self.total_speed_logger.failed_to_subsample,
+                            "bytes_downloaded_total": self.total_speed_logger.bytes_downloaded,
+                            "scratch_bytes_written_total": scratch_bytes["written"],
+                            "scratch_bytes_read_total": scratch_bytes["read"],
+                        },
+                        stage_timings,
+                    )
+                    if metrics_server is not None:
+                        metrics_server.metrics_text = metrics_text
+                    if self.metrics_file is not None:
+                        write_metrics(self.metrics_file, metrics_text)
+            except Exception as err:  # pylint: disable=broad-except
+                traceback.print_exc()
+                print("failed to log shard stats", err)
 
     def finish(self):
         """Finish logger process"""
@@ -337,6 +426,5 @@ class LoggerProcess(multiprocessing.context.SpawnProcess):
 
     def join(self, timeout=None):
         """Stop logger process"""
-        self.q.put("stop")
-        super().join()
-        self.q.close()
+        self.stats_queue.put(None)
+        super().join(timeout)
@@ -1,15 +1,33 @@
 import fsspec
+import hashlib
+from fsspec.implementations.local import LocalFileSystem
+from functools import partial
 from .input_sharder import InputSharder
 from .download_worker import DownloadWorker
 from typing import List, Optional
+import multiprocessing
 import os
+import shutil
+import uuid
 from .data_writer import (
     WebDatasetSampleWriter,
     ParquetSampleWriter,
+    FilesSampleWriter,
+    ArrowSampleWriter,
+    JsonlZstSampleWriter,
+    RollingSampleWriter,
 )
 from .distributor import (
     multiprocessing_distributor,
+    pyspark_distributor,
+    ray_distributor,
+    work_stealing_distributor,
 )
+from .index import build_index
+from .lease import ShardLeases
+from .logger import LoggerProcess
+from .manifest import Manifest, ManifestCompactor
+from .robots import RobotsCache
 
 
 def identity(x):
@@ -36,11 +54,48 @@ def urls2dataset(
     config={},
     postprocess_func=None,
     filters_config={},
-    clean_text=False
+    clean_text=False,
+    writer_queue_size: int = 100,
+    upload_block_size: int = 32 * 1024**2,
+    webdataset_compression: Optional[str] = None,
+    save_parquet_meta: bool = True,
+    write_index: bool = True,
+    max_shard_bytes: Optional[int] = None,
+    arrow_compression: Optional[str] = "zstd",
+    distributor: str = "multiprocessing",
+    enable_leases: bool = False,
+    lease_ttl: int = 300,
+    checkpoint_interval: Optional[int] = None,
+    rebuild_manifest: bool = False,
+    manifest_compact_interval: int = 600,
+    enable_wandb: bool = False,
+    wandb_project: str = "urls2dataset",
+    metrics_file: Optional[str] = None,
+    metrics_port: Optional[int] = None,
+    profile: bool = False,
+    profile_fraction: float = 0.05,
+    adaptive_concurrency: bool = False,
+    min_thread_count: int = 1,
+    max_thread_count: Optional[int] = None,
+    url_retries: int = 2,
+    max_retries_per_shard: int = 1000,
+    retry_backoff: float = 1.0,
+    max_retry_delay: float = 60.0,
+    host_failure_threshold: Optional[int] = 5,
+    host_cooldown: float = 60.0,
+    respect_robots: bool = False,
+    robots_ttl: int = 24 * 3600,
+    max_buffered_bytes: Optional[int] = 256 * 1024**2,
+    shard_compression: Optional[str] = "lz4",
+    start_method: str = "spawn",
 ):
     """
     extract text from webpage links
     """
+    # the logger process is spawned, keep only the parameters that can be sent to it
+    config_parameters = {
+        k: v if isinstance(v, (str, int, float, bool, list, type(None))) else repr(v) for k, v in locals().items()
+    }
 
     def make_path_absolute(path):
         fs, p = fsspec.core.url_to_fs(path)
@@ -51,21 +106,24 @@ def urls2dataset(
     output_folder = make_path_absolute(output_folder)
     url_list = make_path_absolute(url_list)
 
-    tmp_path = output_folder + "/_tmp"
-    fs, run_tmp_dir = fsspec.core.url_to_fs(tmp_path)
-    if not fs.exists(run_tmp_dir):
-        fs.mkdir(run_tmp_dir)
-
     sampler = identity
 
     fs, output_path = fsspec.core.url_to_fs(output_folder)
+    manifest = Manifest(output_folder, oom_shard_count)
 
     if not fs.exists(output_path):
         fs.mkdir(output_path)
         done_shards = set()
     else:
         if incremental_mode == "incremental":
-            done_shards = set(int(x.split("/")[-1].split("_")[0]) for x in fs.glob(output_path + "/*.json"))
+            # listing the stats files is slow on big outputs, it is only done to rebuild the manifest
+            if rebuild_manifest:
+                manifest.rebuild()
+            elif not manifest.exists():
+                # outputs written before the manifest existed have only their stats files
+                print(f"no manifest in {output_folder}, rebuilding it from the stats files")
+                manifest.rebuild()
+            done_shards = manifest.done_shards()
         elif incremental_mode == "overwrite":
             fs.rm(output_path, recursive=True)
             fs.mkdir(output_path)
@@ -73,15 +131,51 @@ def urls2dataset(
         else:
             raise ValueError(f"Unknown incremental mode {incremental_mode}")
 
+    # after the incremental mode handling, overwrite would remove it
+    tmp_path = output_folder + "/_tmp"
+    fs, run_tmp_dir = fsspec.core.url_to_fs(tmp_path)
+    if not fs.exists(run_tmp_dir):
+        fs.mkdir(run_tmp_dir)
+
+    robots = None
+    if respect_robots:
+        # sqlite needs a local file, with a remote output folder each node has its cache in tmp_dir
+        if isinstance(fs, LocalFileSystem):
+            robots_db = f"{run_tmp_dir}/robots.sqlite"
+        else:
+            robots_db = os.path.join(tmp_dir, f"robots_{hashlib.md5(output_folder.encode()).hexdigest()}.sqlite")
+        robots = RobotsCache(robots_db, ttl=robots_ttl, timeout=timeout)
+
+    # block_size is the part size of multipart uploads on object stores
+    writer_kwargs = {"block_size": upload_block_size, "write_index": write_index}
     if output_format == "webdataset":
         sample_writer_class = WebDatasetSampleWriter
+        writer_kwargs.update(compression=webdataset_compression, save_parquet_meta=save_parquet_meta)
     elif output_format == "parquet":
         sample_writer_class = ParquetSampleWriter  # type: ignore
+    elif output_format == "files":
+        sample_writer_class = FilesSampleWriter  # type: ignore
+    elif output_format == "arrow":
+        sample_writer_class = ArrowSampleWriter  # type: ignore
+        writer_kwargs.update(compression=arrow_compression)
+    elif output_format == "jsonl.zst":
+        sample_writer_class = JsonlZstSampleWriter  # type: ignore
     else:
         raise ValueError(f"Invalid output format {output_format}")
+    sample_writer_class = partial(sample_writer_class, **writer_kwargs)  # type: ignore
+    if max_shard_bytes is not None or checkpoint_interval is not None:
+        # roll output files at a target size, independently of number_sample_per_shard,
+        # checkpoints also close the current part so that a resumed shard keeps the parts already written
+        sample_writer_class = partial(RollingSampleWriter, sample_writer_class, max_shard_bytes)  # type: ignore
 
     save_caption = caption_col is not None
 
+    # the input shards are scratch data, written once and read once by a local worker,
+    # pyspark and ray executors may run on other nodes and read them from the output folder
+    if distributor in ["multiprocessing", "work_stealing"]:
+        shard_path = os.path.join(tmp_dir, f"urls2dataset_shards_{uuid.uuid4().hex}")
+    else:
+        shard_path = tmp_path
     shard_iterator = InputSharder(
         url_list,
         input_format,
@@ -90,10 +184,17 @@ def urls2dataset(
         save_additional_columns,
         number_sample_per_shard,
         done_shards,
-        tmp_path,
+        shard_path,
         sampler,
+        compression=shard_compression,
     )
 
+    # workers push the stats of their shards to the logger process,
+    # pyspark and ray workers run outside of this machine's processes and only write the stats files
+    ctx = multiprocessing.get_context("spawn")
+    manager = ctx.Manager() if distributor in ["multiprocessing", "work_stealing"] else None
+    stats_queue = manager.Queue() if manager is not None else None
+
     worker = DownloadWorker(
         sample_writer_class=sample_writer_class,
         save_caption=save_caption,
@@ -108,18 +209,80 @@ def urls2dataset(
         common_crawl=input_format == "cc",
         postprocess_func=postprocess_func,
         filters_config=filters_config,
-        clean_text=clean_text
+        clean_text=clean_text,
+        writer_queue_size=writer_queue_size,
+        # nodes running the same command on a shared output folder claim shards with lease files
+        shard_leases=ShardLeases(output_folder, oom_shard_count, lease_ttl) if enable_leases else None,
+        checkpoint_interval=checkpoint_interval,
+        manifest=manifest,
+        stats_queue=stats_queue,
+        # a deterministic sample of the shards runs under cProfile, see urls2dataset.profiler.merge_profiles
+        profile=profile,
+        profile_fraction=profile_fraction,
+        # thread_count is adjusted per shard between min_thread_count and max_thread_count (4 * thread_count)
+        adaptive_concurrency=adaptive_concurrency,
+        min_thread_count=min_thread_count,
+        max_thread_count=max_thread_count,
+        # timeouts and 429/502/503/504 responses are fetched again at the end of the shard, honoring Retry-After
+        url_retries=url_retries,
+        max_retries_per_shard=max_retries_per_shard,
+        retry_backoff=retry_backoff,
+        max_retry_delay=max_retry_delay,
+        # after that many connect failures or timeouts in a row, a host is skipped for host_cooldown seconds
+        host_failure_threshold=host_failure_threshold,
+        host_cooldown=host_cooldown,
+        robots=robots,
+        # fetches wait while the fetched samples not processed yet hold that much text, per process
+        max_buffered_bytes=max_buffered_bytes,
+        shard_compression=shard_compression,
     )
 
-    distributor_fn = multiprocessing_distributor
+    if distributor == "multiprocessing":
+        distributor_fn = multiprocessing_distributor
+    elif distributor == "pyspark":
+        distributor_fn = pyspark_distributor
+    elif distributor == "ray":
+        distributor_fn = ray_distributor
+    elif distributor == "work_stealing":
+        distributor_fn = work_stealing_distributor
+    else:
+        raise ValueError(f"Distributor {distributor} not supported")
+    if distributor in ["multiprocessing", "work_stealing"]:
+        # forkserver starts the download processes from a server that imported their modules once
+        distributor_fn = partial(distributor_fn, start_method=start_method)
+
+    compactor = ManifestCompactor(manifest, manifest_compact_interval)
+    # the logger process isn't a daemon, it is started last so that the finally below always stops it
+    if stats_queue is not None:
+        logger_process = LoggerProcess(
+            output_folder,
+            enable_wandb,
+            wandb_project,
+            config_parameters,
+            stats_queue,
+            metrics_file=metrics_file,
+            metrics_port=metrics_port,
+        )
+        logger_process.start()
+    compactor.start()
+    try:
+        distributor_fn(
+            processes_count,
+            worker,
+            shard_iterator,
+            subjob_size,
+            max_shard_retry,
+        )
+    finally:
+        compactor.stop()
+        if shard_path != tmp_path:
+            shutil.rmtree(shard_path, ignore_errors=True)
+        if manager is not None:
+            logger_process.join()
+            manager.shutdown()
 
-    distributor_fn(
-        processes_count,
-        worker,
-        shard_iterator,
-        subjob_size,
-        max_shard_retry,
-    )
+    if write_index:
+        build_index(output_folder)
 
 
 def main():
@@ -0,0 +1,112 @@
+"""manifest module keeps track of the committed shards of an output folder without listing it"""
+
+import threading
+import uuid
+
+import fsspec
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+
+class Manifest:
+    """Completion manifest in {output_folder}/_manifest
+
+    Committing a shard appends an empty {shard_name}.done entry to _manifest/log,
+    compact() folds the log into a parquet file of shard ids in _manifest/done.
+    Each compaction writes a new file then removes only the files and entries it merged,
+    so concurrent compactions (one per node) can't lose entries, at worst they duplicate them.
+    """
+
+    def __init__(self, output_folder, oom_shard_count):
+        self.output_folder = output_folder
+        self.oom_shard_count = oom_shard_count
+
+    def _paths(self):
+        fs, output_path = fsspec.core.url_to_fs(self.output_folder, use_listings_cache=False)
+        return fs, f"{output_path}/_manifest/log", f"{output_path}/_manifest/done"
+
+    def add(self, shard_id):
+        """Record a committed shard"""
+        fs, log_path, _ = self._paths()
+        shard_name = "{shard_id:0{oom_shard_count}d}".format(  # pylint: disable=consider-using-f-string
+            shard_id=shard_id, oom_shard_count=self.oom_shard_count
+        )
+        fs.makedirs(log_path, exist_ok=True)
+        fs.touch(f"{log_path}/{shard_name}.done")
+
+    def _list(self, fs, path, suffix):
+        if not fs.exists(path):
+            return []
+        return [f for f in fs.ls(path, detail=False) if f.endswith(suffix)]
+
+    def _read(self, fs, log_path, done_path):
+        entries = self._list(fs, log_path, ".done")
+        done_files = self._list(fs, done_path, ".parquet")
+        shard_ids = set(int(f.split("/")[-1].split(".")[0]) for f in entries)
+        for done_file in done_files:
+            with fs.open(done_file, "rb") as f:
+                shard_ids.update(pq.read_table(f)["shard_id"].to_pylist())
+        return shard_ids, entries, done_files
+
+    def done_shards(self):
+        """Set of the ids of the committed shards"""
+        fs, log_path, done_path = self._paths()
+        return self._read(fs, log_path, done_path)[0]
+
+    def _write_done(self, fs, done_path, shard_ids):
+        fs.makedirs(done_path, exist_ok=True)
+        table = pa.table({"shard_id": pa.array(sorted(shard_ids), pa.int64())})
+        tmp_file = f"{done_path}/.{uuid.uuid4().hex}.tmp"
+        with fs.open(tmp_file, "wb") as f:
+            pq.write_table(table, f)
+        fs.mv(tmp_file, f"{done_path}/{uuid.uuid4().hex}.parquet")
+
+    def compact(self):
+        """Merge the log entries and the compacted files into a single parquet file"""
+        fs, log_path, done_path = self._paths()
+        try:
+            shard_ids, entries, done_files = self._read(fs, log_path, done_path)
+        except FileNotFoundError:
+            # another node is compacting, its output has what we listed
+            return
+        if len(entries) == 0 and len(done_files) <= 1:
+            return
+        self._write_done(fs, done_path, shard_ids)
+        for f in entries + done_files:
+            try:
+                fs.rm(f)
+            except FileNotFoundError:
+                pass
+
+    def exists(self):
+        fs, output_path = fsspec.core.url_to_fs(self.output_folder, use_listings_cache=False)
+        return fs.exists(f"{output_path}/_manifest")
+
+    def rebuild(self):
+        """Record the shards that have a stats file, for outputs written without a manifest"""
+        fs, output_path = fsspec.core.url_to_fs(self.output_folder, use_listings_cache=False)
+        shard_names = [f.split("/")[-1][: -len("_stats.json")] for f in fs.glob(output_path + "/*_stats.json")]
+        self._write_done(fs, f"{output_path}/_manifest/done", [int(name) for name in shard_names if name.isdigit()])
+        self.compact()
+
+
+class ManifestCompactor(threading.Thread):
+    """Compact a manifest every interval seconds until stop() is called"""
+
+    def __init__(self, manifest, interval=600):
+        super().__init__(daemon=True)
+        self.manifest = manifest
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.manifest.compact()
+            except Exception as err:  # pylint: disable=broad-except
+                print(f"manifest compaction failed: {err}")
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        self.manifest.compact()
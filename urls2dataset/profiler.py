@@ -0,0 +1,106 @@
+"""profiler module profiles sampled shards and merges their profiles into one report"""
+
+import cProfile
+import io
+import os
+import pstats
+import random
+import sys
+import tempfile
+import threading
+from contextlib import contextmanager
+
+import fsspec
+
+# before python 3.12 cProfile only sees the thread that enabled it, fetch and writer threads get their own profiler
+PER_THREAD = sys.version_info < (3, 12)
+
+
+def should_profile(shard_id, fraction):
+    """Deterministic choice of the profiled shards, the same shards are picked by retries and other nodes"""
+    return random.Random(shard_id).random() < fraction
+
+
+class ShardProfiler:
+    """cProfile the calling thread and every function wrapped with wrap(), whatever thread runs it"""
+
+    def __init__(self):
+        self.profiles = []
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def _thread_profile(self):
+        if not hasattr(self.local, "profile"):
+            self.local.profile = cProfile.Profile()
+            with self.lock:
+                self.profiles.append(self.local.profile)
+        return self.local.profile
+
+    @contextmanager
+    def profile(self):
+        profile = self._thread_profile()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+
+    def wrap(self, func):
+        if not PER_THREAD:
+            return func
+
+        def profiled(*args, **kwargs):
+            with self.profile():
+                return func(*args, **kwargs)
+
+        return profiled
+
+    def dump(self, profile_file):
+        """Write the merged profiles of all threads in pstats format"""
+        for profile in self.profiles:
+            profile.create_stats()
+        stats = pstats.Stats(*[profile for profile in self.profiles if profile.stats])
+        fs, profile_path = fsspec.core.url_to_fs(profile_file)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            local_file = os.path.join(tmp_dir, "profile.prof")
+            stats.dump_stats(local_file)
+            fs.put(local_file, profile_path)
+
+
+def merge_profiles(output_folder, report_file=None, sort="cumulative", limit=50):
+    """Merge the shard profiles of an output folder, print the top functions and return the text report
+
+    The merged pstats file is written to {output_folder}/_profile.prof, a text report to report_file if given
+    """
+    fs, output_path = fsspec.core.url_to_fs(output_folder)
+    profile_files = sorted(fs.glob(output_path + "/*_profile.prof"))
+    if len(profile_files) == 0:
+        raise ValueError(f"No shard profile found in {output_folder}")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        local_files = []
+        for i, profile_file in enumerate(profile_files):
+            local_files.append(os.path.join(tmp_dir, f"{i}.prof"))
+            fs.get(profile_file, local_files[-1])
+        report = io.StringIO()
+        stats = pstats.Stats(*local_files, stream=report)
+        print(f"Merged profiles of {len(profile_files)} shards", file=report)
+        stats.sort_stats(sort).print_stats(limit)
+        merged_file = os.path.join(tmp_dir, "merged.prof")
+        stats.dump_stats(merged_file)
+        fs.put(merged_file, output_path + "/_profile.prof")
+    report_text = report.getvalue()
+    if report_file is not None:
+        with fsspec.open(report_file, "w") as f:
+            f.write(report_text)
+    print(report_text)
+    return report_text
+
+
+def main():
+    import fire  # pylint: disable=import-outside-toplevel
+
+    fire.Fire(merge_profiles)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""retry module holds the samples of a shard whose fetch failed transiently until they can be fetched again"""
+
+import heapq
+import itertools
+import random
+import threading
+import time
+
+
+class RetryQueue:
+    """Failed samples waiting for their retry, handed out after the fresh samples of the shard
+
+    A sample is retried at most retries times, and a shard at most max_retries times in total. The delay before a
+    retry is drawn uniformly up to backoff * 2**attempt (full jitter), at least what the server asked for with
+    Retry-After, a sample asked to wait more than max_delay isn't retried.
+    Outstanding counts the samples handed to the fetch threads and not processed yet, they may still come back.
+    """
+
+    def __init__(self, retries=2, max_retries=1000, backoff=1.0, max_delay=60.0, seed=None):
+        self.retries = retries
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_delay = max_delay
+        self.rng = random.Random(seed)
+        self.attempts = {}
+        self.scheduled = []
+        self.order = itertools.count()
+        self.outstanding = 0
+        self.retried = 0
+        self.closed = False
+        self.condition = threading.Condition()
+
+    def started(self):
+        with self.condition:
+            self.outstanding += 1
+
+    def finished(self):
+        with self.condition:
+            self.outstanding -= 1
+            self.condition.notify_all()
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def schedule(self, sample, key, retry_after):
+        """Schedule a retry of sample, return False if it gets none"""
+        with self.condition:
+            attempt = self.attempts.get(key, 0)
+            if attempt >= self.retries or self.retried >= self.max_retries or retry_after > self.max_delay:
+                return False
+            delay = max(retry_after, self.rng.uniform(0, min(self.max_delay, self.backoff * 2**attempt)))
+            self.attempts[key] = attempt + 1
+            self.retried += 1
+            heapq.heappush(self.scheduled, (time.monotonic() + delay, next(self.order), sample))
+            self.condition.notify_all()
+            return True
+
+    def is_retry(self, key):
+        return key in self.attempts
+
+    def next(self):
+        """Wait for the next due retry, None once nothing is scheduled nor outstanding"""
+        with self.condition:
+            while not self.closed:
+                if self.scheduled:
+                    due, _, sample = self.scheduled[0]
+                    wait = due - time.monotonic()
+                    if wait <= 0:
+                        heapq.heappop(self.scheduled)
+                        return sample
+                    self.condition.wait(wait)
+                elif self.outstanding > 0:
+                    self.condition.wait()
+                else:
+                    return None
+            return None
@@ -0,0 +1,125 @@
+"""robots module checks urls against the robots.txt of their host, fetched once per job and cached in sqlite"""
+
+import sqlite3
+import threading
+import time
+from urllib.parse import urlparse
+from urllib.robotparser import RobotFileParser
+
+import requests
+
+DISALLOWED_BY_ROBOTS = "disallowed_by_robots"
+# robots.txt files are truncated to 500 KiB, as RFC 9309 allows
+MAX_ROBOTS_BYTES = 500 * 1024
+
+
+def robots_parser(status, body):
+    """Parser of a robots.txt fetch following RFC 9309
+
+    A 4xx means no rules, a 5xx or an unreachable host (status 0) means everything is disallowed
+    """
+    parser = RobotFileParser()
+    if 200 <= status < 300:
+        parser.parse(body.splitlines())
+    elif 400 <= status < 500:
+        parser.parse([])
+    else:
+        parser.disallow_all = True
+    return parser
+
+
+class RobotsCache:
+    """robots.txt policies shared by the worker processes through a sqlite database
+
+    The process that inserts the row of a host fetches its robots.txt, the others wait for the row to be filled.
+    Policies older than ttl seconds are fetched again, a claim older than claim_timeout is taken over,
+    the process holding it probably died. Each process also keeps the parsed policies in memory.
+    """
+
+    def __init__(self, db_path, ttl=24 * 3600, timeout=10, claim_timeout=60, headers=None):
+        self.db_path = db_path
+        self.ttl = ttl
+        self.timeout = timeout
+        self.claim_timeout = claim_timeout
+        self.headers = headers or {}
+        self._init_state()
+
+    def _init_state(self):
+        self.lock = threading.Lock()
+        self.host_locks = {}
+        self.parsers = {}
+        self.connection = None
+
+    def __getstate__(self):
+        # connections and locks stay in their process
+        return {k: self.__dict__[k] for k in ["db_path", "ttl", "timeout", "claim_timeout", "headers"]}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_state()
+
+    def _execute(self, query, params=()):
+        """Run a query on the connection of this process, return its rows and row count"""
+        with self.lock:
+            if self.connection is None:
+                self.connection = sqlite3.connect(self.db_path, timeout=30, check_same_thread=False)
+                self.connection.execute("PRAGMA journal_mode=WAL")
+                self.connection.execute(
+                    "CREATE TABLE IF NOT EXISTS robots "
+                    "(host TEXT PRIMARY KEY, status INTEGER, body TEXT, fetched REAL, claimed REAL)"
+                )
+                self.connection.commit()
+            cursor = self.connection.execute(query, params)
+            rows = cursor.fetchall()
+            self.connection.commit()
+            return rows, cursor.rowcount
+
+    def fetch(self, origin):
+        """Status and body of the robots.txt of origin, status 0 if the host can't be reached"""
+        try:
+            resp = requests.get(f"{origin}/robots.txt", headers=self.headers, timeout=self.timeout)
+            return resp.status_code, resp.content[:MAX_ROBOTS_BYTES].decode("utf-8", errors="replace")
+        except requests.RequestException:
+            return 0, ""
+
+    def policy(self, origin):
+        """Parser of the robots.txt of origin, fetching it if no process did yet"""
+        now = time.time()
+        cached = self.parsers.get(origin)
+        if cached is not None and cached[0] > now:
+            return cached[1]
+        with self.lock:
+            host_lock = self.host_locks.setdefault(origin, threading.Lock())
+        # the threads of a process wait for the one fetching
+        with host_lock:
+            cached = self.parsers.get(origin)
+            if cached is not None and cached[0] > time.time():
+                return cached[1]
+            while True:
+                now = time.time()
+                rows, _ = self._execute("SELECT status, body, fetched FROM robots WHERE host = ?", (origin,))
+                if rows and rows[0][2] is not None and rows[0][2] > now - self.ttl:
+                    status, body, fetched = rows[0]
+                    break
+                _, claimed = self._execute(
+                    "INSERT INTO robots (host, claimed) VALUES (?, ?) ON CONFLICT (host) DO UPDATE SET "
+                    "claimed = excluded.claimed WHERE (fetched IS NULL OR fetched <= ?) "
+                    "AND (claimed IS NULL OR claimed < ?)",
+                    (origin, now, now - self.ttl, now - self.claim_timeout),
+                )
+                if claimed:
+                    status, body = self.fetch(origin)
+                    fetched = time.time()
+                    self._execute(
+                        "UPDATE robots SET status = ?, body = ?, fetched = ?, claimed = NULL WHERE host = ?",
+                        (status, body, fetched, origin),
+                    )
+                    break
+                time.sleep(0.1)
+            parser = robots_parser(status, body)
+            self.parsers[origin] = (fetched + self.ttl, parser)
+            return parser
+
+    def allowed(self, url, user_agent="*"):
+        parsed = urlparse(url)
+        return self.policy(f"{parsed.scheme}://{parsed.netloc}").can_fetch(user_agent, url)
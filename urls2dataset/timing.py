@@ -0,0 +1,101 @@
+"""timing module measures the time spent per sample in each processing stage"""
+
+import os
+import time
+from contextlib import contextmanager
+
+import numpy as np
+
+# upper bounds in seconds of the histogram buckets, from 0.1ms to about 100s, the last bucket is +inf
+BUCKETS = [0.0001 * 2**i for i in range(21)]
+
+
+class StageTimer:
+    """Collect the duration of each stage for the samples of a shard
+
+    Durations are appended from the fetch threads, list.append and dict.setdefault being atomic no lock is needed
+    """
+
+    def __init__(self):
+        self.durations = {}
+
+    @contextmanager
+    def time(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - start)
+
+    def record(self, stage, duration):
+        self.durations.setdefault(stage, []).append(duration)
+
+    def summary(self):
+        """Count, total, exact p50/p95/p99 and bucket counts of each stage"""
+        stage_timings = {}
+        for stage, durations in list(self.durations.items()):
+            durations = np.array(durations)
+            p50, p95, p99 = np.percentile(durations, [50, 95, 99])
+            stage_timings[stage] = {
+                "count": len(durations),
+                "total": float(durations.sum()),
+                "p50": float(p50),
+                "p95": float(p95),
+                "p99": float(p99),
+                "buckets": np.bincount(np.searchsorted(BUCKETS, durations), minlength=len(BUCKETS) + 1).tolist(),
+            }
+        return stage_timings
+
+
+def process_start_time():
+    """Wall clock time at which this process was started, None without /proc"""
+    try:
+        with open("/proc/self/stat", encoding="utf-8") as f:
+            # the command name in parentheses may hold spaces, starttime is the 20th field after it, in clock ticks
+            start_ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime", encoding="utf-8") as f:
+            uptime = float(f.read().split()[0])
+    except (OSError, ValueError, IndexError):
+        return None
+    return time.time() - (uptime - start_ticks / os.sysconf("SC_CLK_TCK"))
+
+
+def bucket_percentile(buckets, q):
+    """Upper bound of the bucket holding the q-th percentile"""
+    cumulative = np.cumsum(buckets)
+    i = int(np.searchsorted(cumulative, q / 100 * cumulative[-1]))
+    return BUCKETS[i] if i < len(BUCKETS) else float("inf")
+
+
+def merge_stage_timings(a, b):
+    """Merge two stage timing summaries, percentiles of the merge are estimated from the buckets"""
+    merged = dict(a)
+    for stage, timing in b.items():
+        if stage not in merged:
+            merged[stage] = timing
+            continue
+        buckets = [x + y for x, y in zip(merged[stage]["buckets"], timing["buckets"])]
+        merged[stage] = {
+            "count": merged[stage]["count"] + timing["count"],
+            "total": merged[stage]["total"] + timing["total"],
+            **{f"p{q}": bucket_percentile(buckets, q) for q in [50, 95, 99]},
+            "buckets": buckets,
+        }
+    return merged
+
+
+def prometheus_text(counters, stage_timings):
+    """Render job counters and stage timings in the Prometheus text exposition format"""
+    lines = []
+    for name, value in counters.items():
+        lines += [f"# TYPE urls2dataset_{name} counter", f"urls2dataset_{name} {value}"]
+    lines += [
+        "# HELP urls2dataset_stage_seconds Time spent per sample in each processing stage",
+        "# TYPE urls2dataset_stage_seconds histogram",
+    ]
+    for stage, timing in sorted(stage_timings.items()):
+        for bound, cumulative in zip(BUCKETS + ["+Inf"], np.cumsum(timing["buckets"])):
+            lines.append(f'urls2dataset_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+        lines.append(f'urls2dataset_stage_seconds_sum{{stage="{stage}"}} {timing["total"]}')
+        lines.append(f'urls2dataset_stage_seconds_count{{stage="{stage}"}} {timing["count"]}')
+    return "\n".join(lines) + "\n"